@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Size of what a device has to load after an ordinary change day: the full outputs against the delta outputs, for a
+# digested rule list with a share of its entries replaced since the previous run. Applying the delta to the previous
+# rule list must give the new one
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from bench_matcher import digest
+from m365digester.OutputRunner import OutputRunner
+from m365digester.RuleDelta import read_rule_list
+from m365digester.Synthetic import generate_endpoint_set
+
+churn = 0.01
+delta_files = {'generalcsv': ('csv', '.delta'), 'nftables': ('nft', '.update'), 'ipset': ('ipset', '.update')}
+
+
+def change_rule_list(rule_list: dict, share: float, seed: int = 365) -> dict:
+    """
+    Copy of 'rule_list' with 'share' of the entries of each list dropped, and as many new ones added
+    """
+    rnd = random.Random(seed)
+    changed = dict()
+    for list_name, acl_addresses in rule_list.items():
+        kept = [acl_address for acl_address in acl_addresses if rnd.random() >= share]
+        for index in range(len(acl_addresses) - len(kept)):
+            if list_name.lower().endswith('-ip'):
+                kept.append(f"198.51.{rnd.randrange(256)}.{rnd.randrange(256)}/32")
+            else:
+                kept.append(f"changed{index}.{rnd.randrange(1 << 30)}.example.com")
+        changed[list_name] = list(dict.fromkeys(kept))
+    return changed
+
+
+def apply_csv_delta(rule_list: dict, file_path: str) -> dict:
+    applied = {list_name: list(acl_addresses) for list_name, acl_addresses in rule_list.items()}
+    with open(file_path) as file_handle:
+        next(file_handle)
+        for line in file_handle:
+            action, list_name, acl_address = [field.strip('"') for field in line.split('","')[:3]]
+            if action == 'remove':
+                applied[list_name].remove(acl_address)
+            else:
+                applied.setdefault(list_name, list()).append(acl_address)
+    return applied
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000]
+    temp_dir = tempfile.mkdtemp()
+    print(f"{'entries':>10} {'rules':>8} {'output':>11} {'full KiB':>9} {'delta KiB':>10} {'lines':>15} {'ms':>8}")
+    for size in sizes:
+        file_path = os.path.join(temp_dir, f"endpoints-{size}.json")
+        with open(file_path, 'w') as file_handle:
+            json.dump(generate_endpoint_set(size), file_handle)
+        previous_rule_list = digest(file_path)
+        rule_list = change_rule_list(previous_rule_list, churn)
+
+        output_path = os.path.join(temp_dir, f"out-{size}")
+        os.mkdir(output_path)
+        config = {'output_path': output_path, 'output_type': list(delta_files), 'output_delta_enabled': True}
+        OutputRunner(config).run(previous_rule_list)
+        started = time.perf_counter()
+        OutputRunner(config).run(rule_list)
+        elapsed = time.perf_counter() - started
+
+        for output_type, (extension, suffix) in delta_files.items():
+            full_file_path = os.path.join(output_path, f"m365endpoint-output.{extension}")
+            with open(full_file_path) as full_file, open(full_file_path + suffix) as delta_file:
+                full_lines = sum(1 for _ in full_file)
+                delta_lines = sum(1 for _ in delta_file)
+            print(f"{size:>10} {sum(map(len, rule_list.values())):>8} {output_type:>11} "
+                  f"{os.path.getsize(full_file_path) / 1024:>9.0f} "
+                  f"{os.path.getsize(full_file_path + suffix) / 1024:>10.1f} "
+                  f"{f'{delta_lines}/{full_lines}':>15} {elapsed * 1000:>8.1f}", flush=True)
+
+        applied = apply_csv_delta(previous_rule_list, os.path.join(output_path, 'm365endpoint-output.csv.delta'))
+        state = read_rule_list(os.path.join(output_path, 'm365endpoint-output.state.json'))
+        if {list_name: set(acl_addresses) for list_name, acl_addresses in applied.items()} != \
+                {list_name: set(acl_addresses) for list_name, acl_addresses in rule_list.items()} or state != rule_list:
+            raise Exception('Delta applied to the previous rule list differs from the new rule list')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Excluding subtrees and address ranges from a digested rule list in an SQLite file store: the compiled exclusion
+# matcher applied in one pass and one transaction, against removing each address the patterns cover one at a time
+# with its own commit, as listing every entry as an exact exclusion used to. Both must leave the same rules
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from bench_matcher import digest
+from m365digester.ExclusionMatcher import ExclusionMatcher
+from m365digester.Lib import SQLiteContext
+from m365digester.RuleStores.SQLiteRuleStore import SQLiteRuleStore
+from m365digester.Synthetic import generate_endpoint_set
+
+
+def get_patterns(rule_list: dict, count: int, seed: int = 365) -> list:
+    """
+    Exclusion patterns made from the rules: parent domains as suffixes, /16 networks around IPv4 rules, and exact rules
+    """
+    rnd = random.Random(seed)
+    domains = [acl_address for list_name, acl_addresses in rule_list.items() if not list_name.lower().endswith('-ip')
+               for acl_address in acl_addresses]
+    networks = [acl_address for list_name, acl_addresses in rule_list.items() if list_name.lower().endswith('-ip')
+                for acl_address in acl_addresses if ':' not in acl_address]
+    patterns = list()
+    for index in range(count):
+        kind = index % 3
+        if kind == 0 and domains:
+            labels = rnd.choice(domains).lstrip('.').split('.')
+            patterns.append('.' + '.'.join(labels[-3:] if len(labels) > 3 else labels[-2:]))
+        elif kind == 1 and networks:
+            octets = rnd.choice(networks).split('/')[0].split('.')
+            patterns.append(f"{octets[0]}.{octets[1]}.0.0/16")
+        elif domains:
+            patterns.append(rnd.choice(domains))
+    return patterns
+
+
+def open_store(file_path: str, rule_list: dict) -> SQLiteRuleStore:
+    store = SQLiteRuleStore({'sqlitedb_file_path': file_path, 'sqlitedb_context': SQLiteContext.FILE})
+    store.open()
+    store.add_acls([(acl_address, list_name) for list_name, acl_addresses in rule_list.items()
+                    for acl_address in acl_addresses])
+    return store
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [2000, 10000]
+    temp_dir = tempfile.mkdtemp()
+    print(f"{'entries':>10} {'rules':>8} {'patterns':>9} {'excluded':>9} {'one at a time s':>16} {'one pass s':>11} "
+          f"{'no hits':>8}")
+    for size in sizes:
+        file_path = os.path.join(temp_dir, f"endpoints-{size}.json")
+        with open(file_path, 'w') as file_handle:
+            json.dump(generate_endpoint_set(size), file_handle)
+        rule_list = digest(file_path)
+        patterns = get_patterns(rule_list, 30)
+        exclusion_matcher = ExclusionMatcher.compile(patterns)
+
+        store = open_store(os.path.join(temp_dir, f"one-pass-{size}.db"), rule_list)
+        started = time.perf_counter()
+        hits = dict.fromkeys(exclusion_matcher.patterns, 0)
+        excluded = list()
+        for acl_address, list_name in store.get_acls():
+            matched = exclusion_matcher.match(acl_address)
+            if matched:
+                excluded.append(acl_address)
+                for pattern in matched:
+                    hits[pattern] += 1
+        store.remove_acls(excluded)
+        one_pass_seconds = time.perf_counter() - started
+        one_pass_rules = sorted(store.get_acls())
+        store.close()
+
+        store = open_store(os.path.join(temp_dir, f"one-at-a-time-{size}.db"), rule_list)
+        started = time.perf_counter()
+        for acl_address in excluded:
+            store.remove_acls([acl_address])
+        one_at_a_time_seconds = time.perf_counter() - started
+        if sorted(store.get_acls()) != one_pass_rules:
+            raise Exception('Exclusion in one pass leaves different rules')
+        store.close()
+
+        print(f"{size:>10} {sum(map(len, rule_list.values())):>8} {len(patterns):>9} {len(excluded):>9} "
+              f"{one_at_a_time_seconds:>16.3f} {one_pass_seconds:>11.3f} "
+              f"{sum(1 for hit_count in hits.values() if not hit_count):>8}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
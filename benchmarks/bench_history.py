@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Snapshot history of a persistent rule database over many endpoint versions, each changing a few rules: time to record
+# each snapshot, rows stored against copying every version in full, and time to diff versions far apart and close
+# together. Diffs are checked against the rule sets of the versions compared
+import os
+import random
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from m365digester.Lib import SQLiteContext
+from m365digester.RuleStores.SQLiteRuleStore import SQLiteRuleStore
+
+list_names = ['m365-exchange-dom', 'm365-exchange-ip', 'm365-sharepoint-dom', 'm365-skype-dom', 'm365-common-dom']
+
+
+def main():
+    parser = ArgumentParser(description='Snapshot history recording and diffs over many versions')
+    parser.add_argument('-n', '--rules', type=int, default=20000, help='Rules in each version')
+    parser.add_argument('-V', '--versions', type=int, default=240,
+                        help='Versions recorded, ie: 20 years of monthly versions')
+    parser.add_argument('-c', '--churn', type=float, default=0.01, help='Fraction of rules replaced per version')
+    parser.add_argument('-d', '--diffs', type=int, default=50, help='Random version pairs diffed')
+    args = parser.parse_args()
+
+    random.seed(1)
+    db_file_path = os.path.join(tempfile.mkdtemp(), 'history.db')
+    store = SQLiteRuleStore({'sqlitedb_file_path': db_file_path, 'sqlitedb_context': SQLiteContext.FILE,
+                             'keep_sqlitedb': True})
+    store.open()
+
+    next_rule = 0
+    rules = set()
+    while len(rules) < args.rules:
+        rules.add((f"host{next_rule}.example{next_rule % 97}.com", random.choice(list_names)))
+        next_rule += 1
+    # Every version's rule set would hold rules x versions tuples, keep a sample to check diffs against
+    kept_versions = set(random.sample(range(args.versions), min(args.versions, 100))) | {0, args.versions - 1}
+    version_rules = dict()
+    changed = max(1, int(args.rules * args.churn))
+    save_seconds = 0.0
+    for version_index in range(args.versions):
+        if version_index:
+            removed = random.sample(sorted(rules), changed)
+            rules.difference_update(removed)
+            # Some removed rules come back in a later version, the rest are new
+            returning = [rule for rule in removed if random.random() < 0.2]
+            while len(rules) < args.rules - len(returning):
+                rules.add((f"host{next_rule}.example{next_rule % 97}.com", random.choice(list_names)))
+                next_rule += 1
+            rules.update(returning)
+        store.clear(commit=False)
+        store.add_acls(sorted(rules), commit=False)
+        version = f"{2021010100 + version_index:010d}"
+        started = time.perf_counter()
+        store.save_snapshot(version)
+        save_seconds += time.perf_counter() - started
+        if version_index in kept_versions:
+            version_rules[version] = set(rules)
+
+    c = store.db_cursor()
+    c.execute("SELECT COUNT(*) FROM snapshot_rules;")
+    rule_rows = c.fetchone()[0]
+    c.execute("SELECT COUNT(*) FROM snapshot_spans;")
+    span_rows = c.fetchone()[0]
+    c.close()
+    full_rows = sum(rule_count for version, recorded, rule_count in store.get_snapshots())
+    print(f"{args.versions} versions of {args.rules} rules, {changed} replaced per version")
+    print(f"{'record':>14}: {save_seconds / args.versions * 1000:8.2f}ms per snapshot")
+    print(f"{'rows stored':>14}: {rule_rows + span_rows:>10,} ({rule_rows:,} rules, {span_rows:,} spans), "
+          f"{full_rows:,} as full copies, db {os.path.getsize(db_file_path) / 1024 / 1024:.1f}MiB")
+
+    versions = sorted(version_rules)
+    pairs = [(versions[0], versions[-1]), (versions[-2], versions[-1]), (versions[-1], versions[0])]
+    pairs.extend(tuple(random.sample(versions, 2)) for _ in range(args.diffs))
+    slowest = 0.0
+    total = 0.0
+    for from_version, to_version in pairs:
+        started = time.perf_counter()
+        added, removed = store.get_snapshot_diff(from_version, to_version)
+        elapsed = time.perf_counter() - started
+        slowest = max(slowest, elapsed)
+        total += elapsed
+        if set(added) != version_rules[to_version] - version_rules[from_version] or \
+                set(removed) != version_rules[from_version] - version_rules[to_version]:
+            raise Exception(f"Diff of {from_version} -> {to_version} differs from the rule sets")
+    for from_version, to_version in pairs[:2]:
+        started = time.perf_counter()
+        added, removed = store.get_snapshot_diff(from_version, to_version)
+        print(f"{from_version} -> {to_version}: {len(added):>6} added {len(removed):>6} removed "
+              f"{(time.perf_counter() - started) * 1000:8.2f}ms")
+    print(f"{'diffs':>14}: {len(pairs)} checked, mean {total / len(pairs) * 1000:.2f}ms, "
+          f"slowest {slowest * 1000:.2f}ms")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
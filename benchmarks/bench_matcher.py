@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Lookups per second of a compiled RuleMatcher against a naive scan of the rule list, on a digested synthetic set
+import ipaddress
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from m365digester.Lib import Defaults
+from m365digester.M365Digester import M365Digester
+from m365digester.RuleMatcher import RuleMatcher
+from m365digester.Synthetic import generate_endpoint_set
+
+naive_sample_size = 500
+
+
+def digest(file_path: str) -> dict:
+    app = M365Digester({'endpoint_file_paths': [file_path],
+                        'categories_filter_include': Defaults.categories_filter_include_choices})
+    if app.main():
+        raise Exception('Digest failed')
+    return app.rule_list
+
+
+def get_queries(rule_list: dict, count: int, seed: int = 365) -> list:
+    """
+    Host names and addresses to look up: names in and below domain rules, addresses at the edges of each network, and
+    as many again that miss
+    """
+    rnd = random.Random(seed)
+    rules = [acl_address for acl_addresses in rule_list.values() for acl_address in acl_addresses]
+    queries = list()
+    while len(queries) < count:
+        acl_address = rnd.choice(rules)
+        network = RuleMatcher.parse_network(acl_address)
+        if network is not None:
+            offset = rnd.randrange(network.num_addresses) if network.num_addresses > 1 else 0
+            queries.append(str(network.network_address + offset))
+            queries.append(str(ipaddress.ip_address((int(network.broadcast_address) + 1) % (2 ** network.max_prefixlen)
+                                                    if network.version == 4 else int(network.broadcast_address) + 1)))
+        else:
+            domain = acl_address.lstrip('.')
+            queries.append(f"host{rnd.randrange(1000)}.{domain}" if acl_address.startswith('.') else domain)
+            queries.append(f"miss{rnd.randrange(1000)}.{domain.split('.', 1)[-1]}x")
+    rnd.shuffle(queries)
+    return queries[:count]
+
+
+def naive_match(rule_list: dict, host_or_ip: str) -> tuple:
+    """
+    Check every rule in turn, as consumers of the plain rule list do
+    """
+    try:
+        address = ipaddress.ip_address(host_or_ip)
+    except ValueError:
+        address = None
+    matched = list()
+    for list_name, acl_addresses in rule_list.items():
+        for acl_address in acl_addresses:
+            if address is not None:
+                network = RuleMatcher.parse_network(acl_address)
+                if network is not None and network.version == address.version and address in network:
+                    matched.append(list_name)
+            elif acl_address.startswith('.'):
+                if host_or_ip == acl_address[1:] or host_or_ip.endswith(acl_address):
+                    matched.append(list_name)
+            elif host_or_ip == acl_address:
+                matched.append(list_name)
+    return tuple(dict.fromkeys(matched))
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000]
+    lookups = 1000000
+    temp_dir = tempfile.mkdtemp()
+    print(f"{'entries':>10} {'rules':>8} {'compile s':>10} {'load s':>8} {'index KiB':>10} "
+          f"{'lookups/s':>11} {'naive/s':>9} {'speedup':>9}")
+    for size in sizes:
+        file_path = os.path.join(temp_dir, f"endpoints-{size}.json")
+        with open(file_path, 'w') as file_handle:
+            json.dump(generate_endpoint_set(size), file_handle)
+        rule_list = digest(file_path)
+
+        started = time.perf_counter()
+        matcher = RuleMatcher.compile(rule_list)
+        compile_seconds = time.perf_counter() - started
+
+        index_file_path = os.path.join(temp_dir, f"matcher-{size}.json")
+        matcher.save(index_file_path)
+        started = time.perf_counter()
+        matcher = RuleMatcher.load(index_file_path)
+        load_seconds = time.perf_counter() - started
+
+        queries = get_queries(rule_list, lookups)
+        match = matcher.match
+        started = time.perf_counter()
+        hits = sum(1 for query in queries if match(query))
+        lookups_per_second = len(queries) / (time.perf_counter() - started)
+
+        sample = queries[:naive_sample_size]
+        started = time.perf_counter()
+        naive_results = [naive_match(rule_list, query) for query in sample]
+        naive_per_second = len(sample) / (time.perf_counter() - started)
+        mismatches = sum(1 for query, naive_result in zip(sample, naive_results)
+                         if set(matcher.match(query)) != set(naive_result))
+        if mismatches:
+            raise Exception(f"{mismatches} of {len(sample)} lookups differ from the naive scan")
+
+        print(f"{size:>10} {len(matcher):>8} {compile_seconds:>10.3f} {load_seconds:>8.3f} "
+              f"{os.path.getsize(index_file_path) / 1024:>10.0f} {lookups_per_second:>11,.0f} "
+              f"{naive_per_second:>9,.0f} {lookups_per_second / naive_per_second:>8,.0f}x  "
+              f"({hits / len(queries):.0%} hits)", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Compare the streaming output plugins against building each file in memory, as the plugins used to
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from string import Template
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from m365digester.Lib import Defaults
+from m365digester.Outputs.GeneralCSV import GeneralCSV
+from m365digester.Outputs.PuppetSquid import PuppetSquid
+from m365digester.Outputs.SquidConfig import SquidConfig
+
+template_file_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                  'examples', 'squidconfig.template')
+
+
+def generate_rule_list(acl_count: int) -> dict:
+    """
+    Generate a rule list of 'acl_count' destinations, split between a domain list and an ip list
+    """
+    domain_count = acl_count * 3 // 4
+    return {
+        'M365-API-Source-domain': [f".host{n}.tenant{n % 997}.example.com" for n in range(domain_count)],
+        'M365-API-Source-ip': [f"10.{(n >> 8) % 256}.{n % 256}.0/24" for n in range(acl_count - domain_count)],
+    }
+
+
+def squid_config_in_memory(rule_list: dict, target_file_path: str):
+    """
+    Previous SquidConfig rendering: ACL lines concatenated into one string, then substituted into the template
+    """
+    linesep = Defaults.linesep.chars()
+    acl_set = ''
+    rule_allow = ''
+    for acl_list_name in rule_list:
+        if len(rule_list[acl_list_name]) > 0:
+            rule_allow += f"http_access allow {Defaults.squid_src_acl_name} {acl_list_name}{linesep}"
+    for acl_list_name in rule_list:
+        for destination in rule_list[acl_list_name]:
+            acl_scope = 'dstdomain' if 'domain' in acl_list_name.lower() else 'dst'
+            acl_set += f"acl {acl_list_name} {acl_scope} {destination}{linesep}"
+    with open(template_file_path) as template_file_handle:
+        template = Template(template_file_handle.read())
+    with open(target_file_path, mode='w') as target_file_handle:
+        target_file_handle.write(template.substitute({'acl_set': acl_set, 'rule_allow': rule_allow}))
+
+
+def general_csv_print(rule_list: dict, target_file_path: str):
+    """
+    Previous GeneralCSV rendering: one print() call per line
+    """
+    with open(target_file_path, mode='w') as target_file_handle:
+        print(f"\"ACL_LIST_NAME\",\"DESTINATION\",\"ACL_TYPE\",\"COMMENT\"", file=target_file_handle)
+        for service_area_name in rule_list:
+            if 'domain' in service_area_name:
+                acl_type = 'domain'
+                acl_comment = f"M365 (Teams or OneDrive) destination domains ({service_area_name})"
+            else:
+                acl_type = 'ip'
+                acl_comment = f"M365 (Teams or OneDrive) destination ip addresses ({service_area_name})"
+            for acl_destination in rule_list[service_area_name]:
+                print(f"\"{service_area_name}\",\"{acl_destination}\",\"{acl_type}\",\"{acl_comment}\"",
+                      file=target_file_handle)
+
+
+def plugin_runner(plugin_class):
+    def run(rule_list: dict, target_file_path: str):
+        plugin = plugin_class({'output_template': template_file_path})
+        plugin.set_input(rule_list)
+        plugin.set_target_file_path(target_file_path)
+        plugin.run()
+    return run
+
+
+def measure(function, *args) -> (float, int):
+    tracemalloc.start()
+    started = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [100000, 1000000]
+    temp_dir = tempfile.mkdtemp()
+    writers = (
+        ('squidconfig-in-memory', squid_config_in_memory),
+        ('squidconfig-stream', plugin_runner(SquidConfig)),
+        ('generalcsv-print', general_csv_print),
+        ('generalcsv-stream', plugin_runner(GeneralCSV)),
+        ('puppetsquid-stream', plugin_runner(PuppetSquid)),
+    )
+    print(f"{'acls':>10} {'writer':>22} {'seconds':>9} {'peak MiB':>9} {'file MiB':>9}")
+    for size in sizes:
+        rule_list = generate_rule_list(size)
+        outputs = dict()
+        for name, writer in writers:
+            target_file_path = os.path.join(temp_dir, name)
+            elapsed, peak = measure(writer, rule_list, target_file_path)
+            with open(target_file_path, 'rb') as target_file_handle:
+                outputs[name] = target_file_handle.read()
+            print(f"{size:>10} {name:>22} {elapsed:>9.3f} {peak / 1048576:>9.2f} "
+                  f"{len(outputs[name]) / 1048576:>9.1f}")
+            os.remove(target_file_path)
+        if outputs['squidconfig-in-memory'] != outputs['squidconfig-stream']:
+            raise Exception(f"Squid config outputs differ for {size} acls")
+        if outputs['generalcsv-print'] != outputs['generalcsv-stream']:
+            raise Exception(f"General CSV outputs differ for {size} acls")
+
+
+if __name__ == "__main__":
+    main()
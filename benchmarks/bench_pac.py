@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Evaluate the PAC file from the 'pac' output plugin against the naive form (one dnsDomainIs/isInNet test per rule) in
+# node, checking both route every host the same way as RuleMatcher, and compare evaluation time per request
+import ipaddress
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from bench_matcher import digest, get_queries
+from m365digester.Outputs.PacFile import PacFile
+from m365digester.RuleMatcher import RuleMatcher
+from m365digester.Synthetic import generate_endpoint_set
+
+match_route = 'DIRECT'
+default_route = 'PROXY proxy.example.com:3128'
+
+# Runs each PAC file in its own context with the PAC helper functions a browser provides, for literal addresses only
+harness = r"""
+const fs = require('fs');
+const net = require('net');
+const vm = require('vm');
+const [pacFilePath, queriesFilePath, rounds] = process.argv.slice(1);
+const queries = JSON.parse(fs.readFileSync(queriesFilePath, 'utf8'));
+
+function ipv4ToInt(s) {
+    const parts = s.split('.');
+    if (parts.length != 4) return null;
+    let n = 0;
+    for (const part of parts) {
+        if (!/^[0-9]{1,3}$/.test(part) || +part > 255) return null;
+        n = n * 256 + +part;
+    }
+    return n;
+}
+const blockLists = new Map();
+const sandbox = {
+    dnsDomainIs: (host, domain) => host.length >= domain.length && host.substring(host.length - domain.length) == domain,
+    isInNet: (host, pattern, mask) => {
+        const h = ipv4ToInt(host);
+        if (h === null) return false;
+        const m = ipv4ToInt(mask);
+        return ((h & m) >>> 0) == ((ipv4ToInt(pattern) & m) >>> 0);
+    },
+    isInNetEx: (host, prefix) => {
+        if (!net.isIPv6(host)) return false;
+        let blockList = blockLists.get(prefix);
+        if (!blockList) {
+            const [address, length] = prefix.split('/');
+            blockList = new net.BlockList();
+            blockList.addSubnet(address, +length, 'ipv6');
+            blockLists.set(prefix, blockList);
+        }
+        return blockList.check(host, 'ipv6');
+    },
+    dnsResolve: (host) => null,
+};
+vm.createContext(sandbox);
+vm.runInContext(fs.readFileSync(pacFilePath, 'utf8'), sandbox);
+const findProxyForURL = sandbox.FindProxyForURL;
+const results = queries.map((host) => findProxyForURL('https://' + host + '/', host));
+const started = process.hrtime.bigint();
+for (let round = 0; round < +rounds; round++) {
+    for (const host of queries) findProxyForURL('https://' + host + '/', host);
+}
+const seconds = Number(process.hrtime.bigint() - started) / 1e9;
+console.log(JSON.stringify({seconds: seconds, evaluations: queries.length * +rounds, results: results}));
+"""
+
+
+def render_naive_pac(rule_list: dict) -> str:
+    """
+    The usual hand written form: one test per rule, in order
+    """
+    lines = ['function FindProxyForURL(url, host) {', '    host = host.toLowerCase();']
+    for acl_addresses in rule_list.values():
+        for acl_address in acl_addresses:
+            network = RuleMatcher.parse_network(acl_address)
+            if network is None:
+                domain = acl_address.lower()
+                if domain.startswith('.'):
+                    test = f"host == {json.dumps(domain[1:])} || dnsDomainIs(host, {json.dumps(domain)})"
+                else:
+                    test = f"host == {json.dumps(domain)}"
+            elif network.version == 4:
+                test = f"isInNet(host, \"{network.network_address}\", \"{network.netmask}\")"
+            else:
+                test = f"isInNetEx(host, \"{network}\")"
+            lines.append(f"    if ({test}) return {json.dumps(match_route)};")
+    lines.append(f"    return {json.dumps(default_route)};")
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def evaluate(node: str, pac_file_path: str, queries_file_path: str, rounds: int) -> dict:
+    completed = subprocess.run([node, '-e', harness, pac_file_path, queries_file_path, str(rounds)],
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout)
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 10000]
+    node = shutil.which('node')
+    if not node:
+        print('node not found, skipping PAC evaluation')
+        return
+    query_count = 20000
+    temp_dir = tempfile.mkdtemp()
+    print(f"{'entries':>10} {'rules':>7} {'form':>10} {'KiB':>7} {'us/request':>11} {'requests/s':>11}")
+    for size in sizes:
+        file_path = os.path.join(temp_dir, f"endpoints-{size}.json")
+        with open(file_path, 'w') as file_handle:
+            json.dump(generate_endpoint_set(size), file_handle)
+        rule_list = digest(file_path)
+        rule_count = sum(len(acl_addresses) for acl_addresses in rule_list.values())
+
+        matcher = RuleMatcher.compile(rule_list)
+        queries = [str(ipaddress.ip_address(query)) if RuleMatcher.parse_network(query) else query.lower()
+                   for query in get_queries(rule_list, query_count)]
+        expected = [match_route if matcher.match(query) else default_route for query in queries]
+        queries_file_path = os.path.join(temp_dir, f"queries-{size}.json")
+        with open(queries_file_path, 'w') as file_handle:
+            json.dump(queries, file_handle)
+
+        pac_file_paths = {'optimized': os.path.join(temp_dir, f"optimized-{size}.pac"),
+                          'naive': os.path.join(temp_dir, f"naive-{size}.pac")}
+        output_plugin = PacFile({'pac_match_route': match_route, 'pac_default_route': default_route})
+        output_plugin.set_input(rule_list)
+        output_plugin.set_target_file_path(pac_file_paths['optimized'])
+        output_plugin.run()
+        with open(pac_file_paths['naive'], 'w') as file_handle:
+            file_handle.write(render_naive_pac(rule_list))
+
+        timings = dict()
+        for form, pac_file_path in pac_file_paths.items():
+            # Fewer rounds of the naive form, which is far slower on large rule sets
+            rounds = 20 if form == 'optimized' else max(1, 20000 // rule_count)
+            evaluation = evaluate(node, pac_file_path, queries_file_path, rounds)
+            mismatches = sum(1 for result, expected_result in zip(evaluation['results'], expected)
+                             if result != expected_result)
+            if mismatches:
+                raise Exception(f"{form} PAC routes {mismatches} of {len(queries)} hosts differently to RuleMatcher")
+            timings[form] = evaluation['seconds'] / evaluation['evaluations']
+            print(f"{size:>10} {rule_count:>7} {form:>10} {os.path.getsize(pac_file_path) / 1024:>7.0f} "
+                  f"{timings[form] * 1e6:>11.3f} {1 / timings[form]:>11,.0f}", flush=True)
+        print(f"{'':>10} {'':>7} {'speedup':>10} {timings['naive'] / timings['optimized']:>7,.0f}x")
+
+
+if __name__ == "__main__":
+    main()
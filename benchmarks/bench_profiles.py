@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Several profiles digested and rendered one after another, each fetching its own endpoint set as separate CLI runs
+# do, against the profile runner: one fetch, then the profiles across a process pool. Both must write the same outputs
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from m365digester.Lib import Defaults
+from m365digester.M365Digester import M365Digester
+from m365digester.OutputRunner import OutputRunner
+from m365digester.ProfileRunner import ProfileRunner
+from m365digester.StandIn import StandInServer
+
+# Profile settings cycled through to make up the requested number of profiles
+profile_variants = [
+    {'categories_filter_include': ['Allow']},
+    {'categories_filter_include': ['Allow', 'Default', 'Optimize'], 'collapse_acl_sets': False},
+    {'extra_known_domains': ['*.live.com', 'tenant1.example1.com'], 'exclude_addresses': ['*.tenant2.example2.com']},
+    {'ip_aggregation_enabled': False, 'wildcard_replace_enabled': False},
+]
+
+
+def get_file_hashes(output_path: str) -> dict:
+    file_hashes = dict()
+    for file_name in sorted(os.listdir(output_path)):
+        with open(os.path.join(output_path, file_name), 'rb') as file_handle:
+            file_hashes[file_name] = hashlib.sha256(file_handle.read()).hexdigest()
+    return file_hashes
+
+
+def main():
+    parser = ArgumentParser(description='Separate digests per profile against the profile runner')
+    parser.add_argument('-n', '--entries', type=int, default=20000, help='Synthetic entries per endpoint set')
+    parser.add_argument('-p', '--profiles', type=int, default=8, help='Profiles to digest')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Profile runner processes, default CPUs')
+    parser.add_argument('--latency-ms', type=float, default=200, help='Stand-in web service latency per request')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    profiles = {f"profile{index}": dict(profile_variants[index % len(profile_variants)],
+                                        output_type=['generalcsv', 'squidconfig', 'ruleset'])
+                for index in range(args.profiles)}
+    profile_file_path = os.path.join(temp_dir, 'profiles.json')
+    with open(profile_file_path, 'w') as file_handle:
+        json.dump({'profiles': profiles}, file_handle)
+    template_file_path = os.path.join(os.path.dirname(Defaults.pwd), 'examples', 'squidconfig.template')
+
+    with StandInServer({'standin_generate_entries': args.entries, 'standin_latency_ms': args.latency_ms}) as stand_in:
+        config = {'m365_web_service_url': stand_in.url, 'data_cache_enabled': False,
+                  'output_template': template_file_path}
+
+        separate_path = os.path.join(temp_dir, 'separate')
+        os.mkdir(separate_path)
+        started = time.perf_counter()
+        for profile_name, profile in profiles.items():
+            profile_config = dict(config, output_path=separate_path,
+                                  output_file_prefix=f"{Defaults.output_file_prefix}-{profile_name}", **profile)
+            app = M365Digester(profile_config)
+            if app.main():
+                raise Exception(f"Digest of '{profile_name}' failed")
+            OutputRunner(profile_config).run(app.rule_list, app.metrics, app.api_versions)
+        separate_seconds = time.perf_counter() - started
+
+        profiles_path = os.path.join(temp_dir, 'profiles')
+        os.mkdir(profiles_path)
+        started = time.perf_counter()
+        runner = ProfileRunner(dict(config, output_path=profiles_path, profile_file_path=profile_file_path,
+                                    profile_workers=args.workers))
+        results = runner.run()
+        profile_seconds = time.perf_counter() - started
+
+    if any(result.exit_code or result.error for result in results):
+        raise Exception(f"Profile runner failed: {[result for result in results if result.exit_code or result.error]}")
+    separate_hashes = get_file_hashes(separate_path)
+    if separate_hashes != get_file_hashes(profiles_path):
+        raise Exception('Profile runner outputs differ from the separate digests')
+
+    print(f"{args.profiles} profiles of {args.entries} entries, {len(separate_hashes)} outputs, "
+          f"{runner.get_worker_count(args.profiles)} workers")
+    print(f"{'separate digests':>18}: {separate_seconds:8.3f}s")
+    print(f"{'profile runner':>18}: {profile_seconds:8.3f}s  ({separate_seconds / profile_seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
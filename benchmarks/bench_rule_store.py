@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Compare the rule store backends end to end, from endpoint set to rule list, without the web service
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from m365digester.Lib import Defaults, SQLiteContext
+from m365digester.M365Digester import M365Digester
+from m365digester.Synthetic import generate_endpoint_set
+
+
+class OfflineDigester(M365Digester):
+
+    endpoint_set = list()
+
+    def m365_web_service_get_rule_set(self, method_name, global_instance_name, client_request_id) -> dict:
+        return self.endpoint_set
+
+
+def run(endpoint_set: list, config: dict) -> (float, dict):
+    app = OfflineDigester(config)
+    app.endpoint_set = endpoint_set
+    started = time.perf_counter()
+    if app.main():
+        raise Exception('Digest failed')
+    return time.perf_counter() - started, app.rule_list
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 10000, 100000]
+    temp_dir = tempfile.mkdtemp()
+    print(f"{'entries':>10} {'store':>12} {'seconds':>10} {'rules':>10}")
+    for size in sizes:
+        endpoint_set = generate_endpoint_set(size)
+        configs = {
+            'memory': {'rule_store': 'memory',
+                       'categories_filter_include': Defaults.categories_filter_include_choices},
+            'sqlite': {'rule_store': 'sqlite', 'sqlitedb_file_path': Defaults.sqlitedb_context_memory,
+                       'categories_filter_include': Defaults.categories_filter_include_choices},
+            'sqlite-file': {'rule_store': 'sqlite', 'sqlitedb_context': SQLiteContext.FILE,
+                            'sqlitedb_file_path': os.path.join(temp_dir, f"bench-{size}.db"),
+                            'categories_filter_include': Defaults.categories_filter_include_choices},
+        }
+        results = dict()
+        for name, config in configs.items():
+            elapsed, rule_list = run(endpoint_set, config)
+            results[name] = rule_list
+            print(f"{size:>10} {name:>12} {elapsed:>10.3f} {sum(len(v) for v in rule_list.values()):>10}")
+        if any(rule_list != results['memory'] for rule_list in results.values()):
+            raise Exception(f"Rule stores disagree for {size} entries")
+
+
+if __name__ == "__main__":
+    main()
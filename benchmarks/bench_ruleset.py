@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Time for a consumer to load a digested rule set and answer its first lookup: parsing the general CSV output and
+# compiling a RuleMatcher, loading the matcher index JSON, or opening the binary rule set. Also lookups per second of
+# the binary rule set against the compiled RuleMatcher, checking both agree
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from bench_matcher import digest, get_queries
+from m365digester.Outputs.GeneralCSV import GeneralCSV
+from m365digester.RuleMatcher import RuleMatcher
+from m365digester.RuleSetFile import RuleSetReader, save_rule_set
+from m365digester.Synthetic import generate_endpoint_set
+
+lookups = 200000
+
+
+def load_csv(file_path: str) -> RuleMatcher:
+    rule_list = dict()
+    with open(file_path, newline='') as file_handle:
+        for row in csv.DictReader(file_handle):
+            rule_list.setdefault(row['ACL_LIST_NAME'], list()).append(row['DESTINATION'])
+    return RuleMatcher.compile(rule_list)
+
+
+def time_load(load, file_path: str, query: str) -> float:
+    started = time.perf_counter()
+    loaded = load(file_path)
+    loaded.match(query)
+    return time.perf_counter() - started
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000]
+    temp_dir = tempfile.mkdtemp()
+    print(f"{'entries':>10} {'rules':>8} {'form':>8} {'KiB':>8} {'load+1st ms':>12} {'lookups/s':>11}")
+    for size in sizes:
+        file_path = os.path.join(temp_dir, f"endpoints-{size}.json")
+        with open(file_path, 'w') as file_handle:
+            json.dump(generate_endpoint_set(size), file_handle)
+        rule_list = digest(file_path)
+        queries = get_queries(rule_list, lookups)
+
+        file_paths = {form: os.path.join(temp_dir, f"rules-{size}.{form}") for form in ('csv', 'json', 'bin')}
+        output_plugin = GeneralCSV()
+        output_plugin.set_input(rule_list)
+        output_plugin.set_target_file_path(file_paths['csv'])
+        output_plugin.run()
+        matcher = RuleMatcher.compile(rule_list)
+        matcher.save(file_paths['json'])
+        save_rule_set(file_paths['bin'], rule_list, {'api_version': 'benchmark'})
+
+        loaders = {'csv': load_csv, 'json': RuleMatcher.load, 'bin': RuleSetReader}
+        for form, file_path in file_paths.items():
+            load_seconds = time_load(loaders[form], file_path, queries[0])
+            lookups_per_second = ''
+            if form in ('json', 'bin'):
+                loaded = loaders[form](file_path)
+                match = loaded.match
+                started = time.perf_counter()
+                results = [match(query) for query in queries]
+                lookups_per_second = f"{len(queries) / (time.perf_counter() - started):,.0f}"
+                mismatches = sum(1 for query, result in zip(queries, results) if result != matcher.match(query))
+                if mismatches:
+                    raise Exception(f"{form} answers {mismatches} of {len(queries)} lookups differently")
+            print(f"{size:>10} {len(matcher):>8} {form:>8} {os.path.getsize(file_path) / 1024:>8.0f} "
+                  f"{load_seconds * 1000:>12.3f} {lookups_per_second:>11}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Compare peak memory of loading endpoint sets whole against streaming them one object at a time. Then check that the
+# peak of a whole streaming digest, M365Digester.main(), stays flat while the input grows with endpoint sets the digest
+# filters out, so only the rules kept and not the size of the payload decide its memory. First the streaming parser is
+# fed one byte per read, as a slow HTTP or gzip stream may, splitting multi-byte characters across reads
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from m365digester.JsonStream import iter_json_array, iter_json_array_file
+from m365digester.Lib import Defaults
+from m365digester.M365Digester import M365Digester
+from m365digester.Synthetic import generate_endpoint_set
+
+# Streaming parse only ever holds one endpoint set object and one read chunk, so its peak must stay under this
+# however large the input file is
+parse_peak_limit = 1024 * 1024
+# Growth allowed in the peak of a streaming digest between the smallest and largest padded input
+digest_peak_growth_limit = 1024 * 1024
+# Categories digested in the bounded check. Padding endpoint sets are of another category, so are parsed and dropped
+digest_categories = ('Allow', 'Default')
+
+
+def measure(function) -> (float, int, object):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+class ShortReader(object):
+    """
+    Binary reader returning at most 'read_size' bytes per read, whatever size is asked for
+    """
+
+    def __init__(self, data: bytes, read_size: int = 1):
+        self.__reader = io.BytesIO(data)
+        self.__read_size = read_size
+
+    def read(self, size: int = -1) -> bytes:
+        return self.__reader.read(self.__read_size)
+
+
+def check_short_reads():
+    """
+    Streaming parse of endpoint sets holding multi-byte characters, read one byte at a time, must match a whole parse
+    """
+    endpoint_set = generate_endpoint_set(200)
+    for index, endpoint in enumerate(endpoint_set):
+        endpoint['notes'] = f"Synthétique {index} – 日本 ü 🙂"
+    data = json.dumps(endpoint_set, ensure_ascii=False).encode('utf-8')
+    if list(iter_json_array(ShortReader(data))) != endpoint_set:
+        raise Exception('Streaming parse of one byte reads disagrees with a whole parse')
+    print(f"Streaming parse of {len(data)} bytes read one byte at a time matches a whole parse")
+
+
+def parse_whole(file_path: str) -> int:
+    with open(file_path) as file_handle:
+        return len(json.load(file_handle))
+
+
+def parse_stream(file_path: str) -> int:
+    return sum(1 for _ in iter_json_array_file(file_path))
+
+
+def digest(file_path: str, streaming_enabled: bool,
+           categories: tuple = Defaults.categories_filter_include_choices) -> dict:
+    app = M365Digester({'endpoint_file_paths': [file_path], 'streaming_enabled': streaming_enabled,
+                        'categories_filter_include': categories})
+    if app.main():
+        raise Exception('Digest failed')
+    return app.rule_list
+
+
+def write_padded_endpoint_set(file_path: str, entries: int, padding: int):
+    """
+    Endpoint set of 'entries' entries in the digested categories, followed by 'padding' entries in 'Optimize'
+    """
+    endpoint_set = [endpoint for endpoint in generate_endpoint_set(entries) if endpoint['category'] in digest_categories]
+    if padding:
+        endpoint_set.extend(dict(endpoint, id=len(endpoint_set) + index + 1, category='Optimize')
+                            for index, endpoint in enumerate(generate_endpoint_set(padding, seed=7)))
+    with open(file_path, 'w') as file_handle:
+        json.dump(endpoint_set, file_handle)
+
+
+def check_bounded_digest(temp_dir: str, entries: int, paddings: list):
+    """
+    Peak memory across M365Digester.main() in streaming mode, for inputs growing only in filtered out endpoint sets
+    """
+    print(f"{'padding':>10} {'file MiB':>9} {'mode':>14} {'seconds':>9} {'peak MiB':>9}")
+    stream_peaks = list()
+    for padding in paddings:
+        file_path = os.path.join(temp_dir, f"endpoints-padded-{padding}.json")
+        write_padded_endpoint_set(file_path, entries, padding)
+        file_size = os.path.getsize(file_path) / 1048576
+        results = dict()
+        for mode, streaming_enabled in (('digest-whole', False), ('digest-stream', True)):
+            elapsed, peak, results[mode] = measure(lambda: digest(file_path, streaming_enabled, digest_categories))
+            print(f"{padding:>10} {file_size:>9.1f} {mode:>14} {elapsed:>9.3f} {peak / 1048576:>9.1f}")
+            if streaming_enabled:
+                stream_peaks.append(peak)
+        if results['digest-whole'] != results['digest-stream']:
+            raise Exception(f"Streaming digest disagrees with {padding} padding entries")
+        os.remove(file_path)
+
+    growth = max(stream_peaks) - stream_peaks[0]
+    if growth > digest_peak_growth_limit:
+        raise Exception(f"Streaming digest peak grew {growth} bytes with the input, over the "
+                        f"{digest_peak_growth_limit} byte limit")
+    print(f"Streaming digest peak grew {growth / 1048576:.2f} MiB across inputs, limit "
+          f"{digest_peak_growth_limit / 1048576:.2f} MiB")
+
+
+def main():
+    parser = ArgumentParser(description='Peak memory of whole and streaming endpoint set parsing and digests')
+    parser.add_argument('sizes', type=int, nargs='*', default=[10000, 100000], help='Synthetic entries per input')
+    parser.add_argument('-e', '--entries', type=int, default=10000,
+                        help='Entries digested in the bounded check, before padding')
+    parser.add_argument('-P', '--padding', type=int, nargs='+', default=[0, 50000, 200000],
+                        help='Filtered out entries added to the input in the bounded check')
+    args = parser.parse_args()
+
+    check_short_reads()
+    temp_dir = tempfile.mkdtemp()
+    print(f"{'entries':>10} {'file MiB':>9} {'mode':>14} {'seconds':>9} {'peak MiB':>9}")
+    for size in args.sizes:
+        file_path = os.path.join(temp_dir, f"endpoints-{size}.json")
+        with open(file_path, 'w') as file_handle:
+            json.dump(generate_endpoint_set(size), file_handle)
+        file_size = os.path.getsize(file_path) / 1048576
+
+        results = dict()
+        for mode, function in (('parse-whole', lambda: parse_whole(file_path)),
+                               ('parse-stream', lambda: parse_stream(file_path)),
+                               ('digest-whole', lambda: digest(file_path, False)),
+                               ('digest-stream', lambda: digest(file_path, True))):
+            elapsed, peak, results[mode] = measure(function)
+            print(f"{size:>10} {file_size:>9.1f} {mode:>14} {elapsed:>9.3f} {peak / 1048576:>9.1f}")
+            if mode == 'parse-stream' and peak > parse_peak_limit:
+                raise Exception(f"Streaming parse peak {peak} bytes is over the {parse_peak_limit} byte limit")
+
+        if results['parse-whole'] != results['parse-stream']:
+            raise Exception(f"Parsers disagree for {size} entries")
+        if results['digest-whole'] != results['digest-stream']:
+            raise Exception(f"Streaming digest disagrees for {size} entries")
+        os.remove(file_path)
+
+    check_bounded_digest(temp_dir, args.entries, args.padding)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Compare two benchmark suite result files, phase by phase
+import json
+import sys
+
+
+def load_runs(results_file_path: str) -> dict:
+    with open(results_file_path) as results_file_handle:
+        results = json.load(results_file_handle)
+    return {(run['entries'], run['store']): run for run in results['runs']}
+
+
+def get_timings(run: dict) -> dict:
+    timings = {'digest': run['digest_seconds']}
+    timings.update(run['phases'])
+    timings.update({f"output:{name}": output['seconds'] for name, output in run['outputs'].items()})
+    return timings
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} BASELINE.json CANDIDATE.json")
+        exit(1)
+    baseline_runs = load_runs(sys.argv[1])
+    candidate_runs = load_runs(sys.argv[2])
+    print(f"{'entries':>8} {'store':>11} {'timing':>20} {'baseline':>10} {'candidate':>10} {'ratio':>7}")
+    for key in sorted(set(baseline_runs) & set(candidate_runs)):
+        baseline_timings = get_timings(baseline_runs[key])
+        candidate_timings = get_timings(candidate_runs[key])
+        for name in baseline_timings:
+            if name not in candidate_timings:
+                continue
+            baseline_seconds = baseline_timings[name]
+            candidate_seconds = candidate_timings[name]
+            ratio = candidate_seconds / baseline_seconds if baseline_seconds else float('nan')
+            print(f"{key[0]:>8} {key[1]:>11} {name:>20} {baseline_seconds:>10.3f} {candidate_seconds:>10.3f} "
+                  f"{ratio:>7.2f}")
+        if baseline_runs[key]['rules'] != candidate_runs[key]['rules']:
+            print(f"{key[0]:>8} {key[1]:>11} rule count changed: {baseline_runs[key]['rules']} -> "
+                  f"{candidate_runs[key]['rules']}")
+
+
+if __name__ == "__main__":
+    main()
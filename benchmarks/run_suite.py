@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Offline benchmark suite: digest synthetic endpoint sets served by a local stand-in web service, recording the metrics
+# of each phase of M365Digester.main and timing each output plugin, and write the results as JSON for comparison
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from m365digester import APP_VERSION
+from m365digester.Lib import Defaults, SQLiteContext
+from m365digester.M365Digester import M365Digester
+from m365digester.OutputRunner import OutputRunner
+from m365digester.StandIn import StandInServer
+from m365digester.Synthetic import default_mix, parse_mix
+
+repo_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def get_store_config(store_name: str, temp_dir: str, size: int) -> dict:
+    if store_name == 'sqlite':
+        return {'rule_store': 'sqlite', 'sqlitedb_file_path': Defaults.sqlitedb_context_memory}
+    if store_name == 'sqlite-file':
+        return {'rule_store': 'sqlite', 'sqlitedb_context': SQLiteContext.FILE,
+                'sqlitedb_file_path': os.path.join(temp_dir, f"bench-{size}.db")}
+    return {'rule_store': 'memory'}
+
+
+def run_case(size: int, store_name: str, url: str, temp_dir: str, output_types: list, template: str) -> dict:
+    config = {'m365_web_service_url': url, 'data_cache_enabled': False,
+              'categories_filter_include': Defaults.categories_filter_include_choices,
+              'extra_known_domains': ['*.live.com', 'tenant1.example1.com'],
+              'extra_known_ips': ['192.0.2.0/24'],
+              'exclude_addresses': ['*.tenant2.example2.com', 'host3.site3.example3.net']}
+    config.update(get_store_config(store_name, temp_dir, size))
+    app = M365Digester(config)
+    started = time.perf_counter()
+    if app.main():
+        raise Exception(f"Digest of {size} entries with '{store_name}' store failed")
+    digest_seconds = time.perf_counter() - started
+
+    outputs = dict()
+    output_runner = OutputRunner({'output_template': template})
+    for output_type in output_types:
+        target_file_path = os.path.join(temp_dir, f"bench-{size}-{store_name}.{output_type}")
+        result = output_runner.run_output(output_type, target_file_path, template, app.rule_list)
+        if not result.success:
+            raise Exception(f"Output '{output_type}' failed: {result.error}")
+        outputs[output_type] = {'seconds': round(result.elapsed, 6), 'bytes': os.path.getsize(target_file_path)}
+        os.remove(target_file_path)
+
+    return {
+        'entries': size,
+        'store': store_name,
+        'rules': sum(len(addresses) for addresses in app.rule_list.values()),
+        'digest_seconds': round(digest_seconds, 6),
+        'phases': {name: round(phase.seconds, 6) for name, phase in app.metrics.phases.items()},
+        'phase_rows': {name: phase.rows for name, phase in app.metrics.phases.items()},
+        'phase_peak_memory_bytes': {name: phase.peak_memory_bytes for name, phase in app.metrics.phases.items()},
+        'outputs': outputs,
+    }
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = ArgumentParser(description='Offline benchmark suite for M365Digester')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Synthetic entry counts, ie: 1000 10000 100000 1000000')
+    parser.add_argument('-r', '--stores', nargs='+', default=['memory', 'sqlite'],
+                        choices=['memory', 'sqlite', 'sqlite-file'])
+    parser.add_argument('-t', '--output-types', nargs='+', default=Defaults.output_types_available,
+                        choices=Defaults.output_types_available)
+    parser.add_argument('-m', '--mix', default='',
+                        help=f"Address mix overrides as 'kind=share,...', kinds: {', '.join(default_mix)}")
+    parser.add_argument('--seed', type=int, default=365)
+    parser.add_argument('-o', '--output', default='benchmark-results.json', help='Results file (JSON)')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    template = os.path.join(repo_path, 'examples', 'squidconfig.template')
+    temp_dir = tempfile.mkdtemp()
+    results = {
+        'app_version': APP_VERSION,
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'seed': args.seed,
+        'mix': mix,
+        'runs': list(),
+    }
+
+    for size in args.sizes:
+        with StandInServer({'standin_generate_entries': size, 'standin_seed': args.seed, 'standin_mix': args.mix}) \
+                as stand_in:
+            url = stand_in.url
+            for store_name in args.stores:
+                run = run_case(size, store_name, url, temp_dir, args.output_types, template)
+                results['runs'].append(run)
+                phases = ' '.join(f"{name}={seconds:.3f}" for name, seconds in run['phases'].items())
+                outputs = ' '.join(f"{name}={output['seconds']:.3f}" for name, output in run['outputs'].items())
+                print(f"{size:>8} {store_name:>11} rules={run['rules']:<8} digest={run['digest_seconds']:.3f} "
+                      f"{phases} | {outputs}", flush=True)
+
+    with open(args.output, 'w') as results_file_handle:
+        json.dump(results, results_file_handle, indent=2)
+    print(f"Results written to '{args.output}'")
+
+
+if __name__ == "__main__":
+    main()
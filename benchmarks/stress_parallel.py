@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Part of m365-endpoint-api-digester
+# Stress test for embedded use: run many digests with different configs concurrently from a thread pool, against a
+# local stand-in web service, and check each result matches the same config digested on its own
+import os
+import random
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from m365digester.HttpClient import HttpClient
+from m365digester.Lib import Defaults
+from m365digester.M365Digester import M365Digester
+from m365digester.StandIn import StandInServer
+
+# Config variants, each producing a different rule list from the same endpoint sets
+variants = {
+    'default': {},
+    'all-categories': {'categories_filter_include': Defaults.categories_filter_include_choices},
+    'no-collapse': {'collapse_acl_sets': False},
+    'no-wildcards': {'wildcard_replace_enabled': False},
+    'no-aggregation': {'ip_aggregation_enabled': False},
+    'domains-only': {'address_filter_ipv4_enabled': False, 'address_filter_ipv6_enabled': False},
+    'extras': {'extra_known_domains': ['*.live.com', 'tenant1.example1.com'], 'extra_known_ips': ['192.0.2.0/24'],
+               'exclude_addresses': ['*.tenant2.example2.com', 'host3.site3.example3.net']},
+    'multi-instance': {'m365_service_instance_name': ['Worldwide', 'Germany', 'China']},
+    'sqlite': {'rule_store': 'sqlite', 'sqlitedb_file_path': Defaults.sqlitedb_context_memory},
+    'streaming': {'streaming_enabled': True},
+    'cached': {'data_cache_enabled': True},
+}
+
+
+def get_config(variant_name: str, url: str, cache_path: str) -> dict:
+    config = {'m365_web_service_url': url, 'data_cache_enabled': False, 'data_cache_path': cache_path,
+              'categories_filter_include': Defaults.categories_filter_include}
+    config.update(variants[variant_name])
+    return config
+
+
+def main():
+    parser = ArgumentParser(description='Run M365Digester digests concurrently and check each result')
+    parser.add_argument('-n', '--entries', type=int, default=5000, help='Synthetic entries per endpoint set')
+    parser.add_argument('-d', '--digests', type=int, default=200, help='Digests to run concurrently in total')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='Thread pool size')
+    parser.add_argument('--seed', type=int, default=365)
+    parser.add_argument('--shared-client', action='store_true',
+                        help='Share one HTTP client between every digest, rather than one each')
+    args = parser.parse_args()
+
+    cache_path = tempfile.mkdtemp()
+    rnd = random.Random(args.seed)
+    with StandInServer({'standin_generate_entries': args.entries, 'standin_seed': args.seed}) as stand_in:
+        http_client = HttpClient({'http_pool_size': args.workers}) if args.shared_client else None
+
+        def run(variant_name: str):
+            app = M365Digester(get_config(variant_name, stand_in.url, cache_path))
+            if http_client:
+                app.http_client = http_client
+            return variant_name, app.digest()
+
+        # Each variant on its own first, for the expected results
+        expected = dict()
+        for variant_name in variants:
+            variant_name, result = run(variant_name)
+            if not result.success:
+                raise Exception(f"Digest of variant '{variant_name}' failed on its own")
+            expected[variant_name] = result
+            print(f"{variant_name:>15} rules={result.rule_count:<7} {result.total_seconds:.3f}s", flush=True)
+
+        jobs = [rnd.choice(list(variants)) for _ in range(args.digests)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(run, jobs))
+        elapsed = time.perf_counter() - started
+
+    failures = 0
+    for variant_name, result in results:
+        expected_result = expected[variant_name]
+        problems = list()
+        if not result.success:
+            problems.append(f"exit code {result.exit_code}")
+        if dict(result.rule_list) != dict(expected_result.rule_list):
+            problems.append('rule list differs')
+        if dict(result.rule_origins) != dict(expected_result.rule_origins):
+            problems.append('rule origins differ')
+        for counter_name in ('rules', 'wildcard_adjustments', 'domain_subset_duplicates', 'excluded_addresses',
+                             'ip_prefixes_aggregated', 'warnings', 'errors'):
+            if result.counters.get(counter_name) != expected_result.counters.get(counter_name):
+                problems.append(f"counter '{counter_name}' is {result.counters.get(counter_name)}, "
+                                f"expected {expected_result.counters.get(counter_name)}")
+        if problems:
+            failures += 1
+            print(f"{variant_name}: {', '.join(problems)}")
+
+    print(f"{len(results)} digests on {args.workers} threads in {elapsed:.3f}s, {failures} mismatched")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
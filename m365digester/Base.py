@@ -5,14 +5,14 @@ class Base(object):
     warning_count = 0
     error_count = 0
     logger = None
-    config = dict()
+    config = None
 
     def __init__(self, config: dict = None, logger=None):
         self.logger = logger
-        if not config:
-            self.config = dict()
-        else:
-            self.config = config
+        self.warning_count = 0
+        self.error_count = 0
+        # Each object keeps its own copy, so defaults one sets (ie: a rule store's file path) never leak into another
+        self.config = dict(config) if config else dict()
 
     def info(self, message: str):
         if not self.logger:
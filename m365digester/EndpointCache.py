@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from .Base import Base
+from .JsonStream import iter_json_array_file
+from .Lib import Defaults
+
+
+class EndpointCache(Base):
+    """
+    On disk cache of endpoint sets from the M365 web service, one directory per instance and clientRequestId, holding
+    one file per endpoint version
+    """
+
+    __version_file_name = 'version.json'
+    __responses_dir_name = 'responses'
+
+    def get_cache_path(self, instance_name: str, client_request_id: str) -> str:
+        """
+        Cache directory of an instance and clientRequestId, ie: 'Worldwide-GUID-1a2b3c4d'. It ends with a hash of the
+        web service URL, so another service, ie: the stand-in, never reads or overwrites the cache of the live one
+        """
+        data_cache_path = self.config.get('data_cache_path', Defaults.data_cache_path)
+        web_service_url = self.config.get('m365_web_service_url', None) or Defaults.m365_web_service_url
+        url_hash = hashlib.sha256(web_service_url.rstrip('/').encode('utf-8')).hexdigest()[:8]
+        return os.path.join(data_cache_path, f"{instance_name}-{client_request_id}-{url_hash}")
+
+    def get_response_path(self, instance_name: str, client_request_id: str, method_name: str) -> str:
+        """
+        Path to keep the last web service response to 'method_name' at, for conditional requests. Its validators are
+        kept beside it by HttpClient.get()
+        """
+        return os.path.join(self.get_cache_path(instance_name, client_request_id), self.__responses_dir_name,
+                            method_name)
+
+    def get_cached_version(self, instance_name: str, client_request_id: str):
+        """
+        Get the endpoint version last stored for this instance and clientRequestId, or None
+        """
+        version_file_path = os.path.join(self.get_cache_path(instance_name, client_request_id),
+                                         self.__version_file_name)
+        try:
+            with open(version_file_path) as version_file_handle:
+                return json.load(version_file_handle).get('latest', None)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.warning(f"Unable to read cached version file '{version_file_path}'. Error: {e}")
+            return None
+
+    def load(self, instance_name: str, client_request_id: str, version: str):
+        """
+        Get the cached endpoint set for 'version', or None if it isn't cached
+        """
+        if self.get_cached_version(instance_name, client_request_id) != version:
+            return None
+
+        endpoint_file_path = os.path.join(self.get_cache_path(instance_name, client_request_id), f"{version}.json")
+        try:
+            with open(endpoint_file_path) as endpoint_file_handle:
+                endpoint_set = json.load(endpoint_file_handle)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.warning(f"Unable to read cached endpoint set '{endpoint_file_path}'. Error: {e}")
+            return None
+
+        self.info(f"Using cached endpoint set version '{version}' from '{endpoint_file_path}'")
+        return endpoint_set
+
+    def load_stream(self, instance_name: str, client_request_id: str, version: str):
+        """
+        Get an iterator over the cached endpoint set objects for 'version', parsed one at a time, or None if it isn't
+        cached
+        """
+        if self.get_cached_version(instance_name, client_request_id) != version:
+            return None
+
+        endpoint_file_path = os.path.join(self.get_cache_path(instance_name, client_request_id), f"{version}.json")
+        if not os.path.isfile(endpoint_file_path):
+            return None
+
+        self.info(f"Streaming cached endpoint set version '{version}' from '{endpoint_file_path}'")
+        return iter_json_array_file(endpoint_file_path)
+
+    def store_stream(self, instance_name: str, client_request_id: str, version: str, source_file_handle):
+        """
+        Copy a raw endpoint set response from 'source_file_handle' into the cache as the latest version, without
+        parsing it, then evict older versions. Returns the cached file path, or None on failure
+        """
+        cache_path = self.get_cache_path(instance_name, client_request_id)
+        endpoint_file_path = os.path.join(cache_path, f"{version}.json")
+        try:
+            os.makedirs(cache_path, exist_ok=True)
+            file_handle, temp_file_path = tempfile.mkstemp(dir=cache_path, suffix='.tmp')
+            try:
+                with os.fdopen(file_handle, mode='wb') as temp_file_handle:
+                    shutil.copyfileobj(source_file_handle, temp_file_handle)
+                os.replace(temp_file_path, endpoint_file_path)
+            except Exception:
+                os.remove(temp_file_path)
+                raise
+            self._write_atomic(os.path.join(cache_path, self.__version_file_name),
+                               {'instance': instance_name, 'latest': version})
+        except Exception as e:
+            self.warning(f"Unable to store endpoint set version '{version}' in cache '{cache_path}'. Error: {e}")
+            return None
+
+        self.debug(f"Cached endpoint set version '{version}' in '{cache_path}'")
+        self.evict(instance_name, client_request_id)
+        return endpoint_file_path
+
+    def store(self, instance_name: str, client_request_id: str, version: str, endpoint_set) -> bool:
+        """
+        Store 'endpoint_set' as the latest version, then evict older versions
+        """
+        cache_path = self.get_cache_path(instance_name, client_request_id)
+        try:
+            os.makedirs(cache_path, exist_ok=True)
+            self._write_atomic(os.path.join(cache_path, f"{version}.json"), endpoint_set)
+            self._write_atomic(os.path.join(cache_path, self.__version_file_name),
+                               {'instance': instance_name, 'latest': version})
+        except Exception as e:
+            self.warning(f"Unable to store endpoint set version '{version}' in cache '{cache_path}'. Error: {e}")
+            return False
+
+        self.debug(f"Cached endpoint set version '{version}' in '{cache_path}'")
+        self.evict(instance_name, client_request_id)
+        return True
+
+    def evict(self, instance_name: str, client_request_id: str):
+        """
+        Remove all but the newest 'data_cache_keep_versions' endpoint sets
+        """
+        keep_versions = int(self.config.get('data_cache_keep_versions', Defaults.data_cache_keep_versions))
+        cache_path = self.get_cache_path(instance_name, client_request_id)
+
+        # Versions are date based strings ie: '2021043000', so sort in age order
+        versions = sorted(file_name[:-len('.json')] for file_name in os.listdir(cache_path)
+                          if file_name.endswith('.json') and file_name != self.__version_file_name)
+        for version in versions[:-keep_versions] if keep_versions > 0 else versions:
+            try:
+                os.remove(os.path.join(cache_path, f"{version}.json"))
+                self.debug(f"Evicted cached endpoint set version '{version}' from '{cache_path}'")
+            except Exception as e:
+                self.warning(f"Unable to evict cached endpoint set version '{version}'. Error: {e}")
+
+    @staticmethod
+    def _write_atomic(file_path: str, data):
+        file_handle, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.tmp')
+        try:
+            with os.fdopen(file_handle, mode='w') as temp_file_handle:
+                json.dump(data, temp_file_handle)
+            os.replace(temp_file_path, file_path)
+        except Exception:
+            os.remove(temp_file_path)
+            raise
@@ -0,0 +1,86 @@
+from .RuleMatcher import RuleMatcher
+
+
+class ExclusionMatcher(object):
+    """
+    Exclusion patterns ('exclude_addresses') compiled once, to test every rule against all of them in a single pass.
+    A pattern is one of:
+
+        an IP address or CIDR network, excluding the IP rules inside it, ie: '52.96.0.0/14' excludes '52.97.1.0/24'
+        a domain with a leading '.' or '*.', excluding it and every rule below it, ie: '.example.com' excludes
+            'example.com', 'a.example.com' and '.a.example.com'
+        anything else, excluding only a rule equal to it
+
+    Rules wider than a pattern, ie: '52.96.0.0/13' or '.com', are kept. Testing a rule costs one dict probe per label
+    of a domain, or one per distinct prefix length of the network patterns
+    """
+
+    def __init__(self):
+        self.patterns = tuple()
+        # Address -> patterns equal to it
+        self._exact = dict()
+        # Domain -> suffix patterns covering it and the names below it
+        self._suffixes = dict()
+        # Family -> prefix length -> network address shifted right by the host bits -> patterns
+        self._networks = {4: dict(), 6: dict()}
+        # Family -> prefix lengths of the network patterns, shortest first
+        self._prefix_lengths = {4: tuple(), 6: tuple()}
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    @staticmethod
+    def normalise_domain(acl_address: str) -> str:
+        return acl_address.strip().lower().rstrip('.')
+
+    @classmethod
+    def compile(cls, patterns):
+        """
+        Compile a list of exclusion patterns into a matcher. Repeated patterns are kept once
+        """
+        if isinstance(patterns, str):
+            patterns = patterns.split()
+        matcher = cls()
+        matcher.patterns = tuple(dict.fromkeys(str(pattern).strip() for pattern in patterns or ()
+                                               if str(pattern).strip()))
+        for pattern in matcher.patterns:
+            network = RuleMatcher.parse_network(pattern)
+            if network is not None:
+                network_key = int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+                matcher._networks[network.version].setdefault(network.prefixlen, dict()).setdefault(
+                    network_key, list()).append(pattern)
+                continue
+            domain = cls.normalise_domain(pattern)
+            if domain.startswith('*.') or domain.startswith('.'):
+                matcher._suffixes.setdefault(domain.lstrip('*').lstrip('.'), list()).append(pattern)
+            else:
+                matcher._exact.setdefault(domain, list()).append(pattern)
+        matcher._prefix_lengths = {family: tuple(sorted(tables)) for family, tables in matcher._networks.items()}
+        return matcher
+
+    def match(self, acl_address: str) -> tuple:
+        """
+        Patterns excluding the rule 'acl_address', or an empty tuple if it is kept
+        """
+        network = RuleMatcher.parse_network(acl_address)
+        if network is not None:
+            matched = list()
+            family = network.version
+            value = int(network.network_address)
+            for prefix_length in self._prefix_lengths[family]:
+                if prefix_length > network.prefixlen:
+                    break
+                patterns = self._networks[family][prefix_length].get(value >> (network.max_prefixlen - prefix_length))
+                if patterns:
+                    matched.extend(patterns)
+            return tuple(matched)
+
+        domain = self.normalise_domain(acl_address)
+        matched = list(self._exact.get(domain, ()))
+        if self._suffixes:
+            labels = domain.lstrip('*').lstrip('.').split('.')
+            for index in range(len(labels)):
+                patterns = self._suffixes.get('.'.join(labels[index:]))
+                if patterns:
+                    matched.extend(patterns)
+        return tuple(matched)
@@ -0,0 +1,116 @@
+"""
+Kernel firewall sets shared by the nftables and ipset outputs: naming the sets, splitting the '-ip' lists into them,
+and publishing the full file with its update script beside it
+"""
+import hashlib
+import ipaddress
+import re
+
+from .Lib import Defaults
+from .OutputWriter import publish_chunks
+from .RuleMatcher import RuleMatcher
+
+# Suffix of the target file path for the update script written beside it
+update_file_suffix = '.update'
+
+
+def get_set_name(list_name: str, family: int, max_length: int = 31) -> str:
+    """
+    Kernel set name for the IPv4 or IPv6 half of a list, ie: 'M365-API-Source-Exchange-ip' ->
+    'm365_api_source_exchange_v4'. Names longer than 'max_length' (31 is the ipset limit) are shortened with a hash of
+    the full name, to stay unique
+    """
+    base_name = re.sub(r'[^a-z0-9]+', '_', list_name.lower()).strip('_')
+    base_name = re.sub(r'_ip$', '', base_name) or 'm365'
+    set_name = f"{base_name}_v{family}"
+    if len(set_name) > max_length:
+        digest = hashlib.sha256(list_name.encode('utf-8')).hexdigest()[:6]
+        set_name = f"{base_name[:max_length - len(digest) - 5]}_{digest}_v{family}"
+    return set_name
+
+
+def get_network_sets(rule_list: dict) -> dict:
+    """
+    Networks of each '-ip' list, split by family and collapsed so no two overlap, as interval sets require:
+    {list_name: {4: [IPv4Network...], 6: [IPv6Network...]}}. Entries that don't parse as addresses are skipped
+    """
+    network_sets = dict()
+    for list_name, acl_addresses in rule_list.items():
+        if not list_name.lower().endswith('-ip'):
+            continue
+        networks = {4: list(), 6: list()}
+        for acl_address in acl_addresses:
+            network = RuleMatcher.parse_network(acl_address)
+            if network is not None:
+                networks[network.version].append(network)
+        network_sets[list_name] = {family: list(ipaddress.collapse_addresses(family_networks))
+                                   for family, family_networks in networks.items()}
+    return network_sets
+
+
+def format_network(network) -> str:
+    """
+    Single addresses are written without a prefix length, as nft and ipset list them
+    """
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return str(network)
+
+
+def get_sets(rule_list: dict) -> dict:
+    """
+    Elements of each set to publish: {set name: (family, [element...])}, sorted so the file diffs cleanly
+    """
+    sets = dict()
+    for list_name, networks in get_network_sets(rule_list).items():
+        for family in (4, 6):
+            sets[get_set_name(list_name, family)] = (family, [format_network(network)
+                                                               for network in sorted(networks[family])])
+    return sets
+
+
+def get_set_changes(sets: dict, previous_sets: dict) -> dict:
+    """
+    Elements removed from and added to each set since 'previous_sets' ({set name: (family, elements)}):
+    {set name: (family, [removed element...], [added element...])}. Sets no longer published keep their family and lose
+    every element, sets without changes are left out
+    """
+    changes = dict()
+    for set_name in dict.fromkeys(list(sets) + list(previous_sets)):
+        family, elements = sets.get(set_name, None) or (previous_sets[set_name][0], list())
+        previous = set(previous_sets.get(set_name, (family, ()))[1])
+        removed = sorted(previous.difference(elements))
+        added = [element for element in elements if element not in previous]
+        if removed or added:
+            changes[set_name] = (family, removed, added)
+    return changes
+
+
+def publish_sets(output, target_file_path: str, rule_list: dict, previous_rule_list: dict = None) -> (str, bool):
+    """
+    Publish the sets of 'rule_list' with 'output', an NfTables or IpSet output, to 'target_file_path', and beside it
+    an update script of the elements added and removed since the previous sets. These are the sets of
+    'previous_rule_list' in delta mode, otherwise those of the file last published. Returns (sha256, changed) of the
+    full file, as publish_chunks()
+    """
+    sets = get_sets(rule_list)
+    if previous_rule_list is not None:
+        previous_sets = get_sets(previous_rule_list)
+    else:
+        previous_sets = output.read_sets(target_file_path)
+    changes = get_set_changes(sets, previous_sets)
+    buffer_size = output.config.get('output_buffer_size', Defaults.output_buffer_size)
+
+    output_hash, output_changed = publish_chunks(target_file_path, output.iter_lines(sets), buffer_size)
+    if output_changed:
+        output.info(f"Published '{target_file_path}', sha256: {output_hash}")
+    else:
+        output.info(f"Unchanged '{target_file_path}', sha256: {output_hash}, left in place")
+
+    update_file_path = target_file_path + update_file_suffix
+    update_hash, update_changed = publish_chunks(update_file_path, output.iter_update_lines(sets, changes),
+                                                 buffer_size)
+    output.info(f"{'Published' if update_changed else 'Unchanged'} '{update_file_path}', sha256: {update_hash}, "
+                f"{sum(len(added) for family, removed, added in changes.values())} elements added and "
+                f"{sum(len(removed) for family, removed, added in changes.values())} removed")
+    return output_hash, output_changed
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Query the snapshot history kept in a persistent rule database. Each digest with a kept SQLite db ('-k -j PATH') records
+its final rules as the snapshot of the endpoint version they were built from, ie:
+
+    m365digester-history -j ./m365-digester.db list
+    m365digester-history -j ./m365-digester.db diff 2021042900 2021052800
+    m365digester-history -j ./m365-digester.db show 2021052800
+
+'diff' without versions compares the latest snapshot against the one before it
+"""
+
+import json
+import logging
+import os
+import sys
+from argparse import ArgumentParser
+
+from .Lib import SQLiteContext
+from .RuleStores.SQLiteRuleStore import SQLiteRuleStore
+
+
+def get_diff_versions(snapshots: list, from_version: str = None, to_version: str = None) -> (str, str):
+    """
+    Versions to compare, the latest snapshot and the one before it standing in for any not given
+    """
+    versions = [version for version, recorded, rule_count in snapshots]
+    if to_version is None:
+        to_version = versions[-1] if versions else None
+    if from_version is None:
+        to_index = versions.index(to_version) if to_version in versions else len(versions)
+        from_version = versions[to_index - 1] if to_index > 0 else to_version
+    return from_version, to_version
+
+
+def main():
+    parser = ArgumentParser(prog='m365digester-history',
+                            description='Snapshots of the M365 rules kept in a persistent SQLite rule database')
+    parser.add_argument('-j', '--sqlitedb-file-path', dest='sqlitedb_file_path',
+                        default=os.environ.get('SQLITEDB_FILE_PATH', None),
+                        help="SQLite db kept by 'm365digester-cli -k -j PATH'")
+    parser.add_argument('--json', dest='json_output', action='store_true',
+                        help='Default: False. Print JSON instead of text')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.add_parser('list', help='Versions recorded, oldest first')
+    diff_parser = commands.add_parser('diff', help='Rules added and removed between two versions')
+    diff_parser.add_argument('from_version', nargs='?', default=None,
+                             help='Default: the version before TO_VERSION')
+    diff_parser.add_argument('to_version', nargs='?', default=None, help='Default: the latest version')
+    show_parser = commands.add_parser('show', help='Rules of one version')
+    show_parser.add_argument('version', help='Version to show')
+    args = parser.parse_args()
+
+    if not args.command:
+        parser.error('a command is required: list, diff or show')
+    if not args.sqlitedb_file_path:
+        parser.error('a SQLite db file is required (-j PATH or SQLITEDB_FILE_PATH)')
+    if not os.path.isfile(args.sqlitedb_file_path):
+        parser.error(f"SQLite db file '{args.sqlitedb_file_path}' not found")
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr,
+                        format='%(asctime)s m365digester-history [%(levelname)s] %(message)s')
+    store = SQLiteRuleStore({'sqlitedb_file_path': args.sqlitedb_file_path, 'sqlitedb_context': SQLiteContext.FILE,
+                             'keep_sqlitedb': True}, logging.getLogger())
+    if not store.open():
+        sys.exit(1)
+    try:
+        snapshots = store.get_snapshots()
+        if args.command == 'list':
+            if args.json_output:
+                print(json.dumps([{'version': version, 'recorded': recorded, 'rule_count': rule_count}
+                                  for version, recorded, rule_count in snapshots], indent=2))
+            else:
+                for version, recorded, rule_count in snapshots:
+                    print(f"{version}\t{recorded}\t{rule_count}")
+        elif args.command == 'diff':
+            from_version, to_version = get_diff_versions(snapshots, args.from_version, args.to_version)
+            if to_version is None:
+                parser.error('no snapshots recorded')
+            added, removed = store.get_snapshot_diff(from_version, to_version)
+            if args.json_output:
+                print(json.dumps({'from_version': from_version, 'to_version': to_version,
+                                  'added': [{'list': list_name, 'address': address} for address, list_name in added],
+                                  'removed': [{'list': list_name, 'address': address}
+                                              for address, list_name in removed]}, indent=2))
+            else:
+                print(f"# {from_version} -> {to_version}: {len(added)} added, {len(removed)} removed")
+                for address, list_name in removed:
+                    print(f"-\t{list_name}\t{address}")
+                for address, list_name in added:
+                    print(f"+\t{list_name}\t{address}")
+        elif args.command == 'show':
+            rule_list = store.get_snapshot_rule_list(args.version)
+            if args.json_output:
+                print(json.dumps(rule_list, indent=2))
+            else:
+                for list_name, acl_addresses in rule_list.items():
+                    for acl_address in acl_addresses:
+                        print(f"{list_name}\t{acl_address}")
+    except KeyError as e:
+        parser.error(e.args[0])
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+import base64
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import os
+import random
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+from email.utils import parsedate_to_datetime
+
+from .Base import Base
+from .Lib import Defaults
+from .OutputWriter import publish_chunks
+
+
+class HttpResponse(object):
+    """
+    Response from HttpClient, read like the response from urllib.request.urlopen(). A gzip or deflate encoded body is
+    decoded as it is read. Once the body has been read to the end the connection goes back to the pool for reuse
+    """
+
+    def __init__(self, url: str, status: int, headers, raw=None, body: bytes = None, release=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.from_cache = raw is None
+        self.__raw = raw
+        self.__release = release
+        if raw is None:
+            self.__reader = io.BytesIO(body or b'')
+        else:
+            content_encoding = (headers.get('Content-Encoding', '') or '').strip().lower()
+            if content_encoding in ('gzip', 'x-gzip'):
+                self.__reader = gzip.GzipFile(fileobj=raw, mode='rb')
+            elif content_encoding == 'deflate':
+                self.__reader = _DeflateReader(raw)
+            else:
+                self.__reader = raw
+
+    def getcode(self) -> int:
+        return self.status
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return self.__reader.read()
+        return self.__reader.read(size)
+
+    def close(self):
+        if self.__release is not None:
+            release, self.__release = self.__release, None
+            release(self.__raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class _DeflateReader(object):
+    """
+    File-like decoder for a 'Content-Encoding: deflate' body, which may be zlib wrapped or raw deflate
+    """
+
+    def __init__(self, raw):
+        self.__raw = raw
+        self.__decompressor = None
+        self.__buffer = b''
+        self.__eof = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.__eof and (size is None or size < 0 or len(self.__buffer) < size):
+            chunk = self.__raw.read(64 * 1024)
+            if not chunk:
+                self.__eof = True
+                if self.__decompressor is not None:
+                    self.__buffer += self.__decompressor.flush()
+                break
+            if self.__decompressor is None:
+                wbits = zlib.MAX_WBITS if (chunk[0] & 0x0f) == 8 else -zlib.MAX_WBITS
+                self.__decompressor = zlib.decompressobj(wbits)
+            self.__buffer += self.__decompressor.decompress(chunk)
+        if size is None or size < 0:
+            data, self.__buffer = self.__buffer, b''
+        else:
+            data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return data
+
+
+class HttpClient(Base):
+    """
+    Shared HTTP client for the M365 web service. Connections are kept alive and pooled per host, compressed responses
+    are requested, and transient failures (connection errors, timeouts, 429 and 5xx) are retried with jittered
+    exponential backoff, honouring 'Retry-After'
+
+    get() can make conditional requests: given a cache file path, the body of each response is kept there, with its
+    ETag and Last-Modified beside it. They are sent back as 'If-None-Match' and 'If-Modified-Since', so a
+    '304 Not Modified' is answered from the file, across runs. Proxies are taken from the environment, as urllib does,
+    and credentials in the proxy URL are sent as Basic 'Proxy-Authorization'
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+    redirect_statuses = (301, 302, 303, 307, 308)
+    user_agent = 'm365digester'
+    validators_file_suffix = '.validators'
+
+    __lock = None
+    __idle = None
+    __request_count = 0
+    __retry_count = 0
+    __not_modified_count = 0
+    __connection_count = 0
+
+    def __init__(self, config: dict = None, logger=None):
+        super().__init__(config, logger)
+        self.__lock = threading.Lock()
+        self.__idle = dict()
+        self.__rnd = random.Random()
+
+    @property
+    def request_count(self) -> int:
+        return self.__request_count
+
+    @property
+    def retry_count(self) -> int:
+        return self.__retry_count
+
+    @property
+    def not_modified_count(self) -> int:
+        return self.__not_modified_count
+
+    @property
+    def connection_count(self) -> int:
+        """
+        Connections opened, fewer than requests when connections are reused
+        """
+        return self.__connection_count
+
+    def get_timeout(self) -> float:
+        return float(self.config.get('http_timeout', Defaults.http_timeout))
+
+    def get_retries(self) -> int:
+        return int(self.config.get('http_retries', Defaults.http_retries))
+
+    def get_proxy(self, scheme: str, host: str):
+        """
+        Proxy URL for 'scheme' from the environment, or None when there isn't one or 'host' bypasses it
+        """
+        proxy_url = urllib.request.getproxies().get(scheme, None)
+        if not proxy_url or urllib.request.proxy_bypass(host):
+            return None
+        if '://' not in proxy_url:
+            proxy_url = 'http://' + proxy_url
+        return proxy_url
+
+    @staticmethod
+    def get_proxy_headers(proxy_url: str) -> dict:
+        """
+        'Proxy-Authorization' header for the username and password in 'proxy_url', or no headers without them
+        """
+        proxy = urllib.parse.urlsplit(proxy_url)
+        if proxy.username is None:
+            return dict()
+        credentials = f"{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or '')}"
+        return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode('ascii')}
+
+    def get_pool_key(self, url: str) -> tuple:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Unsupported URL '{url}'")
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        return parts.scheme, parts.hostname, port
+
+    def create_connection(self, pool_key: tuple):
+        scheme, host, port = pool_key
+        timeout = self.get_timeout()
+        proxy_url = self.get_proxy(scheme, host)
+        if proxy_url:
+            proxy = urllib.parse.urlsplit(proxy_url)
+            proxy_port = proxy.port or (443 if proxy.scheme == 'https' else 80)
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(proxy.hostname, proxy_port, timeout=timeout,
+                                                         context=ssl.create_default_context())
+                connection.set_tunnel(host, port, headers=self.get_proxy_headers(proxy_url))
+            else:
+                connection = http.client.HTTPConnection(proxy.hostname, proxy_port, timeout=timeout)
+        elif scheme == 'https':
+            connection = http.client.HTTPSConnection(host, port, timeout=timeout,
+                                                     context=ssl.create_default_context())
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        with self.__lock:
+            self.__connection_count += 1
+        return connection
+
+    def acquire_connection(self, pool_key: tuple):
+        with self.__lock:
+            idle = self.__idle.get(pool_key, None)
+            if idle:
+                return idle.pop(), True
+        return self.create_connection(pool_key), False
+
+    def release_connection(self, pool_key: tuple, connection, reusable: bool):
+        if reusable:
+            with self.__lock:
+                idle = self.__idle.setdefault(pool_key, list())
+                if len(idle) < int(self.config.get('http_pool_size', Defaults.http_pool_size)):
+                    idle.append(connection)
+                    return
+        connection.close()
+
+    def close(self):
+        """
+        Close every idle connection
+        """
+        with self.__lock:
+            idle, self.__idle = self.__idle, dict()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def get_backoff(self, attempt: int, retry_after=None) -> float:
+        """
+        Seconds to wait before retry number 'attempt' (from 1): a random 'full jitter' delay of up to
+        'http_backoff' * 2^(attempt - 1), capped at 'http_backoff_max', or the server's 'Retry-After' if longer
+        """
+        backoff = float(self.config.get('http_backoff', Defaults.http_backoff))
+        backoff_max = float(self.config.get('http_backoff_max', Defaults.http_backoff_max))
+        with self.__lock:
+            delay = self.__rnd.uniform(0, min(backoff_max, backoff * (2 ** (attempt - 1))))
+        if retry_after:
+            try:
+                retry_after_seconds = float(retry_after)
+            except ValueError:
+                try:
+                    retry_after_seconds = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    retry_after_seconds = 0
+            delay = max(delay, min(backoff_max, retry_after_seconds))
+        return delay
+
+    def send(self, url: str, headers: dict):
+        """
+        One request attempt. A pooled connection the server has since closed is retried once on a new connection,
+        without counting as a retry
+        """
+        pool_key = self.get_pool_key(url)
+        parts = urllib.parse.urlsplit(url)
+        request_target = parts.path or '/'
+        if parts.query:
+            request_target += '?' + parts.query
+        request_headers = {'Accept-Encoding': 'gzip, deflate', 'User-Agent': self.user_agent}
+        if pool_key[0] == 'http':
+            proxy_url = self.get_proxy(pool_key[0], pool_key[1])
+            if proxy_url:
+                request_target = url
+                request_headers.update(self.get_proxy_headers(proxy_url))
+        request_headers.update(headers or dict())
+        while True:
+            connection, reused = self.acquire_connection(pool_key)
+            try:
+                connection.request('GET', request_target, headers=request_headers)
+                raw = connection.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                connection.close()
+                if reused:
+                    self.debug(f"Pooled connection to '{pool_key[1]}' was closed, reconnecting. Error: {e}")
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+
+            def release(response, connection=connection):
+                reusable = response.isclosed() and not response.will_close
+                if not response.isclosed():
+                    response.close()
+                self.release_connection(pool_key, connection, reusable)
+
+            return raw, release
+
+    def open(self, url: str, headers: dict = None) -> HttpResponse:
+        """
+        GET 'url', retrying transient failures and following redirects, and return the response for the caller to read
+        and close. Error statuses raise urllib.error.HTTPError, as urllib.request.urlopen() does. Certificate failures
+        are raised at once, as retrying can't fix them
+        """
+        retries = self.get_retries()
+        max_redirects = int(self.config.get('http_max_redirects', Defaults.http_max_redirects))
+        redirects = 0
+        attempt = 0
+        while True:
+            with self.__lock:
+                self.__request_count += 1
+            retry_after = None
+            try:
+                raw, release = self.send(url, headers)
+            except ssl.SSLCertVerificationError:
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                # Connection refused or reset, DNS failures and timeouts (socket.timeout is an OSError)
+                error = e
+            else:
+                location = raw.headers.get('Location', None)
+                if raw.status in self.redirect_statuses and location:
+                    raw.read()
+                    release(raw)
+                    redirects += 1
+                    if redirects > max_redirects:
+                        raise urllib.error.HTTPError(url, raw.status, f"More than {max_redirects} redirects",
+                                                     raw.headers, io.BytesIO(b''))
+                    redirect_url = urllib.parse.urljoin(url, location)
+                    self.debug(f"'{url}' redirected ({raw.status}) to '{redirect_url}'")
+                    url = redirect_url
+                    continue
+                if raw.status < 400:
+                    return HttpResponse(url, raw.status, raw.headers, raw=raw, release=release)
+                body = raw.read()
+                release(raw)
+                error = urllib.error.HTTPError(url, raw.status, raw.reason, raw.headers, io.BytesIO(body))
+                if raw.status not in self.retry_statuses:
+                    raise error
+                retry_after = raw.headers.get('Retry-After', None)
+
+            attempt += 1
+            if attempt > retries:
+                raise error
+            delay = self.get_backoff(attempt, retry_after)
+            with self.__lock:
+                self.__retry_count += 1
+            self.warning(f"Request to '{url}' failed, retry {attempt} of {retries} in {delay:.1f}s. "
+                         f"Error: {error}")
+            time.sleep(delay)
+
+    def load_validators(self, url: str, cache_file_path: str):
+        """
+        ETag, Last-Modified and body hash kept beside 'cache_file_path' for 'url', or None
+        """
+        validators_file_path = cache_file_path + self.validators_file_suffix
+        try:
+            with open(validators_file_path) as validators_file_handle:
+                validators = json.load(validators_file_handle)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.warning(f"Unable to read validators file '{validators_file_path}'. Error: {e}")
+            return None
+        if not isinstance(validators, dict) or validators.get('url', None) != url:
+            return None
+        return validators
+
+    def load_body(self, cache_file_path: str, validators: dict):
+        """
+        Body kept at 'cache_file_path', or None if it is missing or isn't the one 'validators' were stored with
+        """
+        try:
+            with open(cache_file_path, 'rb') as cache_file_handle:
+                body = cache_file_handle.read()
+        except OSError as e:
+            self.warning(f"Unable to read cached response '{cache_file_path}'. Error: {e}")
+            return None
+        if hashlib.sha256(body).hexdigest() != validators.get('sha256', None):
+            return None
+        return body
+
+    def store_response(self, url: str, cache_file_path: str, etag, last_modified, body: bytes):
+        """
+        Keep 'body' at 'cache_file_path' and its validators beside it, or remove them when there are no validators
+        """
+        validators_file_path = cache_file_path + self.validators_file_suffix
+        try:
+            if not etag and not last_modified:
+                for file_path in (validators_file_path, cache_file_path):
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(cache_file_path)), exist_ok=True)
+            body_hash, _ = publish_chunks(cache_file_path, (body,), binary=True)
+            publish_chunks(validators_file_path, (json.dumps({'url': url, 'etag': etag, 'last_modified': last_modified,
+                                                              'sha256': body_hash}),))
+        except Exception as e:
+            self.warning(f"Unable to keep the response to '{url}' in '{cache_file_path}'. Error: {e}")
+
+    def get(self, url: str, cache_file_path: str = None) -> bytes:
+        """
+        GET the whole body of 'url'. With 'cache_file_path' the request is conditional on the response kept there, and a
+        '304 Not Modified' is answered from that file
+        """
+        validators = self.load_validators(url, cache_file_path) if cache_file_path else None
+        while True:
+            headers = dict()
+            if validators:
+                if validators.get('etag', None):
+                    headers['If-None-Match'] = validators['etag']
+                if validators.get('last_modified', None):
+                    headers['If-Modified-Since'] = validators['last_modified']
+
+            with self.open(url, headers) as response:
+                body = response.read()
+                status, response_headers = response.status, response.headers
+
+            if status != 304 or not validators:
+                break
+            body = self.load_body(cache_file_path, validators)
+            if body is not None:
+                with self.__lock:
+                    self.__not_modified_count += 1
+                self.debug(f"'{url}' not modified, using the body kept in '{cache_file_path}'")
+                return body
+            self.warning(f"Kept response '{cache_file_path}' no longer matches its validators, "
+                         f"requesting '{url}' again")
+            validators = None
+
+        if cache_file_path:
+            self.store_response(url, cache_file_path, response_headers.get('ETag', None),
+                                response_headers.get('Last-Modified', None), body)
+        return body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
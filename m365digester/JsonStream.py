@@ -0,0 +1,78 @@
+import codecs
+import json
+
+# Bytes read from the source per step. An element larger than this is read in growing steps until it parses
+default_chunk_size = 64 * 1024
+
+_whitespace = ' \t\n\r'
+
+
+def iter_json_array(file_handle, chunk_size: int = default_chunk_size):
+    """
+    Yield the elements of a top level JSON array of objects one at a time, reading 'file_handle' (text or binary, ie:
+    an open file or an HTTP response) in chunks, so only the element being parsed is held in memory
+    """
+    decoder = json.JSONDecoder()
+    byte_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    end_of_file = False
+    started = False
+    read_size = chunk_size
+
+    while True:
+        # Skip to the start of the next element
+        while position < len(buffer) and buffer[position] in _whitespace:
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError(f"Expected a JSON array, found '{buffer[position]}'")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ',':
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+                read_size = chunk_size
+                yield element
+                continue
+            except json.JSONDecodeError:
+                if end_of_file:
+                    raise
+                # Element is incomplete, read a bigger step next time so very large elements don't parse repeatedly
+                read_size *= 2
+
+        if end_of_file:
+            raise ValueError('Unexpected end of JSON array')
+
+        chunk = file_handle.read(read_size)
+        # A short read may end part way through a multi-byte character, which decodes to '', so only an empty read
+        # is the end of the file
+        if not chunk:
+            end_of_file = True
+        if isinstance(chunk, bytes):
+            chunk = byte_decoder.decode(chunk, final=end_of_file)
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def iter_json_array_file(file_path: str, chunk_size: int = default_chunk_size):
+    """
+    Yield the elements of a top level JSON array stored in the file 'file_path' one at a time
+    """
+    with open(file_path, mode='rb') as file_handle:
+        yield from iter_json_array(file_handle, chunk_size)
+
+
+def iter_json_array_spool(file_handle, chunk_size: int = default_chunk_size):
+    """
+    Yield the elements of a top level JSON array from the open spool file 'file_handle', ie: a download written to a
+    temporary file, closing it once the array has been read
+    """
+    with file_handle:
+        yield from iter_json_array(file_handle, chunk_size)
@@ -44,6 +44,16 @@ class Defaults(object):
 
     m365_web_service_url = 'https://endpoints.office.com'
 
+    # HTTP client: seconds to wait on connect and each read, retries of transient failures, the base and cap of the
+    # jittered exponential backoff between retries in seconds, idle connections kept open per host, and redirects
+    # followed per request
+    http_timeout = 30.0
+    http_retries = 3
+    http_backoff = 1.0
+    http_backoff_max = 30.0
+    http_pool_size = 4
+    http_max_redirects = 10
+
     categories_filter_include = ('Allow', 'Default')
     categories_filter_include_choices = ('Allow', 'Default', 'Optimize')
 
@@ -51,6 +61,9 @@ class Defaults(object):
     address_filter_ipv6_enabled = True
     address_filter_domains_enabled = True
 
+    # Collapse overlapping and adjacent IP networks within each list into the fewest prefixes
+    ip_aggregation_enabled = True
+
     extra_known_domains_list_name = "M365-Extra-Domains"
     extra_known_ips_list_name = "M365-Extra-ip"
 
@@ -69,12 +82,29 @@ class Defaults(object):
     log_file_name = f"{APP_NAME}-{log_dts}.log"
     log_file_path = os.path.join(cwd, log_file_name)
     data_cache_path = os.path.join(cwd, '.cache')
+    data_cache_enabled = True
+    data_cache_keep_versions = 2
+    # Parse endpoint sets one object at a time from the response or file, rather than loading the whole payload
+    streaming_enabled = False
     output_path = cwd
     output_file_prefix = 'm365endpoint-output'
     output_file_extension = 'txt'
 
+    # Measure the peak Python heap of each phase with tracemalloc (slower), rather than the process high-water mark
+    metrics_trace_memory = False
+
+    # Output is collected into blocks of this many characters before each write to the target file
+    output_buffer_size = 256 * 1024
+
     output_type = 'generalcsv'
-    output_types_available = ['generalcsv', 'puppetsquid', 'squidconfig']
+    output_types_available = ['generalcsv', 'puppetsquid', 'squidconfig', 'matcherindex', 'pac', 'nftables',
+                              'ipset', 'ruleset']
+
+    # Delta mode: outputs that support it also write only the entries added and removed since the previous run, in a
+    # file beside the full output. The rule list of each run is kept in a state file to compare the next run against
+    output_delta_enabled = False
+    output_delta_file_suffix = '.delta'
+    output_delta_state_extension = 'state.json'
 
     # Efficiency mode - outputs everything into a de-duplicated ACL set for domain, and ips
     collapse_acl_sets = True
@@ -92,6 +122,35 @@ class Defaults(object):
     wildcard_regex_pattern = '^(\*).'
     wildcard_replace_enabled = True
 
+    # PAC output: what M365 destinations and everything else return from FindProxyForURL. Without a default route other
+    # destinations also go DIRECT. Resolving host names lets IP rules match names too, at the cost of a DNS lookup
+    pac_match_route = 'DIRECT'
+    pac_default_route = None
+    pac_resolve_hosts = False
+
+    # nftables and ipset output: the table holding the named sets, and the size limit of each ipset set. Changing the
+    # limit of an existing set needs it destroyed first
+    nftables_table = 'm365'
+    nftables_table_family = 'inet'
+    ipset_max_elements = 65536
+
+    # Seconds between checks of the matcher index file by the squid external ACL helper
+    squid_helper_reload_interval = 5.0
+
+    # Stand-in M365 web service for tests and benchmarks, port 0 picks a free port
+    standin_bind = '127.0.0.1'
+    standin_port = 0
+    standin_seed = 365
+    standin_generate_entries = 1000
+    standin_error_status = 503
+
+    # Incremental mode - apply only the '/changes' since the version held in a kept SQLite db
+    incremental_enabled = False
+
+    # Rule store backend. The SQLite store is always used when the SQLite db is kept or placed on disk
+    rule_store = 'memory'
+    rule_store_choices = ['memory', 'sqlite']
+
     # SQLite
     sqlitedb_context = SQLiteContext.MEMORY
     sqlitedb_context_file = f"{APP_NAME}.db"
@@ -102,3 +161,49 @@ class Defaults(object):
                             "id INTEGER PRIMARY KEY AUTOINCREMENT," \
                             f"{sqlitedb_column_address_name} TEXT NOT NULL," \
                             f"{sqlitedb_column_service_area_name} TEXT NOT NULL);"
+    # Duplicate addresses are rejected by the database itself, so inserts can be batched with 'INSERT OR IGNORE'
+    sqlitedb_index_create = f"CREATE UNIQUE INDEX IF NOT EXISTS acls_{sqlitedb_column_address_name}_unique " \
+                            f"ON acls({sqlitedb_column_address_name});"
+    # Addresses looked up per 'IN (...)' query, within the bound parameter limit of older SQLite builds
+    sqlitedb_max_variables = 999
+    # State kept between runs for incremental updates: the raw endpoint sets last applied, and key/value metadata
+    # such as the endpoint version
+    sqlitedb_state_tables_create = (
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);",
+        "CREATE TABLE IF NOT EXISTS endpoint_sets ("
+        "id INTEGER PRIMARY KEY,"
+        "servicearea TEXT,"
+        "category TEXT,"
+        "required INTEGER NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS endpoint_addresses ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "endpoint_set_id INTEGER NOT NULL,"
+        "kind TEXT NOT NULL,"
+        f"{sqlitedb_column_address_name} TEXT NOT NULL);",
+        "CREATE INDEX IF NOT EXISTS endpoint_addresses_endpoint_set_id "
+        "ON endpoint_addresses(endpoint_set_id, kind);",
+    )
+    # Snapshot history kept in a persistent db, one snapshot per endpoint version. Each distinct rule is stored once,
+    # and a span row records the run of snapshots it was present in, so history grows with the changes between
+    # versions rather than the size of each version
+    snapshot_history_enabled = True
+    sqlitedb_history_tables_create = (
+        "CREATE TABLE IF NOT EXISTS snapshots ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "version TEXT NOT NULL UNIQUE,"
+        "recorded TEXT NOT NULL,"
+        "rule_count INTEGER NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS snapshot_rules ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        f"{sqlitedb_column_address_name} TEXT NOT NULL,"
+        f"{sqlitedb_column_service_area_name} TEXT NOT NULL);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS snapshot_rules_unique "
+        f"ON snapshot_rules({sqlitedb_column_address_name}, {sqlitedb_column_service_area_name});",
+        "CREATE TABLE IF NOT EXISTS snapshot_spans ("
+        "rule_id INTEGER NOT NULL,"
+        "first_snapshot_id INTEGER NOT NULL,"
+        "last_snapshot_id INTEGER);",
+        "CREATE INDEX IF NOT EXISTS snapshot_spans_first ON snapshot_spans(first_snapshot_id);",
+        "CREATE INDEX IF NOT EXISTS snapshot_spans_last ON snapshot_spans(last_snapshot_id);",
+        "CREATE INDEX IF NOT EXISTS snapshot_spans_rule ON snapshot_spans(rule_id, first_snapshot_id);",
+    )
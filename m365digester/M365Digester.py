@@ -1,176 +1,323 @@
+import bisect
+import hashlib
+import ipaddress
 import json
-import os
 import re
-import sqlite3
+import shutil
 import tempfile
-import urllib.request
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from .Base import Base
+from .EndpointCache import EndpointCache
+from .ExclusionMatcher import ExclusionMatcher
+from .HttpClient import HttpClient
+from .JsonStream import iter_json_array_file, iter_json_array_spool
 from .Lib import Defaults, SQLiteContext
+from .Metrics import Metrics
+from .RuleStores.MemoryRuleStore import MemoryRuleStore
+from .RuleStores.SQLiteRuleStore import SQLiteRuleStore
+from .SuffixTrie import SuffixTrie
 
 
-class M365Digester(Base):
-    """App object"""
+class DigestResult(namedtuple('DigestResult', ['exit_code', 'rule_list', 'rule_origins', 'api_versions',
+                                               'counters', 'phase_seconds', 'total_seconds'])):
+    """
+    Read-only outcome of one digest. 'rule_list' maps each list name to a tuple of addresses, 'rule_origins' each
+    address to a tuple of the service instances that published it, and 'counters' holds the run statistics
+    """
+    __slots__ = ()
+
+    @property
+    def success(self) -> bool:
+        return self.exit_code == 0
+
+    @property
+    def rule_count(self) -> int:
+        return sum(len(acl_addresses) for acl_addresses in self.rule_list.values())
+
 
-    __db = None
-    __db_context_handle = None
+class M365Digester(Base):
+    """
+    App object. All state belongs to the instance, so digests may run concurrently from several threads, each with
+    its own M365Digester. One instance runs one digest at a time, and may be reused for the next
+    """
+
+    def __init__(self, config: dict = None, logger=None):
+        super().__init__(config, logger)
+        self.__store = None
+        self.__metrics = None
+        self.__http_client = None
+        self.__result = None
+        self.__running = threading.Lock()
+        self.__endpoint_sets = None
+        self.__endpoint_set_versions = dict()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the state of the last digest
+        """
+        self.warning_count = 0
+        self.error_count = 0
+        self.__api_versions = dict()
+        self.__rule_origins = dict()
+        self.__rule_list = dict()
+        self.__wildcard_adjustments = 0
+        self.__duplicate_count = 0
+        self.__domain_subset_duplicate_count = 0
+        self.__excluded_count = 0
+        self.__ip_aggregated_count = 0
+        self.__http_counts_started = self.get_http_counts()
+        self.__metrics = Metrics(self.config.get('metrics_trace_memory', Defaults.metrics_trace_memory))
 
-    __rule_list = dict()
-    __wildcard_adjustments = 0
-    __duplicate_count = 0
-    __domain_subset_duplicate_count = 0
-    __excluded_count = 0
+    @property
+    def result(self) -> DigestResult:
+        """
+        Outcome of the last digest, or None before the first has finished
+        """
+        return self.__result
 
     @property
     def rule_list(self):
         return self.__rule_list
 
-    def open_db(self, db_target: str) -> bool:
+    @property
+    def rule_store(self):
+        return self.__store
+
+    @property
+    def api_version(self):
         """
-        Open sqlite database connection
+        Endpoint version the rules were built from. When several instances were digested, 'instance=version' pairs
         """
+        api_versions = {instance_name: version for instance_name, version in self.__api_versions.items() if version}
+        if len(self.__api_versions) == 1 or not api_versions:
+            return next(iter(api_versions.values()), None)
+        return ','.join(f"{instance_name}={version}" for instance_name, version in api_versions.items())
 
-        try:
-            self.__db_context_handle = db_target
-            self.__db = sqlite3.connect(self.__db_context_handle)
-            self.debug(f"Opened SQLite3 Database file {self.__db_context_handle} connection, version {sqlite3.version}")
-            return True
-        except sqlite3.Error as e:
-            self.error(f"Unable to open SQLite3 database file {self.__db_context_handle}, error: {e}")
-            raise e
+    @property
+    def api_versions(self) -> dict:
+        return self.__api_versions
 
-    def close_db(self):
+    @property
+    def http_client(self) -> HttpClient:
         """
-        Close sqlite database connection
+        Client used for every request to the M365 web service. Set it to share connections and conditional request
+        validators between digests
         """
-        self.__db.close()
+        if self.__http_client is None:
+            self.__http_client = HttpClient(self.config, self.logger)
+        return self.__http_client
 
-    def remove_db(self) -> bool:
+    @http_client.setter
+    def http_client(self, http_client: HttpClient):
+        self.__http_client = http_client
+
+    @property
+    def metrics(self) -> Metrics:
         """
-        Delete temporary sqlite database file after usage
+        Wall time, rows and peak memory of each phase of the last run, with its counters
         """
+        return self.__metrics
 
-        if self.db_is_in_memory():
-            return True
+    @property
+    def rule_origins(self) -> dict:
+        """
+        Service instances each rule was published by, for rules ingested from endpoint sets in this run
+        """
+        return self.__rule_origins
 
-        if self.config.get('keep_sqlitedb', False):
-            self.info(f"Keeping SQLite db file: {self.__db_context_handle}.")
-            return True
+    def set_endpoint_sets(self, endpoint_sets: dict, api_versions: dict = None):
+        """
+        Digest these endpoint sets (instance name or file path -> endpoint set), fetched once elsewhere, instead of
+        fetching or reading them in each run. 'api_versions' are the versions they were fetched at. None goes back to
+        fetching
+        """
+        self.__endpoint_sets = dict(endpoint_sets) if endpoint_sets is not None else None
+        self.__endpoint_set_versions = dict(api_versions or dict())
 
-        try:
-            os.remove(self.__db_context_handle)
-            return True
-        except Exception as e:
-            self.warning(f"Unable to remove sqlite db file '{self.__db_context_handle}'. Error: {e}")
-            return False
+    def get_instance_names(self) -> list:
+        """
+        Service instances to digest, from a single name or a list of names
+        """
+        instance_names = self.config.get('m365_instance',
+                                         self.config.get('m365_service_instance_name',
+                                                         Defaults.m365_service_instance_name))
+        if isinstance(instance_names, str):
+            instance_names = instance_names.split()
+        return list(dict.fromkeys(instance_names))
+
+    def get_rule_store_type(self) -> str:
+        """
+        Decide which rule store backend to use. Keeping the SQLite db, or asking for it on disk, implies SQLite
+        """
+        if self.config.get('keep_sqlitedb', False) \
+                or self.config.get('sqlitedb_context', Defaults.sqlitedb_context) == SQLiteContext.FILE:
+            return 'sqlite'
+        return str(self.config.get('rule_store', Defaults.rule_store)).lower()
 
-    def init_db(self) -> bool:
-        sqlitedb_table_create = self.config.get('sqlitedb_table_create', Defaults.sqlitedb_table_create)
-        try:
-            c = self.__db.cursor()
-            c.execute(sqlitedb_table_create)
-            return True
-        except sqlite3.Error as e:
-            self.error(f"Unable to create table using query '{sqlitedb_table_create}'. Error: {e}")
-            return False
+    def open_db(self) -> bool:
+        """
+        Create and open the rule store
+        """
+        rule_store_type = self.get_rule_store_type()
+        if rule_store_type == 'sqlite':
+            self.__store = SQLiteRuleStore(self.config, self.logger)
+        else:
+            self.__store = MemoryRuleStore(self.config, self.logger)
+        self.debug(f"Using rule store '{self.__store.__class__.__name__}'")
+        return self.__store.open()
 
-    def db_is_in_memory(self):
-        if self.config.get('sqlitedb_context', Defaults.sqlitedb_context) == SQLiteContext.MEMORY:
-            return True
-        return False
+    def close_db(self):
+        """
+        Close the rule store
+        """
+        if self.__store:
+            self.__store.close()
 
-    def db_cursor(self):
-        return self.__db.cursor()
+    def remove_db(self) -> bool:
+        """
+        Delete temporary rule store after usage
+        """
+        return self.__store.remove()
 
     def db_commit(self):
-        if self.db_is_in_memory():
-            return
-        else:
-            self.__db.commit()
+        self.__store.commit()
 
-    def db_add_acl_to_rule_list(self, acl_address, service_area_name):
+    def db_adjust_wildcard(self, acl_address: str) -> str:
         """
-        Adds rules (and their sources) to the rule database.
-        This function does its best to not duplicate entries upon insertion, but it may not be perfect
+        If the acl_address contains a wildcard, replace it with a single dot - the SQUID way of handling 'wildcards'
 
         FIXME: This function only works with DNS entries, NOT IPv4/6 ADDRESSES. It will mangle an IPv4 ADDRESS with a
         wildcard in
         """
+        if not self.config.get('wildcard_replace_enabled', Defaults.wildcard_replace_enabled):
+            return acl_address
 
-        if self.config.get('wildcard_replace_enabled', Defaults.wildcard_replace_enabled):
-            wildcard_regex_pattern = self.config.get('wildcard_regex_pattern', Defaults.wildcard_regex_pattern)
-
-            # Use a regex for wildcard analysis. This is slow (compared to a fancy lambda) but this is readable, and we
-            # are not here for speed
-            x = re.search(wildcard_regex_pattern, acl_address)
-
-            # If the incoming acl_address contains a wildcard, replace it with a single dot - the SQUID way of handling
-            # 'wildcards'
-            if x:
-                self.__wildcard_adjustments += 1
-                old_address = acl_address
-                pattern = re.compile(wildcard_regex_pattern)
-                acl_address = pattern.sub('.', old_address)
-                self.debug(f"ACL address '{old_address}' contains a wildcard. Altered to '{acl_address}'")
-
-        # Check if the acl already exists in the rule set we are working on, if its there, count that we ignored a
-        # duplicate, otherwise add to list
-        sql_query = f"SELECT id, {Defaults.sqlitedb_column_address_name}, {Defaults.sqlitedb_column_service_area_name} FROM acls" \
-                    f" WHERE {Defaults.sqlitedb_column_address_name} = ?;"
-        c = self.db_cursor()
-        c.execute(sql_query, (acl_address,))
-        rows = c.fetchall()
-        if len(rows) > 0:
-            # Looks like there was a duplicate..
-            existing_acl_service_area_name = rows[0][2]
-            self.debug(
-                f"Ignoring duplicate entry '{acl_address}' which would have been added to list '{service_area_name}'."
-                f"Existing '{acl_address}' is in '{existing_acl_service_area_name}'")
-            self.__duplicate_count += 1
+        wildcard_regex_pattern = self.config.get('wildcard_regex_pattern', Defaults.wildcard_regex_pattern)
+
+        # Use a regex for wildcard analysis. This is slow (compared to a fancy lambda) but this is readable, and re
+        # caches the compiled pattern between calls
+        x = re.search(wildcard_regex_pattern, acl_address)
+        if x:
+            self.__wildcard_adjustments += 1
+            old_address = acl_address
+            acl_address = re.sub(wildcard_regex_pattern, '.', old_address)
+            self.debug(f"ACL address '{old_address}' contains a wildcard. Altered to '{acl_address}'")
+
+        return acl_address
+
+    def db_add_acl_to_rule_list(self, acl_address, service_area_name):
+        """
+        Adds a single rule (and its source) to the rule database, returning 1, or -1 if the address was already known.
+        Prefer db_add_acls_to_rule_list for more than a handful of rules
+        """
+
+        if self.db_add_acls_to_rule_list([(acl_address, service_area_name)]) < 1:
             return -1
-        c.close()
+        return 1
+
+    def db_add_acls_to_rule_list(self, acl_entries, commit: bool = True, origin: str = None) -> int:
+        """
+        Adds rules (and their sources) to the rule database in one batch. 'acl_entries' is an iterable of
+        (acl_address, service_area_name) tuples. The first occurrence of an address wins, later duplicates are ignored
+        by the rule store and counted. If given, 'origin' is recorded against every address in 'rule_origins'.
+
+        Returns the number of rules added
+        """
+
+        rows = [(self.db_adjust_wildcard(str(acl_address)), service_area_name)
+                for acl_address, service_area_name in acl_entries]
+        if not rows:
+            return 0
+
+        if origin:
+            for acl_address, service_area_name in rows:
+                origins = self.__rule_origins.setdefault(acl_address, list())
+                if origin not in origins:
+                    origins.append(origin)
 
-        sql_insert = f"INSERT OR IGNORE INTO acls(" \
-                     f"{Defaults.sqlitedb_column_address_name}, " \
-                     f"{Defaults.sqlitedb_column_service_area_name}) " \
-                     f"VALUES (?,?);"
-        c = self.db_cursor()
-        c.execute(sql_insert, (acl_address, service_area_name))
-        self.db_commit()
-        return c.lastrowid
+        added = self.__store.add_acls(rows, commit=commit)
+        duplicates = len(rows) - added
+        if duplicates:
+            self.debug(f"Ignored {duplicates} duplicate entries out of {len(rows)}")
+        self.__duplicate_count += duplicates
+        return added
 
     def db_remove_acl_from_all_lists(self, acl_address):
         """
         Removes a rule from the rule database.
         """
 
-        # Check if the rule is in there...
-        sql_query = f"SELECT id, {Defaults.sqlitedb_column_address_name}, {Defaults.sqlitedb_column_service_area_name} FROM acls" \
-                    f" WHERE {Defaults.sqlitedb_column_address_name} = ?;"
-        c = self.db_cursor()
-        c.execute(sql_query, (acl_address,))
-
-        rows = c.fetchall()
-        for row in rows:
-            # Looks like it exists
-            existing_acl_id = row[0]
-            existing_acl_service_area_name = row[2]
+        for existing_acl_address, existing_acl_service_area_name in self.__store.remove_acls([acl_address]):
             self.debug(
                 f"Found address entry '{acl_address}' in service area '{existing_acl_service_area_name}'. Excluding..")
-
-            sql_delete = "DELETE FROM acls WHERE id = ?;"
-            c2 = self.db_cursor()
-            c2.execute(sql_delete, (existing_acl_id,))
             self.__excluded_count += 1
-            c2.close()
-
-        self.db_commit()
-        c.close()
 
         return
 
-    def db_analyse_api_rule_lists(self, endpoint_set):
+    def db_exclude_acls(self, exclusion_matcher: ExclusionMatcher) -> dict:
+        """
+        Remove every rule matching an exclusion pattern, in one pass over the rule database and one transaction.
+        Returns the number of rules each pattern matched
         """
-        Analyse object 'endpoint_set' returned from M365 API, and create/update/extend dict-of-list 'rule_list'
+        hits = dict.fromkeys(exclusion_matcher.patterns, 0)
+        excluded = list()
+        for acl_address, service_area_name in self.__store.get_acls():
+            patterns = exclusion_matcher.match(acl_address)
+            if patterns:
+                self.debug(f"Found address entry '{acl_address}' in service area '{service_area_name}' matching "
+                           f"{', '.join(repr(pattern) for pattern in patterns)}. Excluding..")
+                excluded.append(acl_address)
+                for pattern in patterns:
+                    hits[pattern] += 1
+        self.__excluded_count += len(self.__store.remove_acls(excluded))
+        return hits
+
+    def db_analyse_api_rule_lists(self, endpoint_set, commit: bool = True, origin: str = None) -> int:
+        """
+        Analyse object 'endpoint_set' returned from M365 API, and add the resulting rules to the rule database in a
+        single transaction. Returns the number of rules added
+
+        'endpoint_set' can be any iterable of endpoint set objects, including a stream being parsed one object at a
+        time. Domains are added as each object arrives, IPs are held back and added at the end, so every domain is
+        still added before any IP
+        """
+        if self.config.get('address_filter_domains_enabled', Defaults.address_filter_domains_enabled):
+            self.info("Analysing endpoints for domain names...")
+        if self.config.get('address_filter_ipv4_enabled', Defaults.address_filter_ipv4_enabled) \
+                or self.config.get('address_filter_ipv6_enabled', Defaults.address_filter_ipv4_enabled):
+            self.info("Analysing endpoints for IPs...")
+
+        added = 0
+        ip_entries = list()
+        for endpoint in endpoint_set:
+            domain_entries, endpoint_ip_entries = self.db_get_endpoint_rule_list_entries(endpoint)
+            if domain_entries:
+                added += self.db_add_acls_to_rule_list(domain_entries, commit=False, origin=origin)
+            ip_entries.extend(endpoint_ip_entries)
+        added += self.db_add_acls_to_rule_list(ip_entries, commit=commit, origin=origin)
+        return added
+
+    def db_get_api_rule_list_entries(self, endpoint_set) -> list:
+        """
+        Analyse object 'endpoint_set' returned from M365 API, and create list of (acl_address, service_area_name),
+        domains first, then IPs
+        """
+        domain_entries = list()
+        ip_entries = list()
+        for endpoint in endpoint_set:
+            endpoint_domain_entries, endpoint_ip_entries = self.db_get_endpoint_rule_list_entries(endpoint)
+            domain_entries.extend(endpoint_domain_entries)
+            ip_entries.extend(endpoint_ip_entries)
+        return domain_entries + ip_entries
+
+    def db_get_endpoint_rule_list_entries(self, endpointSet: dict) -> (list, list):
+        """
+        Analyse a single endpoint set object, and create lists of (acl_address, service_area_name) for its domains and
+        for its IPs
 
         Filter results for Allow, Optimize, Default endpoints, and transform these into tuples with port and category
         ServiceArea is used to generate rule_set dictionary key, and if global collapse_acl_set is True,
@@ -180,146 +327,316 @@ class M365Digester(Base):
         collapse_acl_sets = self.config.get('collapse_acl_sets', Defaults.collapse_acl_sets)
         categories_filter_include = self.config.get('categories_filter_include', Defaults.categories_filter_include)
 
+        domain_entries = list()
+        ip_entries = list()
+
+        if endpointSet['category'] not in categories_filter_include:
+            return domain_entries, ip_entries
+        required = endpointSet['required'] if 'required' in endpointSet else False
+        if not required:
+            return domain_entries, ip_entries
+        service_area = str(endpointSet['serviceArea']) if 'serviceArea' in endpointSet else ''
+
         if self.config.get('address_filter_domains_enabled', Defaults.address_filter_domains_enabled):
-            self.info("Analysing endpoints for domain names...")
-            for endpointSet in endpoint_set:
-                if endpointSet['category'] in categories_filter_include:
-                    required = endpointSet['required'] if 'required' in endpointSet else False
-                    if not required:
-                        continue
-                    urls = endpointSet['urls'] if 'urls' in endpointSet else []
-                    service_area = str(endpointSet['serviceArea']) if 'serviceArea' in endpointSet else ''
-                    if collapse_acl_sets:
-                        service_area_name = f"M365-API-Source-domain"
-                    else:
-                        service_area_name = f"M365-API-Source-{service_area}-domain"
-                    for url in urls:
-                        self.db_add_acl_to_rule_list(str(url), service_area_name)
+            urls = endpointSet['urls'] if 'urls' in endpointSet else []
+            if collapse_acl_sets:
+                service_area_name = f"M365-API-Source-domain"
+            else:
+                service_area_name = f"M365-API-Source-{service_area}-domain"
+            for url in urls:
+                domain_entries.append((str(url), service_area_name))
 
         if self.config.get('address_filter_ipv4_enabled', Defaults.address_filter_ipv4_enabled) \
                 or self.config.get('address_filter_ipv6_enabled', Defaults.address_filter_ipv4_enabled):
-            self.info("Analysing endpoints for IPs...")
-            for endpointSet in endpoint_set:
-                if endpointSet['category'] in categories_filter_include:
-                    required = endpointSet['required'] if 'required' in endpointSet else False
-                    if not required:
-                        continue
-                    ips = endpointSet['ips'] if 'ips' in endpointSet else []
-                    # IPv4 strings have dots while IPv6 strings have colons
-                    ip4s = [ip for ip in ips if '.' in ip]
-                    ip6s = [ip for ip in ips if ':' in ip]
-                    service_area = str(endpointSet['serviceArea']) if 'serviceArea' in endpointSet else ''
-                    if collapse_acl_sets:
-                        service_area_name = f"M365-API-Source-ip"
-                    else:
-                        service_area_name = f"M365-API-Source-{service_area}-ip"
-                    for ip in ip4s:
-                        self.db_add_acl_to_rule_list(str(ip), service_area_name)
-                    for ip in ip6s:
-                        self.db_add_acl_to_rule_list(str(ip), service_area_name)
+            ips = endpointSet['ips'] if 'ips' in endpointSet else []
+            # IPv4 strings have dots while IPv6 strings have colons
+            ip4s = [ip for ip in ips if '.' in ip]
+            ip6s = [ip for ip in ips if ':' in ip]
+            if collapse_acl_sets:
+                service_area_name = f"M365-API-Source-ip"
+            else:
+                service_area_name = f"M365-API-Source-{service_area}-ip"
+            for ip in ip4s:
+                ip_entries.append((str(ip), service_area_name))
+            for ip in ip6s:
+                ip_entries.append((str(ip), service_area_name))
+
+        return domain_entries, ip_entries
+
+    def db_get_extra_rule_list_entries(self) -> list:
+        """
+        Create list of (acl_address, service_area_name) from the extra known domains and ips in config
+        """
+        extra_entries = list()
+
+        extra_known_domains = self.config.get('extra_known_domains', None)
+
+        if extra_known_domains:
+            extra_known_domains_list_name = self.config.get('extra_known_domains_list_name',
+                                                            Defaults.extra_known_domains_list_name)
+            # Add company domains to rule list
+            for acl_address in extra_known_domains:
+                self.info(f"Adding extra known addresses '{acl_address}' to '{extra_known_domains_list_name}'")
+                extra_entries.append((acl_address, extra_known_domains_list_name))
+
+        extra_known_ips = self.config.get('extra_known_ips', None)
+
+        if extra_known_ips:
+            extra_known_ips_list_name = self.config.get('extra_known_ips_list_name',
+                                                        Defaults.extra_known_ips_list_name)
+            # Add company domains to rule list
+            for acl_address in extra_known_ips:
+                self.info(f"Adding extra known addresses '{acl_address}' to '{extra_known_ips_list_name}'")
+                extra_entries.append((acl_address, extra_known_ips_list_name))
+
+        return extra_entries
+
+    def db_get_candidate_acls(self, endpoint_set) -> dict:
+        """
+        Get the address -> service area name mapping a full digest of 'endpoint_set' plus the extras would ingest,
+        before exclusions and overlap analysis
+        """
+        candidate_acls = dict()
+        for acl_address, service_area_name in self.db_get_api_rule_list_entries(endpoint_set) + \
+                self.db_get_extra_rule_list_entries():
+            candidate_acls.setdefault(self.db_adjust_wildcard(str(acl_address)), service_area_name)
+        return candidate_acls
+
+    def db_apply_endpoint_set_delta(self, old_endpoint_set, new_endpoint_set) -> int:
+        """
+        Bring the rule database from the digest of 'old_endpoint_set' to the digest of 'new_endpoint_set', touching only
+        the rules which differ between them. Exclusions and the subdomain overlap rules are re-evaluated for the
+        touched domains, their subdomains and '.' prefixed twins. IP lists with changes are rebuilt and aggregated.
+
+        Returns the number of candidate rules which changed
+        """
+        wildcard_adjustments = self.__wildcard_adjustments
+        old_candidates = self.db_get_candidate_acls(old_endpoint_set)
+        self.__wildcard_adjustments = wildcard_adjustments
+        new_candidates = self.db_get_candidate_acls(new_endpoint_set)
+
+        exclusion_matcher = ExclusionMatcher.compile(self.config.get('exclude_addresses', None))
+        old_live = {acl_address: service_area_name for acl_address, service_area_name in old_candidates.items()
+                    if not exclusion_matcher.match(acl_address)}
+        new_live = {acl_address: service_area_name for acl_address, service_area_name in new_candidates.items()
+                    if not exclusion_matcher.match(acl_address)}
+
+        touched = [acl_address for acl_address in dict.fromkeys(list(old_live) + list(new_live))
+                   if old_live.get(acl_address) != new_live.get(acl_address)]
+        if not touched:
+            return 0
+
+        touched_domains = list()
+        touched_ip_lists = set()
+        for acl_address in touched:
+            if self.is_ip_network(acl_address):
+                touched_ip_lists.update(service_area_name for service_area_name in
+                                        (old_live.get(acl_address), new_live.get(acl_address)) if service_area_name)
+            else:
+                touched_domains.append(acl_address)
+
+        # Domains whose overlap status may have changed: the touched ones, anything under a touched '.parent', and the
+        # '.' prefixed twin of a touched domain
+        region = dict.fromkeys(touched_domains)
+        touched_parents = SuffixTrie()
+        for acl_address in touched_domains:
+            if acl_address.startswith('.'):
+                touched_parents.add(acl_address, acl_address)
+            else:
+                region['.' + acl_address] = None
+        if len(touched_parents):
+            for acl_address in new_live:
+                if touched_parents.find_parent(acl_address) is not None:
+                    region[acl_address] = None
+
+        parent_domains = SuffixTrie()
+        for acl_address in new_live:
+            if acl_address.startswith('.'):
+                parent_domains.add(acl_address, acl_address)
+
+        current = self.__store.get_acls_by_address(list(region))
+        removals = list()
+        additions = list()
+        for acl_address in region:
+            service_area_name = new_live.get(acl_address)
+            if service_area_name is not None:
+                acl_outer = parent_domains.find_parent(acl_address)
+                if acl_outer is None and acl_address.startswith('.') and acl_address[1:] in new_live:
+                    acl_outer = acl_address[1:]
+                if acl_outer is not None:
+                    self.debug(f"Removed subdomain overlap outer: '{acl_outer}', inner: '{acl_address}'")
+                    self.__domain_subset_duplicate_count += 1
+                    service_area_name = None
+            if current.get(acl_address) == service_area_name:
+                continue
+            if acl_address in current:
+                removals.append(acl_address)
+            if service_area_name is not None:
+                additions.append((acl_address, service_area_name))
+
+        if touched_ip_lists:
+            for acl_address, service_area_name in self.__store.get_acls():
+                if service_area_name in touched_ip_lists and self.is_ip_network(acl_address):
+                    removals.append(acl_address)
+            for acl_address, service_area_name in new_live.items():
+                if service_area_name in touched_ip_lists and self.is_ip_network(acl_address):
+                    additions.append((acl_address, service_area_name))
+
+        self.__store.remove_acls(removals, commit=False)
+        self.__store.add_acls(additions, commit=False)
+
+        if touched_ip_lists and self.config.get('ip_aggregation_enabled', Defaults.ip_aggregation_enabled):
+            self.db_aggregate_ip_rule_lists(list(touched_ip_lists))
+
+        self.debug(f"Endpoint set delta removed {len(removals)} and added {len(additions)} rules")
+        return len(touched)
 
     def db_get_count_acls_in_rule_list(self) -> int:
         """
         Get the total number of ACL's in the 'rule_list' db
         """
-        c = self.db_cursor()
-        c.execute("SELECT COUNT(*) FROM acls")
-        result = c.fetchone()[0]
-        return result
+        return self.__store.get_count_acls()
 
     def db_analyse_rule_lists_for_subdomain_errors(self):
         """
         Analyse rule database to remove subdomain overlaps
+
+        Every '.parent' style ACL is loaded into a reversed label suffix trie, so each ACL can be checked for being
+        covered by a parent in a single pass. An ACL without a leading dot also displaces its '.' prefixed twin.
+        All overlaps are then removed in one transaction
         """
 
         self.info("Analysing rules for subdomain overlaps")
 
-        c = self.db_cursor()
-        sql_query = f"SELECT id, " \
-                    f"{Defaults.sqlitedb_column_address_name}, " \
-                    f"{Defaults.sqlitedb_column_service_area_name} " \
-                    f"FROM acls ORDER BY {Defaults.sqlitedb_column_service_area_name}"
-        c.execute(sql_query)
-        rows = c.fetchall()
-
-        for row in rows:
-
-            search_acl = ''
-
-            # For every single ACL, check one isn't a subset of the other!
-            acl_outer = str(row[1])
-            if acl_outer.startswith('.'):
-                search_acl = acl_outer
-                sql_query2 = f"SELECT id, " \
-                             f"{Defaults.sqlitedb_column_address_name}, " \
-                             f"{Defaults.sqlitedb_column_service_area_name} " \
-                             f"FROM acls WHERE {Defaults.sqlitedb_column_address_name} LIKE '%' || ?"
-            else:
-                search_acl = "." + acl_outer
-                sql_query2 = f"SELECT id, " \
-                             f"{Defaults.sqlitedb_column_address_name}, " \
-                             f"{Defaults.sqlitedb_column_service_area_name} " \
-                             f"FROM acls WHERE {Defaults.sqlitedb_column_address_name}=?;"
-
-            c2 = self.db_cursor()
-            c2.execute(sql_query2, (search_acl,))  # comma makes it a tuple... don't ask
-            rows2 = c2.fetchall()
-            for row2 in rows2:
-                acl_inner = str(row2[1])
-                if acl_inner != acl_outer:
-                    acl_inner_id = str(row2[0])
-                    sql_query3 = "DELETE FROM acls " \
-                                 "WHERE id=?"
-                    c3 = self.db_cursor()
-                    c3.execute(sql_query3, (acl_inner_id,))
-                    self.db_commit()
-                    c3.close()
-                    self.__domain_subset_duplicate_count += 1
-                    self.debug(f"Removed subdomain overlap outer: '{acl_outer}', inner: '{acl_inner}'")
-            c2.close()
+        rows = self.__store.get_acls()
+
+        parent_domains = SuffixTrie()
+        known_addresses = set()
+        for acl_address, service_area_name in rows:
+            known_addresses.add(acl_address)
+            if acl_address.startswith('.'):
+                parent_domains.add(acl_address, acl_address)
+
+        overlaps = list()
+        for acl_inner, service_area_name in rows:
+            acl_outer = parent_domains.find_parent(acl_inner)
+            if acl_outer is None and acl_inner.startswith('.') and acl_inner[1:] in known_addresses:
+                acl_outer = acl_inner[1:]
+            if acl_outer is None:
+                continue
+            overlaps.append(acl_inner)
+            self.debug(f"Removed subdomain overlap outer: '{acl_outer}', inner: '{acl_inner}'")
+
+        if not overlaps:
+            return
 
-        c.close()
+        self.__store.remove_acls(overlaps)
+        self.__domain_subset_duplicate_count += len(overlaps)
+
+    @staticmethod
+    def is_ip_network(acl_address: str) -> bool:
+        try:
+            ipaddress.ip_network(acl_address, strict=False)
+            return True
+        except ValueError:
+            return False
 
-    def db_get_unique_rule_sources(self):
+    def db_aggregate_ip_rule_lists(self, service_area_names: list = None):
+        """
+        Collapse overlapping and adjacent IP networks into the fewest covering prefixes, separately for each address
+        family in each service area list (or only the lists in 'service_area_names'). Entries which don't parse as an
+        IP network (domains) are left untouched, as are networks which survive aggregation, so their original spelling
+        is kept
+        """
+
+        self.info("Aggregating IP networks")
+
+        service_area_addresses = dict()
+        for acl_address, service_area_name in self.__store.get_acls():
+            if service_area_names is not None and service_area_name not in service_area_names:
+                continue
+            service_area_addresses.setdefault(service_area_name, list()).append(acl_address)
+
+        removals = list()
+        additions = list()
+        for service_area_name, acl_addresses in service_area_addresses.items():
+            networks = {4: dict(), 6: dict()}
+            for acl_address in acl_addresses:
+                try:
+                    network = ipaddress.ip_network(acl_address, strict=False)
+                except ValueError:
+                    continue
+                networks[network.version].setdefault(network, acl_address)
+
+            aggregated_addresses = set()
+            for version, original_networks in networks.items():
+                if len(original_networks) < 2:
+                    aggregated_addresses.update(original_networks.values())
+                    continue
+                for network in ipaddress.collapse_addresses(original_networks):
+                    aggregated_addresses.add(original_networks.get(network, str(network)))
+
+            ip_addresses = set(acl_address for original_networks in networks.values()
+                               for acl_address in original_networks.values())
+            for acl_address in acl_addresses:
+                if acl_address in ip_addresses and acl_address not in aggregated_addresses:
+                    removals.append(acl_address)
+            new_addresses = sorted(aggregated_addresses - ip_addresses)
+            for acl_address in new_addresses:
+                self.debug(f"Aggregated IP networks in '{service_area_name}' into '{acl_address}'")
+                additions.append((acl_address, service_area_name))
+            if self.__rule_origins and new_addresses:
+                self.db_merge_aggregated_rule_origins(networks, new_addresses)
+
+        if not removals:
+            return
+
+        self.__store.remove_acls(removals, commit=False)
+        added = self.__store.add_acls(additions)
+        self.__ip_aggregated_count += len(removals) - added
+        self.info(f"Removed {len(removals) - added} IP prefixes by aggregation")
+
+    def db_merge_aggregated_rule_origins(self, networks: dict, aggregate_addresses: list):
+        """
+        Give each new aggregate the origins of the original networks it covers. Aggregates of one family never overlap,
+        so the only aggregate which can cover a network is the last one starting at or before it, found by bisection
+        """
+        aggregates = {4: list(), 6: list()}
+        for acl_address in aggregate_addresses:
+            aggregate = ipaddress.ip_network(acl_address, strict=False)
+            aggregates[aggregate.version].append((aggregate, acl_address))
+
+        for version, version_aggregates in aggregates.items():
+            if not version_aggregates:
+                continue
+            version_aggregates.sort(key=lambda item: item[0])
+            starts = [aggregate.network_address for aggregate, acl_address in version_aggregates]
+            for network, original_address in networks[version].items():
+                index = bisect.bisect_right(starts, network.network_address) - 1
+                if index < 0:
+                    continue
+                aggregate, acl_address = version_aggregates[index]
+                if not network.subnet_of(aggregate):
+                    continue
+                origins = self.__rule_origins.setdefault(acl_address, list())
+                origins.extend(origin for origin in self.__rule_origins.get(original_address, list())
+                               if origin not in origins)
+
+    def db_get_unique_rule_sources(self) -> list:
         """
         Get unique source names from rule database
         """
-        sql_query = f"SELECT DISTINCT {Defaults.sqlitedb_column_service_area_name} FROM acls;"
-        c = self.db_cursor()
-        c.execute(sql_query)
-        rows = c.fetchall()
-        c.close()
-        return rows
+        return self.__store.get_unique_rule_sources()
 
-    def db_get_rule_list(self):
+    def db_get_rule_list(self) -> dict:
         """
         Get complete rule set from rule database
         """
-        local_rule_list = dict()
-
-        sources_list = self.db_get_unique_rule_sources()
+        return self.__store.get_rule_list()
 
-        for source in sources_list:
-            if isinstance(source, tuple):
-                source = str(source[0])
-            sql_query = f"SELECT {Defaults.sqlitedb_column_address_name} " \
-                        f"FROM acls " \
-                        f"WHERE {Defaults.sqlitedb_column_service_area_name} = ? " \
-                        f"ORDER BY address ASC;"
-            c = self.db_cursor()
-            c.execute(sql_query, (source,))
-            addresses = c.fetchall()
-            c.close()
-            local_rule_list[source] = list()
-            for address in addresses:
-                address = str(address[0])
-                local_rule_list[source].append(address)
-
-        return local_rule_list
-
-    def m365_web_service_get_rule_set(self, method_name, global_instance_name, client_request_id) -> dict:
+    def m365_web_service_get_url(self, method_name, global_instance_name, client_request_id) -> str:
         """
-        Communicate with MS 365 Web Service to obtain json object with endpoint information
+        Build the request URL for a M365 Web Service method
         Arguments 'clientRequestId' is a GUID. All zeros returns most recent changes only, hardcoded
         value of 'b10c5ed1-bad1-445f-b386-b919946339a7' should return complete set since 2018..
 
@@ -336,9 +653,51 @@ class M365Digester(Base):
                             '?clientRequestId=' + \
                             client_request_id
         self.debug(f"Full M365 request path: '{request_path}'")
-        request = urllib.request.Request(request_path)
-        with urllib.request.urlopen(request) as response:
-            return json.loads(response.read().decode())
+        return request_path
+
+    def m365_web_service_get_cache_file_path(self, method_name, global_instance_name, client_request_id):
+        """
+        Where the response to 'method_name' is kept for conditional requests, or None when the data cache is disabled.
+        Endpoint sets are cached by version instead, see m365_get_endpoint_set()
+        """
+        if not self.config.get('data_cache_enabled', Defaults.data_cache_enabled):
+            return None
+        return EndpointCache(self.config, self.logger).get_response_path(global_instance_name, client_request_id,
+                                                                         method_name)
+
+    def m365_web_service_open(self, method_name, global_instance_name, client_request_id):
+        """
+        Communicate with MS 365 Web Service, returning the open response for the caller to read and close
+        """
+        return self.http_client.open(self.m365_web_service_get_url(method_name, global_instance_name,
+                                                                   client_request_id))
+
+    def m365_web_service_get_rule_set(self, method_name, global_instance_name, client_request_id) -> dict:
+        """
+        Communicate with MS 365 Web Service to obtain json object with endpoint information
+        """
+        body = self.http_client.get(self.m365_web_service_get_url(method_name, global_instance_name,
+                                                                  client_request_id))
+        with self.metrics.phase('parse') as phase:
+            rule_set = json.loads(body.decode())
+            phase.rows = len(rule_set) if isinstance(rule_set, list) else None
+        return rule_set
+
+    def m365_web_service_stream_rule_set(self, method_name, global_instance_name, client_request_id):
+        """
+        Communicate with MS 365 Web Service, spooling the response to a temporary file, and return an iterator parsing
+        endpoint set objects from it one at a time. The whole response is downloaded here, so instances are fetched
+        concurrently and request failures surface while fetching rather than while ingesting
+        """
+        spool_file_handle = tempfile.TemporaryFile()
+        try:
+            with self.m365_web_service_open(method_name, global_instance_name, client_request_id) as response:
+                shutil.copyfileobj(response, spool_file_handle)
+            spool_file_handle.seek(0)
+        except BaseException:
+            spool_file_handle.close()
+            raise
+        return iter_json_array_spool(spool_file_handle)
 
     def m365_web_service_get_version_data(self, client_request_id: str,
                                           global_instance_name: str = Defaults.m365_service_instance_name):
@@ -350,45 +709,358 @@ class M365Digester(Base):
             request_path += '/' + global_instance_name
         request_path += '?clientRequestId=' + client_request_id
         self.debug(f"Full M365 request path: '{request_path}'")
-        request = urllib.request.Request(request_path)
-        with urllib.request.urlopen(request) as response:
-            return json.loads(response.read().decode())
+        cache_file_path = self.m365_web_service_get_cache_file_path('version', global_instance_name or '',
+                                                                    client_request_id)
+        return json.loads(self.http_client.get(request_path, cache_file_path).decode())
+
+    def m365_web_service_get_changes(self, client_request_id: str, global_instance_name: str, version: str) -> list:
+        """
+        Get the changes to endpoint sets published since 'version'
+        """
+
+        request_url_base: str = self.config.get('m365_web_service_url', Defaults.m365_web_service_url)
+        self.info(f"Contacting M365 web service for changes since version '{version}': '{request_url_base}'")
+        request_path: str = request_url_base + \
+                            '/changes' + \
+                            '/' + global_instance_name + \
+                            '/' + version + \
+                            '?clientRequestId=' + \
+                            client_request_id
+        self.debug(f"Full M365 request path: '{request_path}'")
+        cache_file_path = self.m365_web_service_get_cache_file_path('changes', global_instance_name, client_request_id)
+        return json.loads(self.http_client.get(request_path, cache_file_path).decode())
+
+    @staticmethod
+    def m365_apply_changes_to_endpoint_set(endpoint_set: list, changes: list) -> list:
+        """
+        Apply change objects from the '/changes' method to 'endpoint_set', returning the updated endpoint set
+        """
+        endpoint_sets = dict()
+        for endpoint in endpoint_set:
+            endpoint = dict(endpoint)
+            for kind in ('urls', 'ips'):
+                if kind in endpoint:
+                    endpoint[kind] = list(endpoint[kind])
+            endpoint_sets[endpoint['id']] = endpoint
+
+        for change in sorted(changes, key=lambda x: (str(x.get('version', '')), x.get('id', 0))):
+            endpoint_set_id = change['endpointSetId']
+            disposition = str(change.get('disposition', '')).lower()
+            current = change.get('current', None) or dict()
+            removals = change.get('remove', None) or dict()
+            additions = change.get('add', None) or dict()
+
+            if disposition == 'remove' and not removals.get('urls') and not removals.get('ips'):
+                endpoint_sets.pop(endpoint_set_id, None)
+                continue
+
+            endpoint = endpoint_sets.setdefault(endpoint_set_id, {'id': endpoint_set_id})
+            for key in ('serviceArea', 'category', 'required'):
+                if key in current:
+                    endpoint[key] = current[key]
+            for kind in ('urls', 'ips'):
+                removed = set(removals.get(kind, None) or [])
+                if removed and kind in endpoint:
+                    endpoint[kind] = [address for address in endpoint[kind] if address not in removed]
+                for address in additions.get(kind, None) or []:
+                    if address not in endpoint.setdefault(kind, list()):
+                        endpoint[kind].append(address)
+
+        for endpoint in endpoint_sets.values():
+            if 'category' not in endpoint or 'serviceArea' not in endpoint:
+                raise Exception(f"Changes do not describe new endpoint set '{endpoint['id']}' fully")
+
+        return [endpoint_sets[endpoint_set_id] for endpoint_set_id in sorted(endpoint_sets)]
+
+    def m365_get_endpoint_set(self, global_instance_name: str, client_request_id: str):
+        """
+        Get the endpoint set for an instance. The '/version' method is checked first, and when the latest version is
+        already in the on disk cache, the cached endpoint set is used instead of downloading it again
+
+        In streaming mode an iterator of endpoint set objects is returned instead of a list. The response is written
+        to the cache as it downloads, then parsed back from there one object at a time
+        """
+        data_cache_enabled = self.config.get('data_cache_enabled', Defaults.data_cache_enabled)
+        streaming_enabled = self.config.get('streaming_enabled', Defaults.streaming_enabled)
+        incremental_enabled = self.config.get('incremental_enabled', Defaults.incremental_enabled)
+        force_refresh = self.config.get('force_refresh', False)
+
+        # The snapshot history of a kept rule database is recorded against the version
+        snapshot_enabled = self.config.get('snapshot_history_enabled', Defaults.snapshot_history_enabled) and \
+            (self.__store.is_persistent() if self.__store is not None else self.config.get('keep_sqlitedb', False))
+
+        latest_version = None
+        if data_cache_enabled or incremental_enabled or snapshot_enabled:
+            try:
+                version_data = self.m365_web_service_get_version_data(client_request_id, global_instance_name)
+                latest_version = version_data.get('latest', None)
+                self.info(f"M365 web service reports latest version '{latest_version}' for '{global_instance_name}'")
+            except Exception as e:
+                self.warning(f"Unable to retrieve version data from M365 web service, cache not used. Error: {e}")
+
+        endpoint_cache = EndpointCache(self.config, self.logger)
+
+        if latest_version and data_cache_enabled:
+            if force_refresh:
+                self.info("Forced refresh, ignoring endpoint cache")
+            else:
+                if streaming_enabled:
+                    endpoint_set = endpoint_cache.load_stream(global_instance_name, client_request_id, latest_version)
+                else:
+                    with self.metrics.phase('parse') as phase:
+                        endpoint_set = endpoint_cache.load(global_instance_name, client_request_id, latest_version)
+                        phase.rows = len(endpoint_set) if endpoint_set is not None else None
+                if endpoint_set is not None:
+                    self.__api_versions[global_instance_name] = latest_version
+                    return endpoint_set
+
+        self.__api_versions[global_instance_name] = latest_version
+
+        if streaming_enabled:
+            if latest_version and data_cache_enabled:
+                with self.m365_web_service_open('endpoints', global_instance_name, client_request_id) as response:
+                    endpoint_file_path = endpoint_cache.store_stream(global_instance_name, client_request_id,
+                                                                     latest_version, response)
+                if endpoint_file_path:
+                    return iter_json_array_file(endpoint_file_path)
+            return self.m365_web_service_stream_rule_set('endpoints', global_instance_name, client_request_id)
+
+        endpoint_set = self.m365_web_service_get_rule_set('endpoints', global_instance_name, client_request_id)
+
+        if latest_version and data_cache_enabled:
+            endpoint_cache.store(global_instance_name, client_request_id, latest_version, endpoint_set)
+
+        return endpoint_set
+
+    def read_endpoint_set_files(self, endpoint_file_paths: list) -> dict:
+        """
+        Read endpoint sets from local files (ie: archived '/endpoints' responses) instead of the web service,
+        returning a dict of file path -> endpoint set. Files are parsed one object at a time in streaming mode
+        """
+        endpoint_sets = dict()
+        for endpoint_file_path in endpoint_file_paths:
+            self.info(f"Reading endpoint set from file '{endpoint_file_path}'")
+            if self.config.get('streaming_enabled', Defaults.streaming_enabled):
+                endpoint_sets[endpoint_file_path] = iter_json_array_file(endpoint_file_path)
+            else:
+                with self.metrics.phase('parse') as phase, open(endpoint_file_path) as endpoint_file_handle:
+                    endpoint_sets[endpoint_file_path] = json.load(endpoint_file_handle)
+                    phase.rows = len(endpoint_sets[endpoint_file_path])
+        return endpoint_sets
+
+    def m365_get_endpoint_sets(self, instance_names: list, client_request_id: str) -> dict:
+        """
+        Get the endpoint sets of several instances concurrently, returning a dict of instance name -> endpoint set in
+        the order of 'instance_names'
+        """
+        if len(instance_names) == 1:
+            return {instance_names[0]: self.m365_get_endpoint_set(instance_names[0], client_request_id)}
+
+        self.info(f"Fetching endpoint sets for instances: {', '.join(instance_names)}")
+        with ThreadPoolExecutor(max_workers=len(instance_names)) as executor:
+            futures = {instance_name: executor.submit(self.m365_get_endpoint_set, instance_name, client_request_id)
+                       for instance_name in instance_names}
+            endpoint_sets = {instance_name: future.result() for instance_name, future in futures.items()}
+        self.__api_versions = {instance_name: self.__api_versions.get(instance_name, None)
+                               for instance_name in instance_names}
+        return endpoint_sets
+
+    def get_config_fingerprint(self) -> str:
+        """
+        Hash of the settings which shape the rule database, so stored state is only reused under the same settings
+        """
+        fingerprint_keys = ('categories_filter_include', 'collapse_acl_sets', 'address_filter_domains_enabled',
+                            'address_filter_ipv4_enabled', 'address_filter_ipv6_enabled', 'wildcard_replace_enabled',
+                            'wildcard_regex_pattern', 'extra_known_domains', 'extra_known_domains_list_name',
+                            'extra_known_ips', 'extra_known_ips_list_name', 'exclude_addresses',
+                            'ip_aggregation_enabled')
+        fingerprint = json.dumps({key: self.config.get(key, getattr(Defaults, key, None)) for key in fingerprint_keys},
+                                 sort_keys=True, default=str)
+        return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+    def db_update_incremental(self, global_instance_name: str, client_request_id: str) -> bool:
+        """
+        Update a kept rule database using only the '/changes' since the version it was last built from. Returns False
+        when the database holds no usable state, and a full digest is needed
+        """
+        stored_version = self.__store.get_meta('version')
+        if not stored_version:
+            self.info("Rule database holds no endpoint version, running full digest")
+            return False
+
+        if self.__store.get_meta('instance') != global_instance_name \
+                or self.__store.get_meta('client_request_id') != client_request_id \
+                or self.__store.get_meta('config_fingerprint') != self.get_config_fingerprint():
+            self.info("Rule database was built with different settings, running full digest")
+            return False
+
+        version_data = self.m365_web_service_get_version_data(client_request_id, global_instance_name)
+        latest_version = version_data['latest']
+        self.__api_versions[global_instance_name] = latest_version
+
+        if latest_version == stored_version:
+            self.info(f"Rule database is already at version '{stored_version}', nothing to apply")
+            return True
+
+        changes = self.m365_web_service_get_changes(client_request_id, global_instance_name, stored_version)
+        old_endpoint_set = self.__store.get_endpoint_set()
+        new_endpoint_set = self.m365_apply_changes_to_endpoint_set(old_endpoint_set, changes)
+
+        touched = self.db_apply_endpoint_set_delta(old_endpoint_set, new_endpoint_set)
+
+        self.__store.set_endpoint_set(new_endpoint_set, commit=False)
+        self.__store.set_meta('version', latest_version, commit=False)
+        self.__store.commit()
+
+        self.info(f"Applied {len(changes)} changes from version '{stored_version}' to '{latest_version}', "
+                  f"{touched} rules touched")
+        return True
+
+    def db_save_state(self, global_instance_name: str, client_request_id: str, endpoint_set):
+        """
+        Keep the endpoint set and its version with a persistent rule database, for later incremental updates
+        """
+        if not self.__store.is_persistent():
+            return
+        self.__store.set_endpoint_set(endpoint_set, commit=False)
+        self.__store.set_meta('instance', global_instance_name, commit=False)
+        self.__store.set_meta('client_request_id', client_request_id, commit=False)
+        self.__store.set_meta('config_fingerprint', self.get_config_fingerprint(), commit=False)
+        self.__store.set_meta('version', self.__api_versions.get(global_instance_name, None) or '', commit=False)
+        self.__store.commit()
+
+    def db_save_snapshot(self):
+        """
+        Record the final rules as the snapshot of the endpoint version in a persistent rule database's history
+        """
+        version = self.api_version
+        if not version:
+            self.info('Endpoint version unknown, no snapshot recorded')
+            return
+        try:
+            added_count, removed_count = self.__store.save_snapshot(version)
+        except ValueError as e:
+            self.warning(f"No snapshot recorded: {e}")
+            return
+        self.info(f"Recorded snapshot of version '{version}', {added_count} rules added and {removed_count} removed")
 
     def main(self) -> int:
         """Main function"""
 
-        if self.config.get('sqlitedb_context', Defaults.sqlitedb_context):
-            self.config.setdefault('sqlitedb_file_path',
-                                   self.config.get('sqlitedb_context_memory', Defaults.sqlitedb_context_memory))
-        else:
-            self.config.setdefault('sqlitedb_file_path',
-                                   self.config.get('sqlitedb_context_file', Defaults.sqlitedb_context_file))
+        if not self.__running.acquire(blocking=False):
+            raise RuntimeError("A digest is already running on this M365Digester, use one instance per thread")
+        try:
+            self.reset()
+            self.__result = None
+            self.__metrics.start()
+            exit_code = self.run_digest()
+            if exit_code:
+                self.__metrics.counters.update({'warnings': self.warning_count, 'errors': self.error_count})
+                self.__metrics.stop()
+            self.__result = self.get_result(exit_code)
+            return exit_code
+        finally:
+            self.__running.release()
+
+    def digest(self) -> DigestResult:
+        """
+        Run a digest and return its result, ie: executor.submit(M365Digester(config, logger).digest)
+        """
+        self.main()
+        return self.__result
 
-        sqlitedb_context_handle: str = self.config.get('sqlitedb_file_path', None)
-        # If no sqlite db output specified, generate a temp file to use?
-        # FIXME:
-        if not sqlitedb_context_handle:
-            db_path = tempfile._get_default_tempdir()
-            db_name = next(tempfile._get_candidate_names()) + ".db"
-            sqlitedb_context_handle = os.path.join(db_path, db_name)
+    def get_http_counts(self) -> dict:
+        """
+        Requests, retries, '304 Not Modified' answers and connections of the HTTP client so far
+        """
+        if self.__http_client is None:
+            return dict()
+        return {'http_requests': self.__http_client.request_count,
+                'http_retries': self.__http_client.retry_count,
+                'http_not_modified': self.__http_client.not_modified_count,
+                'http_connections': self.__http_client.connection_count}
+
+    def get_result(self, exit_code: int) -> DigestResult:
+        """
+        Freeze the rules and statistics of the digest just run
+        """
+        return DigestResult(
+            exit_code=exit_code,
+            rule_list=MappingProxyType({list_name: tuple(acl_addresses)
+                                        for list_name, acl_addresses in self.__rule_list.items()}),
+            rule_origins=MappingProxyType({acl_address: tuple(origins)
+                                           for acl_address, origins in self.__rule_origins.items()}),
+            api_versions=MappingProxyType(dict(self.__api_versions)),
+            counters=MappingProxyType(dict(self.__metrics.counters)),
+            phase_seconds=MappingProxyType({name: phase.seconds for name, phase in self.__metrics.phases.items()}),
+            total_seconds=self.__metrics.total_seconds)
+
+    def run_digest(self) -> int:
+        """
+        Digest the endpoint sets into the rule list, returning 0 on success or the error count
+        """
 
         try:
-            self.open_db(sqlitedb_context_handle)
+            with self.metrics.phase('open'):
+                opened = self.open_db()
+            if not opened:
+                return self.error_quit(f"Unable to initialise rule store '{self.get_rule_store_type()}'")
         except Exception as e:
-            return self.error_quit(f"Unable to open sqlite database '{sqlitedb_context_handle}'. Error: {e}")
-
-        self.init_db()
+            return self.error_quit(f"Unable to open rule store '{self.get_rule_store_type()}'. Error: {e}")
 
         m365_request_guid: str = self.config.get('m365clientRequestId_fullset',
-                                                 Defaults.m365_request_guid)
+                                                 self.config.get('m365_request_guid', Defaults.m365_request_guid))
+
+        m365_instances: list = self.get_instance_names()
+
+        endpoint_file_paths = self.config.get('endpoint_file_paths', None)
+        if isinstance(endpoint_file_paths, str):
+            endpoint_file_paths = [endpoint_file_paths]
+
+        if self.config.get('incremental_enabled', Defaults.incremental_enabled):
+            if endpoint_file_paths:
+                self.warning("Incremental mode needs the M365 web service, running full digest of the input files")
+            elif self.__endpoint_sets is not None:
+                self.warning("Incremental mode needs the M365 web service, running full digest of the endpoint sets "
+                             "given")
+            elif not self.__store.is_persistent():
+                self.warning("Incremental mode needs a kept SQLite db (-k -j), running full digest")
+            elif len(m365_instances) > 1:
+                self.warning("Incremental mode supports a single service instance, running full digest")
+            else:
+                try:
+                    with self.metrics.phase('incremental'):
+                        updated = self.db_update_incremental(m365_instances[0], m365_request_guid)
+                    if updated:
+                        return self.complete_digest()
+                except Exception as e:
+                    self.warning(f"Unable to update rule database incrementally, running full digest. Error: {e}")
 
-        m365_instance: str = self.config.get('m365_instance', Defaults.m365_service_instance_name)
+        # A full digest always starts from an empty rule database
+        self.__store.clear(commit=False)
 
-        # Call to M365 web service for rule set and decode JSON to object collection 'endpoint_set'
+        # Call to M365 web service (or the cache) for rule set and decode JSON to object collection 'endpoint_set'
         try:
-            endpoint_set = self.m365_web_service_get_rule_set('endpoints', m365_instance, m365_request_guid)
-            # Analyse the 'endpoint_set' object collection, pass in reference to 'rule_list' to populate
-            self.db_analyse_api_rule_lists(endpoint_set)
+            with self.metrics.phase('fetch') as phase:
+                if self.__endpoint_sets is not None:
+                    endpoint_sets = dict(self.__endpoint_sets)
+                    self.__api_versions.update(self.__endpoint_set_versions)
+                elif endpoint_file_paths:
+                    endpoint_sets = self.read_endpoint_set_files(endpoint_file_paths)
+                else:
+                    endpoint_sets = self.m365_get_endpoint_sets(m365_instances, m365_request_guid)
+                # A kept rule database stores the endpoint sets for incremental updates, so streams are read in full
+                if self.__store.is_persistent():
+                    endpoint_sets = {source: list(endpoint_set) for source, endpoint_set in endpoint_sets.items()}
+                # Streams are only counted as they are ingested
+                if all(isinstance(endpoint_set, list) for endpoint_set in endpoint_sets.values()):
+                    phase.rows = sum(len(endpoint_set) for endpoint_set in endpoint_sets.values())
+            # Analyse each 'endpoint_set' object collection, adding its rules in the same transaction as the extras.
+            # Instances are merged in the order given, so the first to publish an address decides its list
+            with self.metrics.phase('ingest') as phase:
+                phase.rows = 0
+                for m365_instance, endpoint_set in endpoint_sets.items():
+                    phase.rows += self.db_analyse_api_rule_lists(endpoint_set, commit=False, origin=m365_instance)
         except Exception as e:
             # If something goes wrong, pull the rip-cord
             return self.error_quit(f"Unable to retrieve endpoint set from M365 web service. Error: {e}")
@@ -397,46 +1069,55 @@ class M365Digester(Base):
         rule_count = self.db_get_count_acls_in_rule_list()
         self.info(f"Total known rules from MS API: {rule_count}")
 
-        extra_known_domains = self.config.get('extra_known_domains', None)
-
-        if extra_known_domains:
-            extra_known_domains_list_name = self.config.get('extra_known_domains_list_name',
-                                                            Defaults.extra_known_domains_list_name)
-            # Add company domains to rule list
-            for acl_address in extra_known_domains:
-                try:
-                    self.info(f"Adding extra known addresses '{acl_address}' to '{extra_known_domains_list_name}'")
-                    self.db_add_acl_to_rule_list(acl_address, extra_known_domains_list_name)
-                except Exception as e:
-                    self.error(f"Unable to add extra known domain to list. Error: {e.__class__.__name__}: {e}")
-
-        extra_known_ips = self.config.get('extra_known_ips', None)
+        with self.metrics.phase('extras') as phase:
+            extra_entries = self.db_get_extra_rule_list_entries()
 
-        if extra_known_ips:
-            extra_known_ips_list_name = self.config.get('extra_known_ips_list_name',
-                                                        Defaults.extra_known_ips_list_name)
-            # Add company domains to rule list
-            for acl_address in extra_known_ips:
-                try:
-                    self.info(f"Adding extra known addresses '{acl_address}' to '{extra_known_ips_list_name}'")
-                    self.db_add_acl_to_rule_list(acl_address, extra_known_ips_list_name)
-                except Exception as e:
-                    self.error(f"Unable to add extra known ip to list. Error: {e.__class__.__name__}: {e}")
+            try:
+                phase.rows = self.db_add_acls_to_rule_list(extra_entries)
+            except Exception as e:
+                self.error(f"Unable to add extra known addresses to list. Error: {e.__class__.__name__}: {e}")
 
         exclude_addresses = self.config.get('exclude_addresses', None)
 
         if exclude_addresses:
-            for acl_address in exclude_addresses:
+            with self.metrics.phase('exclude') as phase:
+                excluded_count = self.__excluded_count
                 try:
-                    self.info(f"Removing excluded address '{acl_address}' from consideration")
-                    self.db_remove_acl_from_all_lists(acl_address)
+                    exclusion_hits = self.db_exclude_acls(ExclusionMatcher.compile(exclude_addresses))
+                    for pattern, hit_count in exclusion_hits.items():
+                        self.info(f"Excluded {hit_count} rules matching '{pattern}'")
+                    self.metrics.details['exclusion_hits'] = exclusion_hits
                 except Exception as e:
-                    self.error(f"Unable to remove excluded address '{acl_address}', Error: {e.__class__.__name__}: {e}")
+                    self.error(f"Unable to remove excluded addresses, Error: {e.__class__.__name__}: {e}")
+                phase.rows = self.__excluded_count - excluded_count
 
         # The API as of today 20210415 returns domains that are subdomains of high level ones, which Squid really
         # doesnt like
-        self.__duplicate_count = 0
-        self.db_analyse_rule_lists_for_subdomain_errors()
+        with self.metrics.phase('overlap') as phase:
+            subset_duplicate_count = self.__domain_subset_duplicate_count
+            self.db_analyse_rule_lists_for_subdomain_errors()
+            phase.rows = self.__domain_subset_duplicate_count - subset_duplicate_count
+
+        # Overlapping and adjacent prefixes each become a separate 'dst' ACL, so merge them where possible
+        if self.config.get('ip_aggregation_enabled', Defaults.ip_aggregation_enabled):
+            with self.metrics.phase('aggregate') as phase:
+                ip_aggregated_count = self.__ip_aggregated_count
+                self.db_aggregate_ip_rule_lists()
+                phase.rows = self.__ip_aggregated_count - ip_aggregated_count
+
+        with self.metrics.phase('save_state'):
+            if len(endpoint_sets) == 1 and not endpoint_file_paths:
+                self.db_save_state(m365_instances[0], m365_request_guid, endpoint_sets[m365_instances[0]])
+            elif self.__store.is_persistent():
+                # Merged state can't be updated from a single instance's changes
+                self.__store.set_meta('version', '')
+
+        return self.complete_digest()
+
+    def complete_digest(self) -> int:
+        """
+        Report stats and read the final rule list out of the rule store, then close it
+        """
 
         # See how many rules got added (should be x+len(extra_known_domains) obviously)
         rule_count = self.db_get_count_acls_in_rule_list()
@@ -447,20 +1128,49 @@ class M365Digester(Base):
                   f" wildcard adjustment count: {self.__wildcard_adjustments},"
                   f" duplicates discarded count: {self.__duplicate_count},"
                   f" domain subset duplicate count: {self.__domain_subset_duplicate_count},"
-                  f" excluded addresses counts: {self.__excluded_count}.")
+                  f" excluded addresses counts: {self.__excluded_count},"
+                  f" ip prefixes aggregated count: {self.__ip_aggregated_count}.")
 
         # List off rule set names
         self.info(f"Known source sets: ")
         sources = self.db_get_unique_rule_sources()
         for source in sources:
-            if isinstance(source, tuple):
-                source = str(source[0])
             self.info(f"{source}")
 
-        self.__rule_list = self.db_get_rule_list()
+        with self.metrics.phase('extract') as phase:
+            self.__rule_list = self.db_get_rule_list()
+            phase.rows = sum(len(acl_addresses) for acl_addresses in self.__rule_list.values())
+
+        final_addresses = set(acl_address for acl_addresses in self.__rule_list.values() for acl_address in acl_addresses)
+        self.__rule_origins = {acl_address: origins for acl_address, origins in self.__rule_origins.items()
+                               if acl_address in final_addresses}
+
+        if self.__store.is_persistent() and \
+                self.config.get('snapshot_history_enabled', Defaults.snapshot_history_enabled):
+            with self.metrics.phase('snapshot'):
+                self.db_save_snapshot()
 
         self.close_db()
         self.remove_db()
 
+        self.metrics.counters.update({
+            'rules': rule_count,
+            'warnings': self.warning_count,
+            'errors': self.error_count,
+            'wildcard_adjustments': self.__wildcard_adjustments,
+            'duplicates_discarded': self.__duplicate_count,
+            'domain_subset_duplicates': self.__domain_subset_duplicate_count,
+            'excluded_addresses': self.__excluded_count,
+            'ip_prefixes_aggregated': self.__ip_aggregated_count,
+        })
+        # The client outlives a run, so only count the requests made during this one
+        http_counts = self.get_http_counts()
+        self.metrics.counters.update({counter_name: count - self.__http_counts_started.get(counter_name, 0)
+                                      for counter_name, count in http_counts.items()})
+        self.metrics.details['api_versions'] = dict(self.__api_versions)
+        self.metrics.stop()
+        self.info(f"Digest completed in {self.metrics.total_seconds:.3f}s, phases: " +
+                  ', '.join(f"{name} {phase.seconds:.3f}s" for name, phase in self.metrics.phases.items()))
+
         # Success return code 0
         return 0
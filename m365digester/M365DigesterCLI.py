@@ -14,10 +14,8 @@ from argparse import ArgumentParser, RawTextHelpFormatter
 from m365digester import APP_NAME, APP_VERSION, APP_BRANCH
 from m365digester.Lib import Defaults, SQLiteContext, LineSeparator
 from m365digester.M365Digester import M365Digester
-
-from m365digester.Outputs.GeneralCSV import GeneralCSV
-from m365digester.Outputs.PuppetSquid import PuppetSquid
-from m365digester.Outputs.SquidConfig import SquidConfig
+from m365digester.OutputRunner import OutputRunner
+from m365digester.ProfileRunner import ProfileRunner
 
 
 def main():
@@ -47,7 +45,7 @@ def main():
                                    f"\t-m {os.linesep}"
                                    f"\t-e testcompany-files.sharepoint.com testcompany-cloud.microsoft.com *.live.com {os.linesep}"
                                    f"\t-p rules-today {os.linesep}"
-                                   f"\t-t squid {os.linesep}"
+                                   f"\t-t squidconfig generalcsv=./rules-today.csv {os.linesep}"
                                    f"\t--output-template ./squidconfig.template {os.linesep}"
                                    f"\t-C",
                             usage=f"{platform_starter} [options]")
@@ -80,6 +78,18 @@ def main():
     sqlitedb_group.add_argument('-j', '--sqlitedb-file-path', dest='sqlitedb_file_path',
                                 default=os.environ.get('SQLITEDB_FILE_PATH', None))
 
+    sqlitedb_group.add_argument('-I', '--incremental', dest='incremental_enabled',
+                                action='store_true',
+                                default=str(os.environ.get('INCREMENTAL', '')).lower() in ['true', '1', 'y'],
+                                help="Default: False. With -k and -j, apply only the M365 changes since the version "
+                                     "held in the SQLite db")
+
+    sqlitedb_group.add_argument('-r', '--rule-store', dest='rule_store', type=str.lower,
+                                choices=Defaults.rule_store_choices,
+                                default=os.environ.get('RULE_STORE', Defaults.rule_store),
+                                help=f"Default: {Defaults.rule_store}. "
+                                     f"Ignored (sqlite used) when the SQLite db is kept")
+
     wildcard_group = parser.add_argument_group('Wildcards', 'Wildcard handling')
 
     wildcard_enabled_group = wildcard_group.add_mutually_exclusive_group()
@@ -117,7 +127,8 @@ def main():
             pass
 
     acl_group.add_argument('-z', '--categories-include', dest='categories_filter_include', nargs="+",
-                           default=env_categories_include if not None else Defaults.categories_filter_include,
+                           default=env_categories_include if env_categories_include is not None
+                           else Defaults.categories_filter_include,
                            choices=Defaults.categories_filter_include_choices,
                            help=f"Default: '{' '.join(Defaults.categories_filter_include)}'")
 
@@ -135,16 +146,65 @@ def main():
                            default=os.environ.get('IPV6_DISABLED', Defaults.address_filter_ipv6_enabled),
                            help=f"Default: {'IPv6 enabled' if Defaults.address_filter_ipv6_enabled else 'IPv6 disabled'}")
 
+    acl_group.add_argument('-A', '--disable-ip-aggregation', dest='ip_aggregation_enabled',
+                           action='store_false',
+                           default=not (str(os.environ.get('IP_AGGREGATION_DISABLED', '')).lower() in
+                                        ['true', '1', 'y']) and Defaults.ip_aggregation_enabled,
+                           help=f"Default: {'IP aggregation enabled' if Defaults.ip_aggregation_enabled else 'IP aggregation disabled'}")
+
     m365_group = parser.add_argument_group('M365', 'Microsoft 365')
 
+    m365_group.add_argument('--web-service-url', dest='m365_web_service_url',
+                            default=os.environ.get('M365_WEB_SERVICE_URL', Defaults.m365_web_service_url),
+                            help=f"Default: '{Defaults.m365_web_service_url}'. ie: a local stand-in service, "
+                                 f"see 'python -m m365digester.StandIn -h'")
+
+    m365_group.add_argument('--http-timeout', dest='http_timeout', type=float,
+                            default=os.environ.get('HTTP_TIMEOUT', Defaults.http_timeout),
+                            help=f"Default: {Defaults.http_timeout}. Seconds to wait on connect and each read")
+
+    m365_group.add_argument('--http-retries', dest='http_retries', type=int,
+                            default=os.environ.get('HTTP_RETRIES', Defaults.http_retries),
+                            help=f"Default: {Defaults.http_retries}. Retries of connection errors, timeouts, 429 and "
+                                 f"5xx responses, with jittered exponential backoff")
+
+    m365_group.add_argument('--http-backoff', dest='http_backoff', type=float,
+                            default=os.environ.get('HTTP_BACKOFF', Defaults.http_backoff),
+                            help=f"Default: {Defaults.http_backoff}. Base of the backoff between retries in seconds, "
+                                 f"doubled on each retry up to {Defaults.http_backoff_max}")
+
     m365_group.add_argument('-i', '--client-request-id', dest='m365_request_guid',
                             default=os.environ.get('M365_REQUEST_ID', Defaults.m365_request_guid),
                             help=f"Default: (Generated for this host): {Defaults.m365_request_guid}")
 
-    m365_group.add_argument('-s', '--service-instance', dest='m365_service_instance_name',
+    m365_group.add_argument('-s', '--service-instance', dest='m365_service_instance_name', nargs="+",
                             choices=Defaults.m365_service_instance_options,
-                            default=os.environ.get('M365_SERVICE_INSTANCE', Defaults.m365_service_instance_name),
-                            help=f"Default: {Defaults.m365_service_instance_name}")
+                            default=str(os.environ.get('M365_SERVICE_INSTANCE',
+                                                       Defaults.m365_service_instance_name)).split(),
+                            help=f"Default: {Defaults.m365_service_instance_name}. Several instances are fetched "
+                                 f"concurrently and merged, ie: '-s Worldwide Germany USGovGCCHigh'")
+
+    env_data_cache_disabled = str(os.environ.get('DATA_CACHE_DISABLED', '')).lower() in ['true', '1', 'y']
+
+    m365_group.add_argument('-c', '--disable-cache', dest='data_cache_enabled',
+                            action='store_false',
+                            default=Defaults.data_cache_enabled and not env_data_cache_disabled,
+                            help=f"Default: {'Endpoint cache enabled' if Defaults.data_cache_enabled else 'Endpoint cache disabled'}")
+
+    m365_group.add_argument('--data-cache-path', dest='data_cache_path',
+                            default=os.environ.get('DATA_CACHE_PATH', Defaults.data_cache_path),
+                            help=f"Default: '{Defaults.data_cache_path}'")
+
+    m365_group.add_argument('-f', '--force-refresh', dest='force_refresh',
+                            action='store_true',
+                            default=str(os.environ.get('FORCE_REFRESH', '')).lower() in ['true', '1', 'y'],
+                            help="Default: False (cached endpoint set used when the M365 version is unchanged)")
+
+    m365_group.add_argument('-S', '--streaming', dest='streaming_enabled',
+                            action='store_true',
+                            default=str(os.environ.get('STREAMING', '')).lower() in ['true', '1', 'y'],
+                            help="Default: False. Parse endpoint sets one object at a time instead of loading the "
+                                 "whole response, to bound memory use on very large inputs")
 
     env_extra_known_domains = None
     if os.environ.get('EXTRA_KNOWN_DOMAINS', None):
@@ -182,10 +242,17 @@ def main():
 
     acl_group.add_argument('-x', '--exclude-addresses', dest='exclude_addresses', nargs="+",
                            default=env_exclude_addresses,
-                           help="Default: Empty. Use for excluding addresses from consideration.")
+                           help="Default: Empty. Use for excluding addresses from consideration. '.example.com' or "
+                                "'*.example.com' excludes the domain and everything below it, a CIDR network the IP "
+                                "rules inside it, and anything else only an equal entry")
 
     file_group = parser.add_argument_group('IO', 'File IO')
 
+    file_group.add_argument('--input-file', dest='endpoint_file_paths', nargs="+",
+                            default=str(os.environ.get('INPUT_FILE')).split() if os.environ.get('INPUT_FILE') else None,
+                            help="Default: None (M365 web service used). Read endpoint sets from these files, "
+                                 "ie: archived '/endpoints' responses, instead of the M365 web service")
+
     file_group.add_argument('-u', '--output-path', dest='output_path',
                             default=os.environ.get('OUTPUT_PATH', Defaults.output_path),
                             help=f"Default: './'. Mutually exclusive with -o")
@@ -199,19 +266,99 @@ def main():
                             help=f"Default: '{Defaults.output_file_prefix}.EXT' "
                                  f"where EXT is decided by output type. Mutually exclusive with -p and -u")
 
-    file_group.add_argument('-t', '--output-type', dest='output_type', type=str.lower,
-                            choices=Defaults.output_types_available,
-                            default=os.environ.get('OUTPUT_TYPE', Defaults.output_type),
-                            help=f"Default: {Defaults.output_type}")
+    file_group.add_argument('-t', '--output-type', dest='output_type', nargs="+",
+                            default=str(os.environ.get('OUTPUT_TYPE', Defaults.output_type)).split(),
+                            help=f"Default: {Defaults.output_type}. One or more of: "
+                                 f"{' '.join(Defaults.output_types_available)}, each optionally with its own "
+                                 f"target as 'TYPE=PATH'. All outputs are rendered concurrently from one digest, "
+                                 f"ie: '-t squidconfig=./m365.conf generalcsv'")
 
-    file_group.add_argument('--output-template', dest='output_template',
-                            default=os.environ.get('OUTPUT_TEMPLATE', None),
-                            help="Default: None. Not used by all output types")
+    file_group.add_argument('--output-template', dest='output_template', nargs="+",
+                            default=str(os.environ.get('OUTPUT_TEMPLATE')).split()
+                            if os.environ.get('OUTPUT_TEMPLATE') else None,
+                            help="Default: None. Not used by all output types. 'PATH' for every output type "
+                                 "using templates, or 'TYPE=PATH' for one type")
 
     file_group.add_argument('--linesep', dest='linesep', type=LineSeparator.from_string,
                             default=os.environ.get('LINESEP', Defaults.linesep),
                             choices=list(LineSeparator), help="Default: OS_DEFAULT (os.linesep)")
 
+    delta_group = parser.add_argument_group('Delta', 'Entries added and removed since the previous run')
+
+    delta_group.add_argument('--delta', dest='output_delta_enabled', action='store_true',
+                             default=str(os.environ.get('OUTPUT_DELTA', '')).lower() in ['true', '1', 'y'],
+                             help=f"Default: False. Outputs supporting it (generalcsv, nftables, ipset) also write "
+                                  f"only the entries added and removed since the previous run, beside the full output. "
+                                  f"The general CSV delta is 'PATH{Defaults.output_delta_file_suffix}', the nftables and "
+                                  f"ipset ones the element updates 'PATH.update', also written without --delta")
+
+    delta_group.add_argument('--delta-previous', dest='output_delta_previous_path',
+                             default=os.environ.get('OUTPUT_DELTA_PREVIOUS', None),
+                             help="Default: None (the delta state). Rule list to compare against, as a delta state "
+                                  "JSON file or a general CSV output")
+
+    delta_group.add_argument('--delta-state', dest='output_delta_state_path',
+                             default=os.environ.get('OUTPUT_DELTA_STATE', None),
+                             help=f"Default: '{Defaults.output_file_prefix}.{Defaults.output_delta_state_extension}' "
+                                  f"in the output path. The rule list of each run is kept here for the next one")
+
+    profile_group = parser.add_argument_group('Profiles', 'Several configurations from one fetch')
+
+    profile_group.add_argument('--profile-file', dest='profile_file_path',
+                               default=os.environ.get('PROFILE_FILE', None),
+                               help="Default: None. JSON file of profiles, each with its own settings and outputs. "
+                                    "Every endpoint set is fetched once, then each profile is digested and rendered "
+                                    "in parallel across a process pool")
+
+    profile_group.add_argument('--profile-workers', dest='profile_workers', type=int,
+                               default=os.environ.get('PROFILE_WORKERS', None),
+                               help="Default: number of CPUs. Processes digesting profiles at once")
+
+    pac_group = parser.add_argument_group('PAC', "Proxy auto-config output ('-t pac')")
+
+    pac_group.add_argument('--pac-match-route', dest='pac_match_route',
+                           default=os.environ.get('PAC_MATCH_ROUTE', Defaults.pac_match_route),
+                           help=f"Default: '{Defaults.pac_match_route}'. Returned for M365 destinations")
+
+    pac_group.add_argument('--pac-default-route', dest='pac_default_route',
+                           default=os.environ.get('PAC_DEFAULT_ROUTE', Defaults.pac_default_route),
+                           help="Default: DIRECT, with a warning. Returned for every other destination, "
+                                "ie: 'PROXY proxy.example.com:3128; DIRECT'")
+
+    pac_group.add_argument('--pac-resolve-hosts', dest='pac_resolve_hosts',
+                           action='store_true',
+                           default=str(os.environ.get('PAC_RESOLVE_HOSTS', '')).lower() in ['true', '1', 'y'],
+                           help="Default: False (only IP address hosts are checked against IP rules). Resolve host "
+                                "names matching no domain rule, and check their address against the IP rules")
+
+    firewall_group = parser.add_argument_group('Firewall sets', "nftables and ipset output ('-t nftables ipset')")
+
+    firewall_group.add_argument('--nftables-table', dest='nftables_table',
+                                default=os.environ.get('NFTABLES_TABLE', Defaults.nftables_table),
+                                help=f"Default: '{Defaults.nftables_table}'. Name of the "
+                                     f"'{Defaults.nftables_table_family}' table holding the named sets")
+
+    firewall_group.add_argument('--ipset-max-elements', dest='ipset_max_elements', type=int,
+                                default=os.environ.get('IPSET_MAX_ELEMENTS', Defaults.ipset_max_elements),
+                                help=f"Default: {Defaults.ipset_max_elements}. 'maxelem' of each ipset set")
+
+    metrics_group = parser.add_argument_group('Metrics', 'Per-phase timings, row counts and peak memory')
+
+    metrics_group.add_argument('--metrics-json', dest='metrics_json_path',
+                               default=os.environ.get('METRICS_JSON', None),
+                               help="Default: None. Write a JSON metrics report of the run to this file")
+
+    metrics_group.add_argument('--metrics-prometheus', dest='metrics_prometheus_path',
+                               default=os.environ.get('METRICS_PROMETHEUS', None),
+                               help="Default: None. Write metrics of the run to this Prometheus textfile collector "
+                                    "file, ie: '/var/lib/node_exporter/textfile_collector/m365digester.prom'")
+
+    metrics_group.add_argument('--metrics-trace-memory', dest='metrics_trace_memory',
+                               action='store_true',
+                               default=str(os.environ.get('METRICS_TRACE_MEMORY', '')).lower() in ['true', '1', 'y'],
+                               help="Default: False (process peak RSS). Measure the peak Python heap of each phase "
+                                    "with tracemalloc, which slows the run down")
+
     args = parser.parse_args()
     # args = parser.parse_args(['-h'])
     # FIXME: Debugging
@@ -295,15 +442,23 @@ def main():
             config.setdefault('sqlitedb_context', SQLiteContext.MEMORY)
             config['keep_sqlitedb'] = False
 
-    output_plugin = None
-    output_type = config.get('output_type', Defaults.output_type).lower()
+    if config.get('profile_file_path', None):
+        root_logger.debug(f"Config: {pformat(config)}")
+        try:
+            profile_results = ProfileRunner(config, root_logger).run()
+            exit_code = 0 if all(not profile_result.exit_code and not profile_result.error and
+                                 all(output_result.success for output_result in profile_result.output_results)
+                                 for profile_result in profile_results) else 1
+        except Exception as e:
+            root_logger.error(f"Exception during profile execution: {e.__class__.__name__} {e}")
+            exit_code = 1
+        exit(exit_code)
 
-    if output_type == 'puppetsquid':
-        output_plugin = PuppetSquid(config, root_logger)
-    elif output_type == 'squidconfig':
-        output_plugin = SquidConfig(config, root_logger)
-    else: # output_type == 'generalcsv':
-        output_plugin = GeneralCSV(config, root_logger)
+    output_runner = OutputRunner(config, root_logger)
+    try:
+        output_runner.get_output_jobs()
+    except ValueError as e:
+        parser.error(str(e))
 
     exit_code = 0
 
@@ -315,7 +470,7 @@ def main():
         exit_code = app.main()
     except Exception as e:
         root_logger.error(f"Exception during M365 API digester execution: {e}")
-        exit(exit_code if exit_code > 0 else 1)
+        exit_code = exit_code if exit_code > 0 else 1
 
     if not exit_code:
         if not app.rule_list:
@@ -324,21 +479,27 @@ def main():
             if len(app.rule_list) == 0:
                 root_logger.warning('Rule list returned through this configuration contains zero entries')
             else:
-                if output_plugin:
-                    try:
-                        output_file = config.get('output_file', None)
-                        if not output_file:
-                            prefix = config.get('output_file_prefix', Defaults.output_file_prefix)
-                            extension = output_plugin.get_file_extension()
-                            output_path = config.get('output_path', Defaults.output_path)
-                            output_file = os.path.join(output_path, str(prefix + '.' + extension))
-
-                        output_plugin.set_input(app.rule_list)
-                        output_plugin.set_target_file_path(output_file)
-                        output_plugin.run()
-                    except Exception as e:
-                        root_logger.error(f"Exception during output plugin execution: {e.__class__.__name__} {e}")
+                try:
+                    output_results = output_runner.run(app.rule_list, app.metrics, app.api_versions)
+                    if not all(output_result.success for output_result in output_results):
                         exit_code = 1
+                except Exception as e:
+                    root_logger.error(f"Exception during output plugin execution: {e.__class__.__name__} {e}")
+                    exit_code = 1
+
+    app.metrics.counters['success'] = 0 if exit_code else 1
+    metrics_json_path = config.get('metrics_json_path', None)
+    metrics_prometheus_path = config.get('metrics_prometheus_path', None)
+    try:
+        if metrics_json_path:
+            app.metrics.write_json(metrics_json_path)
+            root_logger.info(f"Wrote metrics report to '{metrics_json_path}'")
+        if metrics_prometheus_path:
+            app.metrics.write_prometheus(metrics_prometheus_path)
+            root_logger.info(f"Wrote Prometheus metrics to '{metrics_prometheus_path}'")
+    except Exception as e:
+        root_logger.error(f"Unable to write metrics. Error: {e.__class__.__name__} {e}")
+        exit_code = exit_code if exit_code > 0 else 1
 
     exit(exit_code)
 
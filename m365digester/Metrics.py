@@ -0,0 +1,209 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then only recorded when tracing with tracemalloc
+    resource = None
+
+# tracemalloc is process wide, so it is started by the first run tracing memory and stopped by the last
+_tracing_lock = threading.Lock()
+_tracing_runs = 0
+_tracing_started = False
+
+
+class Phase(object):
+    """
+    Measurements of one phase of a run: wall time, rows handled, and peak memory in bytes
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = 0.0
+        self.rows = None
+        self.peak_memory_bytes = None
+
+    def as_dict(self) -> dict:
+        return {'seconds': round(self.seconds, 6), 'rows': self.rows, 'peak_memory_bytes': self.peak_memory_bytes}
+
+
+class Metrics(object):
+    """
+    Per-phase timings and counters for a run, which can be written as a JSON report or a Prometheus textfile collector
+    file. Numeric 'counters' and any 'labels' go to both, free form 'details' to the JSON report only
+
+    With 'trace_memory' the peak Python heap use of each phase is measured with tracemalloc, which slows the run down.
+    Otherwise the peak memory recorded is the process resident set size high-water mark at the end of the phase. Both
+    are process wide, so the peaks of runs measured concurrently include each other's use
+    """
+
+    prometheus_prefix = 'm365digester'
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.started = time.time()
+        self.total_seconds = 0.0
+        self.counters = dict()
+        self.labels = dict()
+        self.details = dict()
+        self.__phases = dict()
+        self.__lock = threading.Lock()
+        self.__tracing = False
+
+    @property
+    def phases(self) -> dict:
+        return dict(self.__phases)
+
+    def start(self):
+        """
+        Start timing the whole run
+        """
+        global _tracing_runs, _tracing_started
+        self.started = time.time()
+        if self.trace_memory and not self.__tracing:
+            with _tracing_lock:
+                if _tracing_runs == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _tracing_started = True
+                _tracing_runs += 1
+            self.__tracing = True
+
+    def stop(self):
+        """
+        Stop timing the whole run
+        """
+        global _tracing_runs, _tracing_started
+        self.total_seconds = time.time() - self.started
+        if self.__tracing:
+            with _tracing_lock:
+                _tracing_runs -= 1
+                if _tracing_runs == 0 and _tracing_started:
+                    tracemalloc.stop()
+                    _tracing_started = False
+            self.__tracing = False
+
+    def phase(self, name: str):
+        """
+        Context manager measuring a phase. Set 'rows' on the object it returns to record the rows handled. Measuring a
+        phase again adds to its time and rows
+        """
+        return _PhaseTimer(self, name)
+
+    def add_phase(self, name: str, seconds: float, rows: int = None, peak_memory_bytes: int = None):
+        """
+        Record a phase measured elsewhere (ie: in another thread), adding to any time and rows already recorded
+        """
+        with self.__lock:
+            phase = self.__phases.setdefault(name, Phase(name))
+            phase.seconds += seconds
+            if rows is not None:
+                phase.rows = (phase.rows or 0) + rows
+            if peak_memory_bytes is not None:
+                phase.peak_memory_bytes = max(phase.peak_memory_bytes or 0, peak_memory_bytes)
+
+    def get_peak_memory_bytes(self):
+        if self.trace_memory and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[1]
+        if resource:
+            # Linux reports kilobytes, macOS reports bytes
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024
+        return None
+
+    def reset_peak_memory(self):
+        if self.trace_memory and tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def as_dict(self) -> dict:
+        return {
+            'started': self.started,
+            'total_seconds': round(self.total_seconds, 6),
+            'labels': dict(self.labels),
+            'counters': dict(self.counters),
+            'details': dict(self.details),
+            'phases': {name: phase.as_dict() for name, phase in self.__phases.items()},
+        }
+
+    def write_json(self, file_path: str):
+        self._write_atomic(file_path, json.dumps(self.as_dict(), indent=2) + '\n')
+
+    def get_prometheus_text(self) -> str:
+        """
+        Render the metrics in the Prometheus text exposition format, all as gauges
+        """
+        prefix = self.prometheus_prefix
+        labels = ''.join(f',{key}="{self._escape_label(value)}"' for key, value in sorted(self.labels.items()))
+        run_labels = '{' + labels[1:] + '}' if labels else ''
+        lines = list()
+
+        def add_gauge(name: str, help_text: str, samples: list):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for sample_labels, value in samples:
+                lines.append(f"{prefix}_{name}{sample_labels} {value}")
+
+        add_gauge('last_run_timestamp_seconds', 'Unix time the last run started', [(run_labels, self.started)])
+        add_gauge('run_duration_seconds', 'Wall time of the last run', [(run_labels, round(self.total_seconds, 6))])
+        for counter_name, value in sorted(self.counters.items()):
+            if value is None:
+                continue
+            add_gauge(counter_name, f"Counter '{counter_name}' from the last run", [(run_labels, int(value))])
+
+        phases = list(self.__phases.values())
+        phase_labels = {phase.name: '{phase="' + self._escape_label(phase.name) + '"' + labels + '}'
+                        for phase in phases}
+        add_gauge('phase_duration_seconds', 'Wall time of each phase of the last run',
+                  [(phase_labels[phase.name], round(phase.seconds, 6)) for phase in phases])
+        add_gauge('phase_rows', 'Rows handled by each phase of the last run',
+                  [(phase_labels[phase.name], phase.rows) for phase in phases if phase.rows is not None])
+        add_gauge('phase_peak_memory_bytes', 'Peak memory during each phase of the last run',
+                  [(phase_labels[phase.name], phase.peak_memory_bytes) for phase in phases
+                   if phase.peak_memory_bytes is not None])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_path: str):
+        """
+        Write a textfile collector file. It is renamed into place, so the collector never reads a partial file
+        """
+        self._write_atomic(file_path, self.get_prometheus_text())
+
+    @staticmethod
+    def _escape_label(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _write_atomic(file_path: str, text: str):
+        file_handle, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)),
+                                                       suffix='.tmp')
+        try:
+            with os.fdopen(file_handle, mode='w') as temp_file_handle:
+                temp_file_handle.write(text)
+            os.chmod(temp_file_path, 0o644)
+            os.replace(temp_file_path, file_path)
+        except Exception:
+            os.remove(temp_file_path)
+            raise
+
+
+class _PhaseTimer(object):
+
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+        self.rows = None
+        self.__started = None
+
+    def __enter__(self):
+        self.metrics.reset_peak_memory()
+        self.__started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_phase(self.name, time.perf_counter() - self.__started, self.rows,
+                               self.metrics.get_peak_memory_bytes())
+        return False
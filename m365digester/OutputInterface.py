@@ -9,5 +9,24 @@ class OutputInterface:
     def get_file_extension(self) -> str:
         pass
 
+    def set_previous_input(self, previous_rule_list: dict) -> bool:
+        """
+        Rule list of the previous run, for plugins that write only the changes beside their full output. Returns False
+        when the plugin writes no delta
+        """
+        pass
+
+    def get_output_hash(self) -> str:
+        """
+        SHA-256 hex digest of the output last published by run()
+        """
+        pass
+
+    def get_output_changed(self) -> bool:
+        """
+        True if the last run() replaced the target file, False if its content was already identical
+        """
+        pass
+
     def run(self) -> bool:
         pass
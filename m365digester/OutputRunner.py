@@ -0,0 +1,221 @@
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .Base import Base
+from .Lib import Defaults
+from .Metrics import Metrics
+from .Outputs.GeneralCSV import GeneralCSV
+from .Outputs.IpSet import IpSet
+from .Outputs.MatcherIndex import MatcherIndex
+from .Outputs.NfTables import NfTables
+from .Outputs.PacFile import PacFile
+from .Outputs.PuppetSquid import PuppetSquid
+from .Outputs.RuleSetBinary import RuleSetBinary
+from .Outputs.SquidConfig import SquidConfig
+from .RuleDelta import get_rule_list_delta, read_rule_list, save_rule_list
+
+# Outcome of one output plugin run. 'output_hash' and 'changed' are None when the plugin failed, 'error' is None when
+# it succeeded
+OutputResult = namedtuple('OutputResult', ['output_type', 'target_file_path', 'success', 'output_hash', 'changed',
+                                           'elapsed', 'error'])
+
+
+class OutputRunner(Base):
+    """
+    Fan a digested rule list out to several output plugins, run concurrently, each with its own target file and
+    template
+
+    Output types are given as 'TYPE' or 'TYPE=PATH', ie: ['generalcsv', 'squidconfig=/etc/squid/m365.conf'], and
+    templates as 'PATH' for every templated type or 'TYPE=PATH' for one type
+
+    In delta mode the rule list is compared with the previous run's, and outputs supporting it also write the entries
+    added and removed beside their full output
+    """
+
+    output_plugins = {
+        'generalcsv': GeneralCSV,
+        'puppetsquid': PuppetSquid,
+        'squidconfig': SquidConfig,
+        'matcherindex': MatcherIndex,
+        'pac': PacFile,
+        'nftables': NfTables,
+        'ipset': IpSet,
+        'ruleset': RuleSetBinary,
+    }
+
+    __output_jobs = None
+
+    @staticmethod
+    def as_list(value) -> list:
+        if not value:
+            return list()
+        if isinstance(value, str):
+            return value.split()
+        return list(value)
+
+    def parse_output_spec(self, output_spec: str) -> (str, str):
+        """
+        Split 'TYPE=PATH' into (type, path). A value without a known type before the '=' is taken as a bare path
+        """
+        output_type, separator, path = str(output_spec).partition('=')
+        if separator and output_type.lower() in self.output_plugins:
+            return output_type.lower(), path or None
+        return None, output_spec
+
+    def get_output_specs(self) -> list:
+        """
+        Get (output_type, target_file_path, template_file_path) for each requested output, in the order requested.
+        'target_file_path' is None where the default path should be used
+        """
+        templates = dict()
+        default_template = None
+        for template_spec in self.as_list(self.config.get('output_template', None)):
+            output_type, template_file_path = self.parse_output_spec(template_spec)
+            if output_type:
+                templates[output_type] = template_file_path
+            else:
+                default_template = template_file_path
+
+        output_specs = list()
+        for output_spec in self.as_list(self.config.get('output_type', Defaults.output_type)):
+            output_type, target_file_path = self.parse_output_spec(output_spec)
+            if not output_type:
+                output_type, target_file_path = str(output_spec).lower(), None
+            if output_type not in self.output_plugins:
+                raise ValueError(f"Unknown output type '{output_type}', "
+                                 f"choose from: {', '.join(self.output_plugins)}")
+            output_specs.append((output_type, target_file_path, templates.get(output_type, default_template)))
+        return output_specs
+
+    def get_output_jobs(self) -> list:
+        """
+        Get (output_type, target_file_path, template_file_path) for each requested output, with default target paths
+        filled in. Raises ValueError for an unknown type or outputs sharing a target file, so it can be called before
+        the digest runs
+        """
+        if self.__output_jobs is not None:
+            return self.__output_jobs
+        output_specs = self.get_output_specs()
+        single_output = len(output_specs) == 1
+        jobs = list()
+        for output_type, target_file_path, template_file_path in output_specs:
+            if not target_file_path:
+                extension = self.output_plugins[output_type](self.config).get_file_extension()
+                target_file_path = self.get_default_target_file_path(extension, single_output)
+            jobs.append((output_type, target_file_path, template_file_path))
+
+        target_file_paths = [os.path.abspath(target_file_path)
+                             for output_type, target_file_path, template_file_path in jobs]
+        if len(set(target_file_paths)) != len(target_file_paths):
+            raise ValueError(f"Several outputs share a target file path: {', '.join(target_file_paths)}")
+        self.__output_jobs = jobs
+        return jobs
+
+    def get_default_target_file_path(self, extension: str, single_output: bool) -> str:
+        """
+        Target file path for an output without its own path. '-o' only applies when there is a single output
+        """
+        output_file = self.config.get('output_file', None)
+        if output_file:
+            if single_output:
+                return output_file
+            self.warning(f"Output file '{output_file}' ignored with several output types, "
+                         f"set a path per type as 'TYPE=PATH' instead")
+        prefix = self.config.get('output_file_prefix', Defaults.output_file_prefix)
+        output_path = self.config.get('output_path', Defaults.output_path)
+        return os.path.join(output_path, str(prefix + '.' + extension))
+
+    def get_delta_state_file_path(self) -> str:
+        """
+        State file keeping the rule list of each run in delta mode, by default beside the outputs
+        """
+        state_file_path = self.config.get('output_delta_state_path', None)
+        if state_file_path:
+            return state_file_path
+        prefix = self.config.get('output_file_prefix', Defaults.output_file_prefix)
+        output_path = self.config.get('output_path', Defaults.output_path)
+        return os.path.join(output_path, f"{prefix}.{Defaults.output_delta_state_extension}")
+
+    def load_previous_rule_list(self) -> dict:
+        """
+        Rule list to compare against in delta mode: the file set as 'output_delta_previous_path', else the state kept
+        by the last run. None when neither exists, so every entry counts as added
+        """
+        previous_file_path = self.config.get('output_delta_previous_path', None)
+        if previous_file_path:
+            return read_rule_list(previous_file_path)
+        state_file_path = self.get_delta_state_file_path()
+        try:
+            return read_rule_list(state_file_path)
+        except FileNotFoundError:
+            self.info(f"No delta state in '{state_file_path}' yet, every entry is written as added")
+            return None
+
+    def run_output(self, output_type: str, target_file_path: str, template_file_path: str,
+                   rule_list: dict, api_versions: dict = None, previous_rule_list: dict = None) -> OutputResult:
+        """
+        Run a single output plugin, catching any failure into the result so other outputs carry on
+        """
+        started = time.perf_counter()
+        try:
+            config = dict(self.config)
+            config['output_template'] = template_file_path
+            config['api_versions'] = dict(api_versions or dict())
+            output_plugin = self.output_plugins[output_type](config, self.logger)
+            output_plugin.set_input(rule_list)
+            output_plugin.set_target_file_path(target_file_path)
+            if previous_rule_list is not None:
+                output_plugin.set_previous_input(previous_rule_list)
+            output_plugin.run()
+            return OutputResult(output_type, target_file_path, True, output_plugin.get_output_hash(),
+                                output_plugin.get_output_changed(), time.perf_counter() - started, None)
+        except Exception as e:
+            return OutputResult(output_type, target_file_path, False, None, None, time.perf_counter() - started,
+                                f"{e.__class__.__name__} {e}")
+
+    def run(self, rule_list: dict, metrics: Metrics = None, api_versions: dict = None) -> list:
+        """
+        Render 'rule_list' with every requested output plugin concurrently. Returns an OutputResult per output, in the
+        order requested. Each output is recorded as an 'output:TYPE' phase in 'metrics', if given. 'api_versions'
+        (service instance -> endpoint version) is passed to the plugins that record it. In delta mode the rule list is
+        kept as the state for the next run once every output has succeeded
+        """
+        jobs = self.get_output_jobs()
+
+        delta_enabled = self.config.get('output_delta_enabled', Defaults.output_delta_enabled)
+        previous_rule_list = None
+        if delta_enabled:
+            previous_rule_list = self.load_previous_rule_list()
+            added, removed = get_rule_list_delta(previous_rule_list or dict(), rule_list)
+            added_count = sum(len(acl_addresses) for acl_addresses in added.values())
+            removed_count = sum(len(acl_addresses) for acl_addresses in removed.values())
+            self.info(f"Delta since the previous run: {added_count} entries added, {removed_count} removed")
+            if metrics is not None:
+                metrics.counters.update({'delta_added': added_count, 'delta_removed': removed_count})
+
+        with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as executor:
+            futures = [executor.submit(self.run_output, output_type, target_file_path, template_file_path, rule_list,
+                                       api_versions, previous_rule_list)
+                       for output_type, target_file_path, template_file_path in jobs]
+            results = [future.result() for future in futures]
+
+        rule_count = sum(len(acl_addresses) for acl_addresses in rule_list.values())
+        for result in results:
+            if metrics is not None:
+                metrics.add_phase(f"output:{result.output_type}", result.elapsed, rule_count)
+            if result.success:
+                self.info(f"Output '{result.output_type}' to '{result.target_file_path}' "
+                          f"{'published' if result.changed else 'unchanged'} in {result.elapsed:.3f}s, "
+                          f"sha256: {result.output_hash}")
+            else:
+                self.error(f"Output '{result.output_type}' to '{result.target_file_path}' failed: {result.error}")
+
+        # A failed output keeps the old state, so its changes are written again by the next run
+        if delta_enabled and all(result.success for result in results):
+            state_file_path = self.get_delta_state_file_path()
+            save_rule_list(state_file_path, rule_list, api_versions,
+                           self.config.get('output_buffer_size', Defaults.output_buffer_size))
+            self.info(f"Kept rule list as delta state in '{state_file_path}'")
+        return results
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import shutil
+import uuid
+from string import Template
+
+from .Lib import Defaults
+
+# Bytes read per step when hashing a file
+_hash_read_size = 1024 * 1024
+
+
+def write_chunks(target_file_handle, chunks, buffer_size: int = Defaults.output_buffer_size) -> int:
+    """
+    Write an iterable of strings to 'target_file_handle', joining them into blocks of about 'buffer_size' characters so
+    the file is written with a few large calls rather than one per line. Returns the number of characters written.
+    Chunks of bytes are written the same way to a file opened in binary mode
+    """
+    written = 0
+    buffer = list()
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= buffer_size:
+            target_file_handle.write(buffer[0][:0].join(buffer))
+            written += buffered
+            buffer.clear()
+            buffered = 0
+    if buffer:
+        target_file_handle.write(buffer[0][:0].join(buffer))
+        written += buffered
+    return written
+
+
+def get_file_hash(file_path: str):
+    """
+    Get the SHA-256 hex digest of the file 'file_path', or None if it doesn't exist
+    """
+    file_hash = hashlib.sha256()
+    try:
+        with open(file_path, mode='rb') as file_handle:
+            for block in iter(lambda: file_handle.read(_hash_read_size), b''):
+                file_hash.update(block)
+    except FileNotFoundError:
+        return None
+    return file_hash.hexdigest()
+
+
+def publish_chunks(target_file_path: str, chunks, buffer_size: int = Defaults.output_buffer_size,
+                   binary: bool = False) -> (str, bool):
+    """
+    Write an iterable of strings to a temporary file beside 'target_file_path', then atomically rename it into place
+    only if its content differs from the existing target, so an unchanged output keeps its mtime and readers never see
+    a partly written file. Returns the SHA-256 hex digest of the content and whether the target was replaced. With
+    'binary' the chunks are bytes
+    """
+    target_dir_path = os.path.dirname(os.path.abspath(target_file_path))
+    # Created with open() rather than tempfile, so a new target gets the usual umask permissions
+    temp_file_path = os.path.join(target_dir_path, f".{os.path.basename(target_file_path)}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_file_path, mode='xb' if binary else 'x') as temp_file_handle:
+            write_chunks(temp_file_handle, chunks, buffer_size)
+
+        content_hash = get_file_hash(temp_file_path)
+        if content_hash == get_file_hash(target_file_path):
+            os.remove(temp_file_path)
+            return content_hash, False
+
+        if os.path.exists(target_file_path):
+            shutil.copymode(target_file_path, temp_file_path)
+        os.replace(temp_file_path, target_file_path)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+    return content_hash, True
+
+
+def iter_template(template: str, substitutes: dict):
+    """
+    Yield the rendering of a string.Template in chunks, following the same rules as Template.substitute
+
+    A substitute value may be a string, an iterable of strings, or a callable returning one. Iterables are streamed in
+    place of their placeholder, so a large section is never built as one string. Placeholders are checked before
+    anything is yielded, so a missing substitute or bad placeholder doesn't leave a partial rendering behind
+    """
+    matches = list(Template.pattern.finditer(template))
+    for match in matches:
+        name = match.group('named') or match.group('braced')
+        if name is not None:
+            if name not in substitutes:
+                raise KeyError(name)
+        elif match.group('escaped') is None:
+            line_number = template.count('\n', 0, match.start('invalid')) + 1
+            raise ValueError(f"Invalid placeholder in template: line {line_number}")
+
+    return _iter_template_chunks(template, matches, substitutes)
+
+
+def _iter_template_chunks(template: str, matches: list, substitutes: dict):
+    position = 0
+    for match in matches:
+        yield template[position:match.start()]
+        position = match.end()
+        name = match.group('named') or match.group('braced')
+        if name is None:
+            yield Template.delimiter
+            continue
+        value = substitutes[name]
+        if callable(value):
+            value = value()
+        if isinstance(value, str):
+            yield value
+        elif hasattr(value, '__iter__'):
+            yield from value
+        else:
+            yield str(value)
+    yield template[position:]
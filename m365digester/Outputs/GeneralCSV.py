@@ -2,13 +2,19 @@
 #
 # Outputs a general purpose CSV file
 from m365digester.Base import Base
+from m365digester.Lib import Defaults
 from m365digester.OutputInterface import OutputInterface
+from m365digester.OutputWriter import publish_chunks
+from m365digester.RuleDelta import get_rule_list_delta
 
 
 class GeneralCSV(Base, OutputInterface):
 
     __rule_list = dict()
     __target_file_path = ''
+    __output_hash = None
+    __output_changed = False
+    __previous_rule_list = None
 
     def set_input(self, rule_list: dict) -> bool:
         # FIXME: Validate rule_list is viable?
@@ -23,6 +29,16 @@ class GeneralCSV(Base, OutputInterface):
     def get_file_extension(self) -> str:
         return 'csv'
 
+    def set_previous_input(self, previous_rule_list: dict) -> bool:
+        self.__previous_rule_list = previous_rule_list
+        return True
+
+    def get_output_hash(self) -> str:
+        return self.__output_hash
+
+    def get_output_changed(self) -> bool:
+        return self.__output_changed
+
     def run(self) -> bool:
         """
         Output the ACL's in 'rule_list' to the 'target_file_path' in general CSV format
@@ -33,25 +49,58 @@ class GeneralCSV(Base, OutputInterface):
         if not self.__target_file_path:
             raise Exception('Target file path not set')
 
-        self.info(f"Writing general csv file to: '{self.__target_file_path}'")
+        self.info(f"Rendering general csv file for: '{self.__target_file_path}'")
+
+        self.__output_hash, self.__output_changed = publish_chunks(
+            self.__target_file_path, self.iter_lines(),
+            self.config.get('output_buffer_size', Defaults.output_buffer_size))
+        if self.__output_changed:
+            self.info(f"Published '{self.__target_file_path}', sha256: {self.__output_hash}")
+        else:
+            self.info(f"Unchanged '{self.__target_file_path}', sha256: {self.__output_hash}, left in place")
+
+        if self.config.get('output_delta_enabled', Defaults.output_delta_enabled):
+            delta_file_path = self.__target_file_path + Defaults.output_delta_file_suffix
+            added, removed = get_rule_list_delta(self.__previous_rule_list or dict(), self.__rule_list)
+            delta_hash, delta_changed = publish_chunks(
+                delta_file_path, self.iter_delta_lines(added, removed),
+                self.config.get('output_buffer_size', Defaults.output_buffer_size))
+            self.info(f"{'Published' if delta_changed else 'Unchanged'} '{delta_file_path}', "
+                      f"{sum(map(len, added.values()))} added, {sum(map(len, removed.values()))} removed, "
+                      f"sha256: {delta_hash}")
+
+        return True
+
+    @staticmethod
+    def get_acl_type_comment(service_area_name: str) -> (str, str):
+        if 'domain' in service_area_name:
+            return 'domain', f"M365 (Teams or OneDrive) destination domains ({service_area_name})"
+        return 'ip', f"M365 (Teams or OneDrive) destination ip addresses ({service_area_name})"
 
-        with open(self.__target_file_path, mode='w') as target_file_handle:
+    def iter_lines(self):
+        """
+        Yield the lines of the general CSV file one at a time
+        """
+        yield f"\"ACL_LIST_NAME\",\"DESTINATION\",\"ACL_TYPE\",\"COMMENT\"\n"
 
-            print(f"\"ACL_LIST_NAME\",\"DESTINATION\",\"ACL_TYPE\",\"COMMENT\"", file=target_file_handle)
+        for service_area_name in self.__rule_list:
+            acl_type, acl_comment = self.get_acl_type_comment(service_area_name)
+            for acl_destination in self.__rule_list[service_area_name]:
+                if not isinstance(acl_destination, str):
+                    raise Exception(f"ACL List destination found in rule list if not expected type: string. "
+                                    f"Found '{acl_destination.__class__.__name__}")
 
-            for service_area_name in self.__rule_list:
-                acl_comment = ''
-                acl_type = ''
-                if 'domain' in service_area_name:
-                    acl_type = 'domain'
-                    acl_comment = f"M365 (Teams or OneDrive) destination domains ({service_area_name})"
-                else:
-                    acl_type = 'ip'
-                    acl_comment = f"M365 (Teams or OneDrive) destination ip addresses ({service_area_name})"
-                for acl_destination in self.__rule_list[service_area_name]:
-                    if not isinstance(acl_destination, str):
-                        raise Exception(f"ACL List destination found in rule list if not expected type: string. "
-                                   f"Found '{acl_destination.__class__.__name__}")
+                yield f"\"{service_area_name}\",\"{acl_destination}\",\"{acl_type}\",\"{acl_comment}\"\n"
+
+    def iter_delta_lines(self, added: dict, removed: dict):
+        """
+        Yield the lines of the delta CSV file: each entry removed since the previous run, then each one added
+        """
+        yield f"\"ACTION\",\"ACL_LIST_NAME\",\"DESTINATION\",\"ACL_TYPE\",\"COMMENT\"\n"
 
-                    print(f"\"{service_area_name}\",\"{acl_destination}\",\"{acl_type}\",\"{acl_comment}\"",
-                          file=target_file_handle)
+        for action, delta in (('remove', removed), ('add', added)):
+            for service_area_name, acl_destinations in delta.items():
+                acl_type, acl_comment = self.get_acl_type_comment(service_area_name)
+                for acl_destination in acl_destinations:
+                    yield f"\"{action}\",\"{service_area_name}\",\"{acl_destination}\",\"{acl_type}\"," \
+                          f"\"{acl_comment}\"\n"
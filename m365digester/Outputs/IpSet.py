@@ -0,0 +1,117 @@
+#!/bin/env python
+#
+# Outputs the IP rules as ipset 'hash:net' sets in 'ipset restore' format, with an update script applying only the
+# elements added and removed since the last run, so the kernel sets are never flushed and rebuilt
+from m365digester.Base import Base
+from m365digester.FirewallSets import publish_sets
+from m365digester.Lib import Defaults
+from m365digester.OutputInterface import OutputInterface
+
+
+class IpSet(Base, OutputInterface):
+
+    __rule_list = dict()
+    __target_file_path = ''
+    __output_hash = None
+    __output_changed = False
+    __previous_rule_list = None
+
+    def set_input(self, rule_list: dict) -> bool:
+        self.__rule_list = rule_list
+        return True
+
+    def set_target_file_path(self, target_file_path: str) -> bool:
+        self.__target_file_path = target_file_path
+        return True
+
+    def get_file_extension(self) -> str:
+        return 'ipset'
+
+    def set_previous_input(self, previous_rule_list: dict) -> bool:
+        self.__previous_rule_list = previous_rule_list
+        return True
+
+    def get_output_hash(self) -> str:
+        return self.__output_hash
+
+    def get_output_changed(self) -> bool:
+        return self.__output_changed
+
+    @staticmethod
+    def read_sets(file_path: str) -> dict:
+        """
+        Sets in a file published by a previous run: {set name: (family, set of elements)}, or empty if there is no
+        such file
+        """
+        sets = dict()
+        try:
+            with open(file_path) as file_handle:
+                for line in file_handle:
+                    fields = line.split()
+                    if len(fields) >= 5 and fields[0] == 'create' and fields[3] == 'family':
+                        sets[fields[1]] = (6 if fields[4] == 'inet6' else 4, set())
+                    elif len(fields) >= 3 and fields[0] == 'add' and fields[1] in sets:
+                        sets[fields[1]][1].add(fields[2])
+        except FileNotFoundError:
+            pass
+        return sets
+
+    def run(self) -> bool:
+        """
+        Output the IP ACL's in 'rule_list' to the 'target_file_path' as an ipset restore file creating the sets, and
+        beside it an update script replacing their elements
+        """
+        if not self.__rule_list:
+            raise Exception('Rule list not set')
+
+        if not self.__target_file_path:
+            raise Exception('Target file path not set')
+
+        self.info(f"Rendering ipset restore file for: '{self.__target_file_path}'")
+        self.__output_hash, self.__output_changed = publish_sets(self, self.__target_file_path, self.__rule_list,
+                                                                 self.__previous_rule_list)
+        return True
+
+    def get_create_line(self, set_name: str, family: int) -> str:
+        linesep = self.config.get('linesep', Defaults.linesep).chars()
+        max_elements = self.config.get('ipset_max_elements', None) or Defaults.ipset_max_elements
+        ipset_family = 'inet' if family == 4 else 'inet6'
+        return f"create {set_name} hash:net family {ipset_family} maxelem {max_elements}{linesep}"
+
+    def iter_header_lines(self, sets: dict):
+        """
+        Yield the lines creating each set. With 'ipset -exist restore' existing sets are left as they are
+        """
+        linesep = self.config.get('linesep', Defaults.linesep).chars()
+        yield f"# M365 endpoint networks, generated by m365digester. Load with 'ipset -exist restore < FILE'{linesep}"
+        for set_name, (family, elements) in sets.items():
+            yield self.get_create_line(set_name, family)
+
+    def iter_lines(self, sets: dict):
+        """
+        Yield the lines of the ipset restore file defining every set, one element per line
+        """
+        linesep = self.config.get('linesep', Defaults.linesep).chars()
+        yield from self.iter_header_lines(sets)
+        for set_name, (family, elements) in sets.items():
+            for element in elements:
+                yield f"add {set_name} {element}{linesep}"
+
+    def iter_update_lines(self, sets: dict, changes: dict):
+        """
+        Yield the lines of the update script, from FirewallSets.get_set_changes(): the elements removed, then those
+        added. Loaded with 'ipset -exist restore', deleting an element a set lacks or adding one it holds is no error,
+        so it applies whatever the kernel sets hold. Sets no longer published are emptied rather than destroyed, as
+        rules may still refer to them
+        """
+        linesep = self.config.get('linesep', Defaults.linesep).chars()
+        all_sets = dict(sets)
+        all_sets.update((set_name, (family, list())) for set_name, (family, removed, added) in changes.items()
+                        if set_name not in sets)
+        yield from self.iter_header_lines(all_sets)
+        for set_name, (family, removed, added) in changes.items():
+            for element in removed:
+                yield f"del {set_name} {element}{linesep}"
+        for set_name, (family, removed, added) in changes.items():
+            for element in added:
+                yield f"add {set_name} {element}{linesep}"
@@ -0,0 +1,138 @@
+#!/bin/env python
+#
+# Outputs the IP rules as nftables named interval sets, with an update script applying only the elements added and
+# removed since the last run in one transaction, so the kernel sets are never flushed and rebuilt
+from m365digester.Base import Base
+from m365digester.FirewallSets import publish_sets
+from m365digester.Lib import Defaults
+from m365digester.OutputInterface import OutputInterface
+
+
+class NfTables(Base, OutputInterface):
+
+    __rule_list = dict()
+    __target_file_path = ''
+    __output_hash = None
+    __output_changed = False
+    __previous_rule_list = None
+
+    def set_input(self, rule_list: dict) -> bool:
+        self.__rule_list = rule_list
+        return True
+
+    def set_target_file_path(self, target_file_path: str) -> bool:
+        self.__target_file_path = target_file_path
+        return True
+
+    def get_file_extension(self) -> str:
+        return 'nft'
+
+    def set_previous_input(self, previous_rule_list: dict) -> bool:
+        self.__previous_rule_list = previous_rule_list
+        return True
+
+    def get_output_hash(self) -> str:
+        return self.__output_hash
+
+    def get_output_changed(self) -> bool:
+        return self.__output_changed
+
+    def get_table(self) -> str:
+        """
+        'family name' of the table holding the sets, ie: 'inet m365'
+        """
+        table_name = self.config.get('nftables_table', None) or Defaults.nftables_table
+        return f"{Defaults.nftables_table_family} {table_name}"
+
+    @staticmethod
+    def read_sets(file_path: str) -> dict:
+        """
+        Sets in a file published by a previous run: {set name: (family, set of elements)}, or empty if there is no
+        such file
+        """
+        sets = dict()
+        set_elements = None
+        try:
+            with open(file_path) as file_handle:
+                for line in file_handle:
+                    fields = line.split()
+                    if set_elements is not None:
+                        if fields == ['}']:
+                            set_elements = None
+                        elif fields:
+                            set_elements.add(fields[0].rstrip(','))
+                    # ie: 'add set inet m365 NAME { type ipv4_addr; flags interval; }'
+                    elif len(fields) >= 8 and fields[:2] == ['add', 'set'] and fields[6] == 'type':
+                        sets[fields[4]] = (6 if fields[7].startswith('ipv6') else 4, set())
+                    elif len(fields) >= 6 and fields[:2] == ['add', 'element'] and fields[-1] == '{' and \
+                            fields[4] in sets:
+                        set_elements = sets[fields[4]][1]
+        except FileNotFoundError:
+            pass
+        return sets
+
+    def run(self) -> bool:
+        """
+        Output the IP ACL's in 'rule_list' to the 'target_file_path' as an nftables script defining the sets, and
+        beside it an update script replacing their elements
+        """
+        if not self.__rule_list:
+            raise Exception('Rule list not set')
+
+        if not self.__target_file_path:
+            raise Exception('Target file path not set')
+
+        self.info(f"Rendering nftables sets for: '{self.__target_file_path}'")
+        self.__output_hash, self.__output_changed = publish_sets(self, self.__target_file_path, self.__rule_list,
+                                                                 self.__previous_rule_list)
+        return True
+
+    def iter_header_lines(self, sets: dict):
+        """
+        Yield the lines creating the table and each set, which leave them as they are if they already exist
+        """
+        linesep = self.config.get('linesep', Defaults.linesep).chars()
+        table = self.get_table()
+        yield f"#!/usr/sbin/nft -f{linesep}"
+        yield f"# M365 endpoint networks, generated by m365digester. Applied by 'nft -f' as one transaction{linesep}"
+        yield f"add table {table}{linesep}"
+        for set_name, (family, elements) in sets.items():
+            yield f"add set {table} {set_name} {{ type ipv{family}_addr; flags interval; }}{linesep}"
+
+    def iter_element_block(self, command: str, set_name: str, elements):
+        """
+        Yield a 'command element' block, ie: 'add element', one element per line. nft rejects an empty block
+        """
+        if not elements:
+            return
+        linesep = self.config.get('linesep', Defaults.linesep).chars()
+        yield f"{command} element {self.get_table()} {set_name} {{{linesep}"
+        for element in elements:
+            yield f"    {element},{linesep}"
+        yield f"}}{linesep}"
+
+    def iter_lines(self, sets: dict):
+        """
+        Yield the lines of the nftables script defining every set
+        """
+        yield from self.iter_header_lines(sets)
+        for set_name, (family, elements) in sets.items():
+            yield from self.iter_element_block('add', set_name, elements)
+
+    def iter_update_lines(self, sets: dict, changes: dict):
+        """
+        Yield the lines of the update script, from FirewallSets.get_set_changes(): the elements removed, then those
+        added. 'nft -f' applies it as one transaction, and it holds whatever the kernel sets hold: each removed element
+        is added first, so deleting one the set lacks can't abort the transaction, and adding an element the set
+        already holds is no error. Removals go first, so a network replaced by a wider one never overlaps it. Sets no
+        longer published are emptied rather than deleted, as rules may still refer to them
+        """
+        all_sets = dict(sets)
+        all_sets.update((set_name, (family, list())) for set_name, (family, removed, added) in changes.items()
+                        if set_name not in sets)
+        yield from self.iter_header_lines(all_sets)
+        for set_name, (family, removed, added) in changes.items():
+            yield from self.iter_element_block('add', set_name, removed)
+            yield from self.iter_element_block('delete', set_name, removed)
+        for set_name, (family, removed, added) in changes.items():
+            yield from self.iter_element_block('add', set_name, added)
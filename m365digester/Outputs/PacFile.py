@@ -0,0 +1,216 @@
+#!/bin/env python
+#
+# Outputs a proxy auto-config (PAC) file sending M365 destinations to their own route, ie: DIRECT
+import json
+
+from m365digester.Base import Base
+from m365digester.Lib import Defaults
+from m365digester.OutputInterface import OutputInterface
+from m365digester.OutputWriter import publish_chunks
+from m365digester.RuleMatcher import RuleMatcher
+
+# Values in the PAC domain table: the name itself only ('example.com'), or the name and every name below it
+# ('.example.com'). Both may be set for one name
+pac_domain_exact = 1
+pac_domain_subdomains = 2
+
+# Runs once per request in the browser, so the lookups are hash probes rather than one test per rule: the host's
+# labels are walked up through the domain table, and addresses are checked one prefix length at a time against
+# tables of network prefixes written as bit strings
+pac_functions = r"""
+function m365Ipv4Bits(ip) {
+    var parts = ip.split(".");
+    if (parts.length != 4) return null;
+    var bits = "";
+    for (var i = 0; i < 4; i++) {
+        if (!/^[0-9]{1,3}$/.test(parts[i])) return null;
+        var n = parseInt(parts[i], 10);
+        if (n > 255) return null;
+        var b = n.toString(2);
+        bits += "00000000".substring(b.length) + b;
+    }
+    return bits;
+}
+
+function m365Ipv6Bits(ip) {
+    if (ip.charAt(0) == "[") ip = ip.substring(1, ip.length - 1);
+    var zone = ip.indexOf("%");
+    if (zone >= 0) ip = ip.substring(0, zone);
+    var halves = ip.split("::");
+    if (halves.length > 2) return null;
+    var head = halves[0] ? halves[0].split(":") : [];
+    var tail = halves.length == 2 && halves[1] ? halves[1].split(":") : [];
+    var groups = halves.length == 2 ? tail : head;
+    var last = groups.length ? groups[groups.length - 1] : "";
+    if (last.indexOf(".") >= 0) {
+        var ipv4 = m365Ipv4Bits(last);
+        if (ipv4 === null) return null;
+        groups.splice(groups.length - 1, 1, parseInt(ipv4.substring(0, 16), 2).toString(16),
+                      parseInt(ipv4.substring(16), 2).toString(16));
+    }
+    if (halves.length == 2) {
+        if (head.length + tail.length > 7) return null;
+        var zeros = [];
+        for (var z = head.length + tail.length; z < 8; z++) zeros.push("0");
+        groups = head.concat(zeros, tail);
+    } else if (groups.length != 8) {
+        return null;
+    }
+    var bits = "";
+    for (var i = 0; i < 8; i++) {
+        if (!/^[0-9a-f]{1,4}$/.test(groups[i])) return null;
+        var b = parseInt(groups[i], 16).toString(2);
+        bits += "0000000000000000".substring(b.length) + b;
+    }
+    return bits;
+}
+
+function m365MatchNetwork(bits, networks, prefixLengths) {
+    for (var i = 0; i < prefixLengths.length; i++) {
+        if (networks[bits.substring(0, prefixLengths[i])] === 1) return true;
+    }
+    return false;
+}
+
+function m365MatchAddress(ip) {
+    var bits;
+    if (ip.indexOf(":") >= 0) {
+        bits = m365Ipv6Bits(ip);
+        return bits !== null && m365MatchNetwork(bits, m365Ipv6Networks, m365Ipv6PrefixLengths);
+    }
+    bits = m365Ipv4Bits(ip);
+    return bits !== null && m365MatchNetwork(bits, m365Ipv4Networks, m365Ipv4PrefixLengths);
+}
+
+function m365Match(host) {
+    host = host.toLowerCase();
+    if (host.charAt(host.length - 1) == ".") host = host.substring(0, host.length - 1);
+    if (host.indexOf(":") >= 0 || /^[0-9.]+$/.test(host)) return m365MatchAddress(host);
+    if (m365Domains["." + host] > 0) return true;
+    for (var dot = host.indexOf("."); dot >= 0; dot = host.indexOf(".", dot + 1)) {
+        if (m365Domains[host.substring(dot)] & 2) return true;
+    }
+    if (m365ResolveHosts) {
+        var ip = dnsResolve(host);
+        if (ip) return m365MatchAddress(ip);
+    }
+    return false;
+}
+
+function FindProxyForURL(url, host) {
+    if (m365Match(host)) return m365MatchRoute;
+    return m365DefaultRoute;
+}
+"""
+
+
+class PacFile(Base, OutputInterface):
+
+    __rule_list = dict()
+    __target_file_path = ''
+    __output_hash = None
+    __output_changed = False
+
+    def set_input(self, rule_list: dict) -> bool:
+        self.__rule_list = rule_list
+        return True
+
+    def set_target_file_path(self, target_file_path: str) -> bool:
+        self.__target_file_path = target_file_path
+        return True
+
+    def get_file_extension(self) -> str:
+        return 'pac'
+
+    def get_output_hash(self) -> str:
+        return self.__output_hash
+
+    def get_output_changed(self) -> bool:
+        return self.__output_changed
+
+    def get_routes(self) -> (str, str):
+        """
+        (route for M365 destinations, route for everything else) as PAC return values
+        """
+        match_route = self.config.get('pac_match_route', None) or Defaults.pac_match_route
+        default_route = self.config.get('pac_default_route', None)
+        if not default_route:
+            self.warning("No PAC default route set, so other destinations also go DIRECT. "
+                         "Set one with --pac-default-route, ie: 'PROXY proxy.example.com:3128'")
+            default_route = 'DIRECT'
+        return match_route, default_route
+
+    def run(self) -> bool:
+        """
+        Output the ACL's in 'rule_list' to the 'target_file_path' as a proxy auto-config file
+        """
+        if not self.__rule_list:
+            raise Exception('Rule list not set')
+
+        if not self.__target_file_path:
+            raise Exception('Target file path not set')
+
+        self.info(f"Rendering PAC file for: '{self.__target_file_path}'")
+
+        self.__output_hash, self.__output_changed = publish_chunks(
+            self.__target_file_path, self.iter_lines(),
+            self.config.get('output_buffer_size', Defaults.output_buffer_size))
+        if self.__output_changed:
+            self.info(f"Published '{self.__target_file_path}', sha256: {self.__output_hash}")
+        else:
+            self.info(f"Unchanged '{self.__target_file_path}', sha256: {self.__output_hash}, left in place")
+
+        return True
+
+    def get_tables(self) -> (dict, dict):
+        """
+        Split the rules into the PAC domain table ('.name' -> pac_domain_* flags) and, per address family, the set of
+        network prefixes as bit strings
+        """
+        domains = dict()
+        networks = {4: set(), 6: set()}
+        for acl_addresses in self.__rule_list.values():
+            for acl_address in acl_addresses:
+                network = RuleMatcher.parse_network(acl_address)
+                if network is not None:
+                    bits = format(int(network.network_address), f"0{network.max_prefixlen}b")
+                    networks[network.version].add(bits[:network.prefixlen])
+                    continue
+                domain = acl_address.strip().lower().rstrip('.')
+                flag = pac_domain_subdomains if domain.startswith('.') else pac_domain_exact
+                key = '.' + domain.lstrip('.')
+                domains[key] = domains.get(key, 0) | flag
+        return domains, networks
+
+    def iter_lines(self):
+        """
+        Yield the lines of the PAC file one at a time
+        """
+        linesep = self.config.get('linesep', Defaults.linesep).chars()
+        match_route, default_route = self.get_routes()
+        domains, networks = self.get_tables()
+
+        yield f"// M365 endpoints proxy auto-config, generated by m365digester{linesep}"
+        yield f"var m365MatchRoute = {json.dumps(match_route)};{linesep}"
+        yield f"var m365DefaultRoute = {json.dumps(default_route)};{linesep}"
+        resolve_hosts = self.config.get('pac_resolve_hosts', Defaults.pac_resolve_hosts)
+        yield f"var m365ResolveHosts = {'true' if resolve_hosts else 'false'};{linesep}"
+
+        # Keys start with '.', so they can never collide with properties every object inherits, ie: 'constructor'
+        yield f"var m365Domains = {{{linesep}"
+        for index, key in enumerate(sorted(domains)):
+            separator = ',' if index < len(domains) - 1 else ''
+            yield f"{json.dumps(key)}:{domains[key]}{separator}{linesep}"
+        yield f"}};{linesep}"
+
+        for family in (4, 6):
+            prefix_lengths = sorted(set(len(bits) for bits in networks[family]), reverse=True)
+            yield f"var m365Ipv{family}PrefixLengths = {json.dumps(prefix_lengths)};{linesep}"
+            yield f"var m365Ipv{family}Networks = {{{linesep}"
+            family_networks = sorted(networks[family])
+            for index, bits in enumerate(family_networks):
+                separator = ',' if index < len(family_networks) - 1 else ''
+                yield f"\"{bits}\":1{separator}{linesep}"
+            yield f"}};{linesep}"
+
+        yield linesep.join(pac_functions.strip('\n').split('\n')) + linesep
@@ -4,12 +4,15 @@
 from m365digester.Base import Base
 from m365digester.Lib import Defaults
 from m365digester.OutputInterface import OutputInterface
+from m365digester.OutputWriter import publish_chunks
 
 
 class PuppetSquid(Base, OutputInterface):
 
     __rule_list = dict()
     __target_file_path = ''
+    __output_hash = None
+    __output_changed = False
 
     def set_input(self, rule_list: dict) -> bool:
         # FIXME: Validate rule_list is viable?
@@ -24,6 +27,12 @@ class PuppetSquid(Base, OutputInterface):
     def get_file_extension(self) -> str:
         return 'yaml'
 
+    def get_output_hash(self) -> str:
+        return self.__output_hash
+
+    def get_output_changed(self) -> bool:
+        return self.__output_changed
+
     def run(self) -> bool:
         """
         Output the ACL's in 'rule_list' to the 'target_file_path' in YAML format, creating a partial YAML file
@@ -34,44 +43,55 @@ class PuppetSquid(Base, OutputInterface):
         if not self.__target_file_path:
             raise Exception('Target file path not set')
 
-        squid_src_acl_name: str = self.config.get('squid_src_acl_name', Defaults.squid_src_acl_name)
+        self.info(f"Rendering Puppet Squid partial YAML file for: '{self.__target_file_path}'")
 
-        self.info(f"Writing Puppet Squid partial YAML file to: '{self.__target_file_path}'")
+        self.__output_hash, self.__output_changed = publish_chunks(
+            self.__target_file_path, self.iter_lines(),
+            self.config.get('output_buffer_size', Defaults.output_buffer_size))
+        if self.__output_changed:
+            self.info(f"Published '{self.__target_file_path}', sha256: {self.__output_hash}")
+        else:
+            self.info(f"Unchanged '{self.__target_file_path}', sha256: {self.__output_hash}, left in place")
+
+        return True
+
+    def iter_lines(self):
+        """
+        Yield the lines of the partial YAML file one at a time
+        """
+        squid_src_acl_name: str = self.config.get('squid_src_acl_name', Defaults.squid_src_acl_name)
 
         linesep = self.config.get('linesep', Defaults.linesep).chars()
 
-        with open(self.__target_file_path, mode='w') as target_file_handle:
-            print("squid_http_access:", file=target_file_handle, end=linesep)
-
-            for acl_list_name in self.__rule_list:
-                if not isinstance(acl_list_name, str):
-                    raise Exception(f"ACL List found in rule list if not expected type: string. "
-                               f"Found '{acl_list_name.__class__.__name__}")
-
-                if len(self.__rule_list[acl_list_name]) > 0:
-                    print(f"  '{squid_src_acl_name} {acl_list_name}':", file=target_file_handle, end=linesep)
-                    print("    'action': 'allow'", file=target_file_handle, end=linesep)
-                    print(f"    'comment': 'Allow rule for {acl_list_name} ACL'", file=target_file_handle, end=linesep)
-
-            print("", file=target_file_handle, end=linesep)
-            print("squid_acls:", file=target_file_handle, end=linesep)
-
-            for acl_list_name in self.__rule_list:
-                print(f"  '{acl_list_name}':", file=target_file_handle, end=linesep)
-                if 'domain' in acl_list_name:
-                    print(f"    'type': 'dstdomain'", file=target_file_handle, end=linesep)
-                    print(f"    'comment': 'M365 (Teams or OneDrive) destination domains ({acl_list_name})'",
-                          file=target_file_handle, end=linesep)
-                else:
-                    print(f"    'type': 'dst'", file=target_file_handle, end=linesep)
-                    print(f"    'comment': 'M365 (Teams or OneDrive) destination ip addresses ({acl_list_name})'",
-                          file=target_file_handle, end=linesep)
-                print(f"    'entries':", file=target_file_handle, end=linesep)
-                for destination in self.__rule_list[acl_list_name]:
-                    if not isinstance(destination, str):
-                        raise Exception(f"ACL List destination found in rule list if not expected type: string. "
-                                   f"Found '{destination.__class__.__name__}")
-
-                    print(f"      - '{destination}'", file=target_file_handle, end=linesep)
-
-                print("", file=target_file_handle, end=linesep)
+        yield f"squid_http_access:{linesep}"
+
+        for acl_list_name in self.__rule_list:
+            if not isinstance(acl_list_name, str):
+                raise Exception(f"ACL List found in rule list if not expected type: string. "
+                                f"Found '{acl_list_name.__class__.__name__}")
+
+            if len(self.__rule_list[acl_list_name]) > 0:
+                yield f"  '{squid_src_acl_name} {acl_list_name}':{linesep}"
+                yield f"    'action': 'allow'{linesep}"
+                yield f"    'comment': 'Allow rule for {acl_list_name} ACL'{linesep}"
+
+        yield linesep
+        yield f"squid_acls:{linesep}"
+
+        for acl_list_name in self.__rule_list:
+            yield f"  '{acl_list_name}':{linesep}"
+            if 'domain' in acl_list_name:
+                yield f"    'type': 'dstdomain'{linesep}"
+                yield f"    'comment': 'M365 (Teams or OneDrive) destination domains ({acl_list_name})'{linesep}"
+            else:
+                yield f"    'type': 'dst'{linesep}"
+                yield f"    'comment': 'M365 (Teams or OneDrive) destination ip addresses ({acl_list_name})'{linesep}"
+            yield f"    'entries':{linesep}"
+            for destination in self.__rule_list[acl_list_name]:
+                if not isinstance(destination, str):
+                    raise Exception(f"ACL List destination found in rule list if not expected type: string. "
+                                    f"Found '{destination.__class__.__name__}")
+
+                yield f"      - '{destination}'{linesep}"
+
+            yield linesep
@@ -0,0 +1,61 @@
+#!/bin/env python
+#
+# Outputs the rule list as a compact binary rule set, which RuleSetReader memory-maps and searches without a parse step
+from m365digester.Base import Base
+from m365digester.Lib import Defaults
+from m365digester.OutputInterface import OutputInterface
+from m365digester.RuleMatcher import get_api_version_meta
+from m365digester.RuleSetFile import save_rule_set
+
+
+class RuleSetBinary(Base, OutputInterface):
+
+    __rule_list = dict()
+    __target_file_path = ''
+    __output_hash = None
+    __output_changed = False
+
+    def set_input(self, rule_list: dict) -> bool:
+        self.__rule_list = rule_list
+        return True
+
+    def set_target_file_path(self, target_file_path: str) -> bool:
+        self.__target_file_path = target_file_path
+        return True
+
+    def get_file_extension(self) -> str:
+        return 'bin'
+
+    def get_output_hash(self) -> str:
+        return self.__output_hash
+
+    def get_output_changed(self) -> bool:
+        return self.__output_changed
+
+    def get_meta(self) -> dict:
+        """
+        Source API version kept in the file, see get_api_version_meta()
+        """
+        return get_api_version_meta(self.config.get('api_versions', None))
+
+    def run(self) -> bool:
+        """
+        Save the ACL's in 'rule_list' to the 'target_file_path' as a binary rule set, open it with RuleSetReader
+        """
+        if not self.__rule_list:
+            raise Exception('Rule list not set')
+
+        if not self.__target_file_path:
+            raise Exception('Target file path not set')
+
+        self.info(f"Writing binary rule set for: '{self.__target_file_path}'")
+
+        self.__output_hash, self.__output_changed = save_rule_set(
+            self.__target_file_path, self.__rule_list, self.get_meta(),
+            self.config.get('output_buffer_size', Defaults.output_buffer_size))
+        if self.__output_changed:
+            self.info(f"Published '{self.__target_file_path}', sha256: {self.__output_hash}")
+        else:
+            self.info(f"Unchanged '{self.__target_file_path}', sha256: {self.__output_hash}, left in place")
+
+        return True
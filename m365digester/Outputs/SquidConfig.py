@@ -6,14 +6,15 @@ import os
 from m365digester.Base import Base
 from m365digester.Lib import Defaults
 from m365digester.OutputInterface import OutputInterface
-
-from string import Template
+from m365digester.OutputWriter import iter_template, publish_chunks
 
 class SquidConfig(Base, OutputInterface):
 
     __rule_list = dict()
     __ext = 'config'
     __target_file_path = ''
+    __output_hash = None
+    __output_changed = False
 
     def set_input(self, rule_list: dict) -> bool:
         # FIXME: Validate rule_list is viable?
@@ -32,8 +33,14 @@ class SquidConfig(Base, OutputInterface):
         with open(template_file_path) as template_file_handle:
             return template_file_handle.read()
 
-    def _render_template(self, template_file_path: str, template_substitutes: dict) -> str:
-        return Template(self._read_template(template_file_path)).substitute(template_substitutes)
+    def _render_template(self, template_file_path: str, template_substitutes: dict):
+        return iter_template(self._read_template(template_file_path), template_substitutes)
+
+    def get_output_hash(self) -> str:
+        return self.__output_hash
+
+    def get_output_changed(self) -> bool:
+        return self.__output_changed
 
     def run(self) -> bool:
         """
@@ -53,15 +60,29 @@ class SquidConfig(Base, OutputInterface):
         if not os.path.isfile(template_file):
             raise FileNotFoundError(template_file)
 
-        self.info(f"Writing squid config file to: '{self.__target_file_path}'")
-
-        squid_src_acl_name: str = self.config.get('squid_src_acl_name', Defaults.squid_src_acl_name)
+        self.info(f"Rendering squid config file for: '{self.__target_file_path}'")
 
         template_config = dict()
+        template_config.setdefault('acl_set', self.iter_acl_set)
+        template_config.setdefault('rule_allow', self.iter_rule_allow)
+
+        # Placeholders are checked before the target file is opened
+        chunks = self._render_template(template_file, template_config)
+        self.__output_hash, self.__output_changed = publish_chunks(
+            self.__target_file_path, chunks,
+            self.config.get('output_buffer_size', Defaults.output_buffer_size))
+        if self.__output_changed:
+            self.info(f"Published '{self.__target_file_path}', sha256: {self.__output_hash}")
+        else:
+            self.info(f"Unchanged '{self.__target_file_path}', sha256: {self.__output_hash}, left in place")
 
-        acl_set = ''
-        rule_allow = ''
+        return True
 
+    def iter_rule_allow(self):
+        """
+        Yield the 'http_access allow' lines substituted for '$rule_allow', one per non empty ACL list
+        """
+        squid_src_acl_name: str = self.config.get('squid_src_acl_name', Defaults.squid_src_acl_name)
         linesep = self.config.get('linesep', Defaults.linesep).chars()
 
         for acl_list_name in self.__rule_list:
@@ -70,20 +91,19 @@ class SquidConfig(Base, OutputInterface):
                                 f"Found '{acl_list_name.__class__.__name__}")
 
             if len(self.__rule_list[acl_list_name]) > 0:
-                rule_allow += f"http_access allow {squid_src_acl_name} {acl_list_name}{linesep}"
+                yield f"http_access allow {squid_src_acl_name} {acl_list_name}{linesep}"
+
+    def iter_acl_set(self):
+        """
+        Yield the 'acl' lines substituted for '$acl_set', one per destination
+        """
+        linesep = self.config.get('linesep', Defaults.linesep).chars()
 
         for acl_list_name in self.__rule_list:
-            for destination in self.__rule_list[acl_list_name]:
+            if 'domain' in acl_list_name.lower():
+                acl_scope = 'dstdomain'
+            else:
                 acl_scope = 'dst'
-                if 'domain' in acl_list_name.lower():
-                    acl_scope = 'dstdomain'
-                else:
-                    acl_scope = 'dst'
-
-                acl_set += f"acl {acl_list_name} {acl_scope} {destination}{linesep}"
 
-        template_config.setdefault('acl_set', acl_set)
-        template_config.setdefault('rule_allow', rule_allow)
-
-        with open(self.__target_file_path, mode='w') as target_file_handle:
-            target_file_handle.write(self._render_template(template_file, template_config))
+            for destination in self.__rule_list[acl_list_name]:
+                yield f"acl {acl_list_name} {acl_scope} {destination}{linesep}"
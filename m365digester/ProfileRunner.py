@@ -0,0 +1,197 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .Base import Base
+from .Lib import Defaults
+from .M365Digester import M365Digester
+from .OutputRunner import OutputRunner
+
+# Outcome of one profile: the digest exit code (0 on success), rules digested, an OutputResult per output, wall time,
+# and the error when the profile failed before its outputs ran
+ProfileResult = namedtuple('ProfileResult', ['profile_name', 'exit_code', 'rule_count', 'output_results', 'elapsed',
+                                             'error'])
+
+# Endpoint sets fetched by the parent, set once in each worker process by _init_worker(). With the 'fork' start method
+# workers inherit them without copying or pickling
+_shared_endpoint_sets = dict()
+_shared_api_versions = dict()
+
+
+class ProfileLogAdapter(logging.LoggerAdapter):
+    """
+    Prefix each message with the profile it belongs to, as profiles log to the same handlers concurrently
+    """
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['profile_name']}] {msg}", kwargs
+
+
+def _init_worker(endpoint_sets: dict, api_versions: dict):
+    global _shared_endpoint_sets, _shared_api_versions
+    _shared_endpoint_sets = endpoint_sets
+    _shared_api_versions = api_versions
+
+
+def run_profile(profile_name: str, config: dict, sources: list, logger_name: str) -> ProfileResult:
+    """
+    Digest and render one profile from the shared endpoint sets, in a worker process
+    """
+    started = time.perf_counter()
+    logger = ProfileLogAdapter(logging.getLogger(logger_name), {'profile_name': profile_name})
+    try:
+        app = M365Digester(config, logger)
+        app.set_endpoint_sets({source: _shared_endpoint_sets[source] for source in sources},
+                              {source: _shared_api_versions.get(source, None) for source in sources})
+        exit_code = app.main()
+        output_results = list()
+        if not exit_code and app.rule_list:
+            output_results = OutputRunner(config, logger).run(app.rule_list, app.metrics, app.api_versions)
+        elif not exit_code:
+            logger.warning('No rule list returned through this profile')
+        app.metrics.counters['success'] = 0 if exit_code or not all(
+            output_result.success for output_result in output_results) else 1
+        if config.get('metrics_json_path', None):
+            app.metrics.write_json(config['metrics_json_path'])
+        if config.get('metrics_prometheus_path', None):
+            app.metrics.write_prometheus(config['metrics_prometheus_path'])
+        rule_count = sum(len(acl_addresses) for acl_addresses in app.rule_list.values())
+        return ProfileResult(profile_name, exit_code, rule_count, output_results, time.perf_counter() - started, None)
+    except Exception as e:
+        return ProfileResult(profile_name, 1, 0, list(), time.perf_counter() - started, f"{e.__class__.__name__} {e}")
+
+
+class ProfileRunner(Base):
+    """
+    Digest and render several profiles (ie: one per business unit, each with its own categories, extras, exclusions
+    and outputs) from a single fetch of each endpoint set, running the profiles in parallel across a process pool
+
+    The profile file is JSON: settings shared by every profile under 'defaults', and each profile's own settings under
+    'profiles'. Settings use the same names as the config dict of M365Digester, ie:
+
+        {"defaults": {"output_path": "/etc/squid/m365"},
+         "profiles": {"finance": {"categories_filter_include": ["Allow"], "output_type": ["squidconfig"]},
+                      "labs": {"exclude_addresses": ["*.live.com"], "collapse_acl_sets": false}}}
+
+    Fetching settings (web service, request ID, cache, input files) are taken once from the runner's own config
+    """
+
+    def load_profiles(self) -> dict:
+        """
+        Config of each profile in the profile file: the runner's config, then the file's defaults, then the profile
+        """
+        profile_file_path = self.config.get('profile_file_path', None)
+        if not profile_file_path:
+            raise ValueError('Profile file path not set')
+        with open(profile_file_path) as file_handle:
+            profile_file = json.load(file_handle)
+        profiles = profile_file.get('profiles', None)
+        if not isinstance(profiles, dict) or not profiles:
+            raise ValueError(f"Profile file '{profile_file_path}' holds no 'profiles'")
+
+        base_config = dict(self.config)
+        base_config.update(profile_file.get('defaults', None) or dict())
+        # Shared file names would have every profile overwrite the same outputs
+        if base_config.get('output_file', None):
+            self.warning(f"Output file '{base_config['output_file']}' ignored with profiles, set a path per profile")
+            base_config['output_file'] = None
+
+        profile_configs = dict()
+        for profile_name, profile in profiles.items():
+            config = dict(base_config)
+            config.update(profile or dict())
+            config['profile_name'] = profile_name
+            if 'output_file_prefix' not in (profile or dict()):
+                prefix = base_config.get('output_file_prefix', None) or Defaults.output_file_prefix
+                config['output_file_prefix'] = f"{prefix}-{profile_name}"
+            # A kept SQLite database too, or profiles would overwrite each other's rules and snapshot history
+            for key in ('metrics_json_path', 'metrics_prometheus_path', 'output_delta_state_path',
+                        'output_delta_previous_path', 'sqlitedb_file_path'):
+                if config.get(key, None) and key not in (profile or dict()) and \
+                        config[key] != Defaults.sqlitedb_context_memory:
+                    path, extension = os.path.splitext(config[key])
+                    config[key] = f"{path}-{profile_name}{extension}"
+            profile_configs[profile_name] = config
+        return profile_configs
+
+    def get_sources(self, config: dict) -> list:
+        """
+        Endpoint sets a profile digests: its input files, or its service instances
+        """
+        endpoint_file_paths = config.get('endpoint_file_paths', None)
+        if isinstance(endpoint_file_paths, str):
+            endpoint_file_paths = [endpoint_file_paths]
+        if endpoint_file_paths:
+            return list(dict.fromkeys(endpoint_file_paths))
+        return M365Digester(config).get_instance_names()
+
+    def fetch(self, profile_configs: dict) -> (dict, dict):
+        """
+        Fetch or read every endpoint set any profile needs, each once. Returns (source -> endpoint set,
+        source -> API version)
+        """
+        file_paths = list()
+        instance_names = list()
+        for config in profile_configs.values():
+            if config.get('endpoint_file_paths', None):
+                file_paths.extend(self.get_sources(config))
+            else:
+                instance_names.extend(self.get_sources(config))
+        file_paths = list(dict.fromkeys(file_paths))
+        instance_names = list(dict.fromkeys(instance_names))
+
+        app = M365Digester(self.config, self.logger)
+        endpoint_sets = dict()
+        if file_paths:
+            endpoint_sets.update(app.read_endpoint_set_files(file_paths))
+        if instance_names:
+            client_request_id = self.config.get('m365_request_guid', Defaults.m365_request_guid)
+            endpoint_sets.update(app.m365_get_endpoint_sets(instance_names, client_request_id))
+        # Streams can only be read once, and workers each need the whole set
+        endpoint_sets = {source: list(endpoint_set) for source, endpoint_set in endpoint_sets.items()}
+        return endpoint_sets, dict(app.api_versions)
+
+    def get_worker_count(self, profile_count: int) -> int:
+        workers = self.config.get('profile_workers', None) or os.cpu_count() or 1
+        return max(1, min(int(workers), profile_count))
+
+    def run(self) -> list:
+        """
+        Run every profile, returning a ProfileResult per profile in the order of the profile file
+        """
+        started = time.perf_counter()
+        profile_configs = self.load_profiles()
+        # Unknown output types and clashing target files fail before anything is fetched
+        for profile_name, config in profile_configs.items():
+            try:
+                OutputRunner(config).get_output_jobs()
+            except ValueError as e:
+                raise ValueError(f"Profile '{profile_name}': {e}")
+        endpoint_sets, api_versions = self.fetch(profile_configs)
+        self.info(f"Fetched {len(endpoint_sets)} endpoint sets with {sum(map(len, endpoint_sets.values()))} entries "
+                  f"in {time.perf_counter() - started:.3f}s for {len(profile_configs)} profiles")
+
+        workers = self.get_worker_count(len(profile_configs))
+        logger_name = self.logger.name if isinstance(self.logger, logging.Logger) else None
+        # Forked workers share the parsed endpoint sets copy-on-write, and keep the parent's log handlers
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(endpoint_sets, api_versions)) as executor:
+            futures = [executor.submit(run_profile, profile_name, config, self.get_sources(config), logger_name)
+                       for profile_name, config in profile_configs.items()]
+            results = [future.result() for future in futures]
+
+        for result in results:
+            if result.error:
+                self.error(f"Profile '{result.profile_name}' failed: {result.error}")
+            elif result.exit_code or not all(output_result.success for output_result in result.output_results):
+                self.error(f"Profile '{result.profile_name}' failed with exit code {result.exit_code or 1}")
+            else:
+                self.info(f"Profile '{result.profile_name}' digested {result.rule_count} rules and rendered "
+                          f"{len(result.output_results)} outputs in {result.elapsed:.3f}s")
+        self.info(f"Ran {len(results)} profiles on {workers} workers in {time.perf_counter() - started:.3f}s")
+        return results
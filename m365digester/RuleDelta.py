@@ -0,0 +1,58 @@
+"""
+Rule list of the previous run, for outputs that write only what changed beside their full output. The rule list of
+each run is kept in a small JSON state file. A previous rule list can also be read from a general CSV output
+"""
+import csv
+import json
+
+from .Lib import Defaults
+from .OutputWriter import publish_chunks
+
+
+def read_rule_list(file_path: str) -> dict:
+    """
+    Rule list from a delta state file, a JSON '{list name: [address...]}', or a general CSV output
+    """
+    with open(file_path, newline='') as file_handle:
+        if file_path.lower().endswith('.csv'):
+            rule_list = dict()
+            for row in csv.DictReader(file_handle):
+                rule_list.setdefault(row['ACL_LIST_NAME'], list()).append(row['DESTINATION'])
+            return rule_list
+        state = json.load(file_handle)
+    rule_list = state.get('rule_list', state) if isinstance(state, dict) else None
+    if not isinstance(rule_list, dict):
+        raise ValueError(f"'{file_path}' holds no rule list")
+    return {str(list_name): [str(acl_address) for acl_address in acl_addresses]
+            for list_name, acl_addresses in rule_list.items()}
+
+
+def save_rule_list(file_path: str, rule_list: dict, api_versions: dict = None,
+                   buffer_size: int = Defaults.output_buffer_size) -> (str, bool):
+    """
+    Keep 'rule_list' as the delta state for the next run, replacing 'file_path' atomically. Returns (sha256, changed)
+    as publish_chunks()
+    """
+    state = {'api_versions': dict(api_versions or dict()),
+             'rule_list': {list_name: list(acl_addresses) for list_name, acl_addresses in rule_list.items()}}
+    return publish_chunks(file_path, json.JSONEncoder(separators=(',', ':')).iterencode(state), buffer_size)
+
+
+def get_rule_list_delta(previous_rule_list: dict, rule_list: dict) -> (dict, dict):
+    """
+    Addresses added to and removed from each list since 'previous_rule_list': ({list name: [address...]},
+    {list name: [address...]}). Added addresses keep the order of 'rule_list', removed ones are sorted. Lists without
+    changes are left out
+    """
+    added = dict()
+    removed = dict()
+    for list_name in dict.fromkeys(list(previous_rule_list) + list(rule_list)):
+        previous = set(previous_rule_list.get(list_name, ()))
+        current = rule_list.get(list_name, ())
+        list_added = [acl_address for acl_address in current if acl_address not in previous]
+        list_removed = sorted(previous.difference(current))
+        if list_added:
+            added[list_name] = list_added
+        if list_removed:
+            removed[list_name] = list_removed
+    return added, removed
@@ -0,0 +1,246 @@
+import ipaddress
+import json
+import socket
+
+from .Lib import Defaults
+from .OutputWriter import publish_chunks
+
+
+def get_api_version_meta(api_versions: dict) -> dict:
+    """
+    Source API version to keep with a compiled rule set: 'api_version' as M365Digester.api_version, and
+    'api_version.INSTANCE' for each service instance in 'api_versions' ({instance name: version})
+    """
+    api_versions = {instance_name: version for instance_name, version in (api_versions or dict()).items() if version}
+    meta = {f"api_version.{instance_name}": version for instance_name, version in api_versions.items()}
+    if len(api_versions) == 1:
+        meta['api_version'] = next(iter(api_versions.values()))
+    elif api_versions:
+        meta['api_version'] = ','.join(f"{instance_name}={version}" for instance_name, version in api_versions.items())
+    return meta
+
+
+class RuleMatcher(object):
+    """
+    Lookup index compiled from a digested rule list, answering which lists a host name or IP address falls in
+
+    Domains follow squid 'dstdomain' rules: '.example.com' matches 'example.com' and every name below it, while
+    'example.com' matches only itself. They are indexed by suffix in a hash table, so a lookup costs one dict probe
+    per label of the name looked up. IP networks are held in one hash table per prefix length and address family, so
+    an address lookup costs one probe per distinct prefix length stored, at most the address length in bits
+
+    The compiled index can be saved and loaded again without digesting, see as_dict(), save() and load()
+    """
+
+    format_version = 1
+
+    def __init__(self):
+        # Suffix -> (lists matched by the suffix itself, lists matched by names below it)
+        self._domains = dict()
+        # Family -> prefix length -> network address shifted right by the host bits -> lists
+        self._networks = {4: dict(), 6: dict()}
+        # Family -> stored prefix lengths, longest first
+        self._prefix_lengths = {4: tuple(), 6: tuple()}
+        self._rule_count = 0
+        self.meta = dict()
+
+    def __len__(self) -> int:
+        return self._rule_count
+
+    @classmethod
+    def compile(cls, rule_list: dict, meta: dict = None):
+        """
+        Compile 'rule_list' (list name -> addresses, ie: M365Digester.rule_list) into a matcher. 'meta' is kept with
+        the index, ie: the endpoint versions it was built from
+        """
+        domains = dict()
+        networks = {4: dict(), 6: dict()}
+        rule_count = 0
+        for list_name, acl_addresses in rule_list.items():
+            for acl_address in acl_addresses:
+                rule_count += 1
+                network = cls.parse_network(acl_address)
+                if network is not None:
+                    family = network.version
+                    network_key = int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+                    list_names = networks[family].setdefault(network.prefixlen, dict()).setdefault(network_key, [])
+                else:
+                    domain = acl_address.strip().lower().rstrip('.')
+                    subdomains = domain.startswith('.')
+                    exact_list_names, subdomain_list_names = domains.setdefault(domain.lstrip('.'), ([], []))
+                    list_names = subdomain_list_names if subdomains else exact_list_names
+                if list_name not in list_names:
+                    list_names.append(list_name)
+
+        matcher = cls()
+        matcher._rule_count = rule_count
+        matcher.meta = dict(meta or dict())
+        interned = dict()
+
+        def intern(list_names) -> tuple:
+            list_names = tuple(list_names)
+            return interned.setdefault(list_names, list_names)
+
+        for domain, (exact_list_names, subdomain_list_names) in domains.items():
+            # A name equal to the suffix matches both 'example.com' and '.example.com'
+            matcher._domains[domain] = (intern(dict.fromkeys(exact_list_names + subdomain_list_names)),
+                                        intern(subdomain_list_names))
+        for family, tables in networks.items():
+            matcher._networks[family] = {prefix_length: {network_key: intern(list_names)
+                                                         for network_key, list_names in table.items()}
+                                         for prefix_length, table in tables.items()}
+        matcher._index_prefix_lengths()
+        return matcher
+
+    @staticmethod
+    def parse_network(acl_address: str):
+        """
+        Parse an IP address or CIDR rule, or return None for a domain
+        """
+        if ':' not in acl_address and not acl_address[-1:].isdigit():
+            return None
+        try:
+            return ipaddress.ip_network(acl_address.strip(), strict=False)
+        except ValueError:
+            return None
+
+    def _index_prefix_lengths(self):
+        self._prefix_lengths = {family: tuple(sorted(tables, reverse=True))
+                                for family, tables in self._networks.items()}
+
+    @staticmethod
+    def _merge(matched: tuple, list_names: tuple) -> tuple:
+        if not matched:
+            return list_names
+        return tuple(dict.fromkeys(matched + list_names))
+
+    def match(self, host_or_ip: str) -> tuple:
+        """
+        Lists a host name or IP address falls in, most specific rule first, or an empty tuple. This is the hot path of
+        lookups, so it is kept in one function
+        """
+        last = host_or_ip[-1:]
+        if last.isdigit() or last == ']' or ':' in host_or_ip:
+            try:
+                if ':' in host_or_ip:
+                    value = int.from_bytes(socket.inet_pton(socket.AF_INET6, host_or_ip.strip('[]')), 'big')
+                    family, bits = 6, 128
+                else:
+                    value = int.from_bytes(socket.inet_pton(socket.AF_INET, host_or_ip), 'big')
+                    family, bits = 4, 32
+            except OSError:
+                # Not an address after all, ie: a host name ending in a digit
+                pass
+            else:
+                tables = self._networks[family]
+                matched = tuple()
+                for prefix_length in self._prefix_lengths[family]:
+                    list_names = tables[prefix_length].get(value >> (bits - prefix_length))
+                    if list_names is not None:
+                        matched = self._merge(matched, list_names)
+                return matched
+
+        host = host_or_ip.lower()
+        if last == '.':
+            host = host.rstrip('.')
+        domains = self._domains
+        entry = domains.get(host)
+        matched = entry[0] if entry is not None else tuple()
+        dot = host.find('.')
+        while dot >= 0:
+            entry = domains.get(host[dot + 1:])
+            if entry is not None and entry[1]:
+                matched = self._merge(matched, entry[1])
+            dot = host.find('.', dot + 1)
+        return matched
+
+    def iter_domains(self):
+        """
+        Yield (domain, lists matched by the name itself, lists matched by names below it) for every domain indexed
+        """
+        for domain, (exact_list_names, subdomain_list_names) in self._domains.items():
+            yield domain, exact_list_names, subdomain_list_names
+
+    def iter_network_keys(self, family: int):
+        """
+        Yield (prefix length, network address shifted right by the host bits, lists) for every network of an address
+        family indexed
+        """
+        for prefix_length, table in self._networks[family].items():
+            for network_key, list_names in table.items():
+                yield prefix_length, network_key, list_names
+
+    def get_prefix_lengths(self, family: int) -> tuple:
+        """
+        Prefix lengths stored for an address family, longest first
+        """
+        return self._prefix_lengths[family]
+
+    def as_dict(self) -> dict:
+        """
+        Compiled index as plain JSON types. List names are stored once and referred to by position
+        """
+        list_names = dict()
+
+        def refs(names: tuple) -> list:
+            return [list_names.setdefault(list_name, len(list_names)) for list_name in names]
+
+        domains = {domain: [refs(exact_list_names), refs(subdomain_list_names)]
+                   for domain, (exact_list_names, subdomain_list_names) in sorted(self._domains.items())}
+        networks = {str(family): {str(prefix_length): {format(network_key, 'x'): refs(names)
+                                                       for network_key, names in sorted(table.items())}
+                                  for prefix_length, table in sorted(tables.items())}
+                    for family, tables in self._networks.items()}
+        return {
+            'format': self.format_version,
+            'rule_count': self._rule_count,
+            'meta': self.meta,
+            'lists': list(list_names),
+            'domains': domains,
+            'networks': networks,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        if data.get('format', None) != cls.format_version:
+            raise ValueError(f"Unsupported rule matcher format '{data.get('format', None)}', "
+                             f"expected {cls.format_version}")
+        list_names = data['lists']
+        interned = dict()
+
+        def names(refs: list) -> tuple:
+            key = tuple(refs)
+            if key not in interned:
+                interned[key] = tuple(list_names[ref] for ref in refs)
+            return interned[key]
+
+        matcher = cls()
+        matcher._rule_count = int(data.get('rule_count', 0))
+        matcher.meta = dict(data.get('meta', None) or dict())
+        matcher._domains = {domain: (names(exact_refs), names(subdomain_refs))
+                            for domain, (exact_refs, subdomain_refs) in data['domains'].items()}
+        matcher._networks = {int(family): {int(prefix_length): {int(network_key, 16): names(refs)
+                                                                for network_key, refs in table.items()}
+                                           for prefix_length, table in tables.items()}
+                             for family, tables in data['networks'].items()}
+        for family in (4, 6):
+            matcher._networks.setdefault(family, dict())
+        matcher._index_prefix_lengths()
+        return matcher
+
+    def iter_json(self):
+        """
+        Yield the compiled index as JSON text in pieces, for OutputWriter.write_chunks()
+        """
+        return json.JSONEncoder(separators=(',', ':')).iterencode(self.as_dict())
+
+    def save(self, file_path: str, buffer_size: int = Defaults.output_buffer_size) -> (str, bool):
+        """
+        Save the compiled index, replacing 'file_path' atomically. Returns (sha256, changed) as publish_chunks()
+        """
+        return publish_chunks(file_path, self.iter_json(), buffer_size)
+
+    @classmethod
+    def load(cls, file_path: str):
+        with open(file_path) as file_handle:
+            return cls.from_dict(json.load(file_handle))
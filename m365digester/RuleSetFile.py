@@ -0,0 +1,348 @@
+"""
+Compact binary rule set, for consumers that load a large rule set often and can't afford to parse it each time
+
+The file is a header, a table of sections and the sections, each 8 byte aligned. All integers are big-endian, so
+addresses sort and compare as bytes:
+
+    header          magic 'M365RSET', format version (u16), section count (u16), rule count (u32)
+    section table   per section: id (u32), record count (u32), offset from the start of the file (u64), length (u64)
+    strings         u32 offset of each string in the section, then each string as a u16 length and UTF-8 bytes
+    list sets       u32 offset of each set in the section, then each set as a u16 count and u16 list indexes
+    domains         fixed size records sorted by name: name offset (u32) and length (u16) in the names section, then
+                    the list set matched by the name itself and the list set matched by names below it (u32 each)
+    networks        fixed size records sorted by address: network address (4 or 16 bytes), prefix length (u8), list
+                    set (u32)
+
+RuleSetReader memory-maps the file and binary-searches the sorted records in place, so opening it costs the same
+whatever the size of the rule set, and nothing is read that a lookup doesn't touch
+"""
+
+import ipaddress
+import mmap
+import socket
+import struct
+
+from .Lib import Defaults
+from .OutputWriter import publish_chunks
+from .RuleMatcher import RuleMatcher
+
+rule_set_magic = b'M365RSET'
+rule_set_format_version = 1
+
+section_meta = 1
+section_lists = 2
+section_list_sets = 3
+section_domain_names = 4
+section_domains = 5
+section_ipv4_networks = 6
+section_ipv6_networks = 7
+section_ipv4_prefix_lengths = 8
+section_ipv6_prefix_lengths = 9
+
+_header = struct.Struct('>8sHHI')
+_section_entry = struct.Struct('>IIQQ')
+_u16 = struct.Struct('>H')
+_u32 = struct.Struct('>I')
+_domain_record = struct.Struct('>IHxxII')
+_network_records = {4: struct.Struct('>4sBxxxI'), 6: struct.Struct('>16sBxxxI')}
+_network_sections = {4: section_ipv4_networks, 6: section_ipv6_networks}
+_prefix_length_sections = {4: section_ipv4_prefix_lengths, 6: section_ipv6_prefix_lengths}
+_alignment = 8
+
+
+def _pack_strings(values: list) -> bytes:
+    offsets = list()
+    records = list()
+    position = len(values) * _u32.size
+    for value in values:
+        encoded = value.encode('utf-8')
+        offsets.append(_u32.pack(position))
+        records.append(_u16.pack(len(encoded)) + encoded)
+        position += _u16.size + len(encoded)
+    return b''.join(offsets + records)
+
+
+def _pack_list_sets(list_sets: list) -> bytes:
+    offsets = list()
+    records = list()
+    position = len(list_sets) * _u32.size
+    for list_set in list_sets:
+        offsets.append(_u32.pack(position))
+        records.append(struct.pack(f">H{len(list_set)}H", len(list_set), *list_set))
+        position += _u16.size * (len(list_set) + 1)
+    return b''.join(offsets + records)
+
+
+def iter_rule_set(rule_list: dict, meta: dict = None):
+    """
+    Yield the binary rule set for 'rule_list' (list name -> addresses, ie: M365Digester.rule_list) in pieces, for
+    publish_chunks(). 'meta' holds strings kept with the rules, ie: the source API version
+    """
+    matcher = RuleMatcher.compile(rule_list)
+    list_index = {list_name: index for index, list_name in enumerate(rule_list)}
+    # The empty set is always set 0
+    list_sets = {tuple(): 0}
+
+    def list_set_ref(list_names: tuple) -> int:
+        key = tuple(list_index[list_name] for list_name in list_names)
+        return list_sets.setdefault(key, len(list_sets))
+
+    domain_names = list()
+    domain_records = list()
+    names_length = 0
+    for domain, exact_list_names, subdomain_list_names in sorted(matcher.iter_domains(),
+                                                                 key=lambda item: item[0].encode('utf-8')):
+        encoded = domain.encode('utf-8')
+        domain_records.append(_domain_record.pack(names_length, len(encoded), list_set_ref(exact_list_names),
+                                                  list_set_ref(subdomain_list_names)))
+        domain_names.append(encoded)
+        names_length += len(encoded)
+
+    network_records = dict()
+    for family, bits in ((4, 32), (6, 128)):
+        record = _network_records[family]
+        network_records[family] = sorted(
+            record.pack((network_key << (bits - prefix_length)).to_bytes(bits // 8, 'big'), prefix_length,
+                        list_set_ref(list_names))
+            for prefix_length, network_key, list_names in matcher.iter_network_keys(family))
+
+    meta_strings = [str(item) for key, value in sorted((meta or dict()).items()) if value is not None
+                    for item in (key, value)]
+    sections = [
+        (section_meta, len(meta_strings), _pack_strings(meta_strings)),
+        (section_lists, len(list_index), _pack_strings(list(list_index))),
+        (section_list_sets, len(list_sets), _pack_list_sets(list(list_sets))),
+        (section_domain_names, len(domain_names), b''.join(domain_names)),
+        (section_domains, len(domain_records), b''.join(domain_records)),
+    ]
+    for family in (4, 6):
+        sections.append((_network_sections[family], len(network_records[family]),
+                         b''.join(network_records[family])))
+        prefix_lengths = matcher.get_prefix_lengths(family)
+        sections.append((_prefix_length_sections[family], len(prefix_lengths), bytes(prefix_lengths)))
+
+    yield _header.pack(rule_set_magic, rule_set_format_version, len(sections), len(matcher))
+    position = _header.size + _section_entry.size * len(sections)
+    padded = list()
+    for section_id, count, data in sections:
+        padding = -position % _alignment
+        position += padding
+        yield _section_entry.pack(section_id, count, position, len(data))
+        padded.append((padding, data))
+        position += len(data)
+    for padding, data in padded:
+        yield b'\0' * padding
+        yield data
+
+
+def save_rule_set(file_path: str, rule_list: dict, meta: dict = None,
+                  buffer_size: int = Defaults.output_buffer_size) -> (str, bool):
+    """
+    Save 'rule_list' as a binary rule set, replacing 'file_path' atomically. Returns (sha256, changed) as
+    publish_chunks()
+    """
+    return publish_chunks(file_path, iter_rule_set(rule_list, meta), buffer_size, binary=True)
+
+
+class RuleSetReader(object):
+    """
+    Memory-mapped binary rule set written by save_rule_set(). match() answers as RuleMatcher.match() does, by binary
+    search of the records in the file. Only the header, the list names and the metadata are read on opening
+    """
+
+    def __init__(self, file_path: str):
+        self.__file_handle = open(file_path, 'rb')
+        try:
+            self.__buffer = mmap.mmap(self.__file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.__file_handle.close()
+            raise ValueError(f"Rule set file '{file_path}' is empty")
+        try:
+            self.__sections = self.read_sections()
+            self.__lists = tuple(self.iter_strings(section_lists))
+            meta_strings = list(self.iter_strings(section_meta))
+            self.meta = dict(zip(meta_strings[::2], meta_strings[1::2]))
+            self.__prefix_lengths = {family: tuple(self.get_section_bytes(_prefix_length_sections[family]))
+                                     for family in (4, 6)}
+        except Exception:
+            self.close()
+            raise
+        self.__list_sets = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.__rule_count
+
+    def close(self):
+        self.__buffer.close()
+        self.__file_handle.close()
+
+    @property
+    def list_names(self) -> tuple:
+        return self.__lists
+
+    @property
+    def api_version(self) -> str:
+        return self.meta.get('api_version', None)
+
+    def read_sections(self) -> dict:
+        """
+        Check the header and read the section table: {section id: (record count, offset, length)}
+        """
+        buffer = self.__buffer
+        if len(buffer) < _header.size:
+            raise ValueError('Not a rule set file, too short')
+        magic, format_version, section_count, self.__rule_count = _header.unpack_from(buffer, 0)
+        if magic != rule_set_magic:
+            raise ValueError('Not a rule set file')
+        if format_version != rule_set_format_version:
+            raise ValueError(f"Unsupported rule set format '{format_version}', expected {rule_set_format_version}")
+        sections = dict()
+        for index in range(section_count):
+            section_id, count, offset, length = _section_entry.unpack_from(
+                buffer, _header.size + index * _section_entry.size)
+            if offset + length > len(buffer):
+                raise ValueError(f"Rule set file truncated, section {section_id} runs past the end")
+            sections[section_id] = (count, offset, length)
+        for section_id in range(section_meta, section_ipv6_prefix_lengths + 1):
+            if section_id not in sections:
+                raise ValueError(f"Rule set file has no section {section_id}")
+        return sections
+
+    def get_section_bytes(self, section_id: int) -> bytes:
+        count, offset, length = self.__sections[section_id]
+        return self.__buffer[offset:offset + length]
+
+    def iter_strings(self, section_id: int):
+        buffer = self.__buffer
+        count, offset, length = self.__sections[section_id]
+        for index in range(count):
+            position = offset + _u32.unpack_from(buffer, offset + index * _u32.size)[0]
+            string_length = _u16.unpack_from(buffer, position)[0]
+            yield buffer[position + _u16.size:position + _u16.size + string_length].decode('utf-8')
+
+    def get_list_set(self, ref: int) -> tuple:
+        """
+        List names of a list set, decoded on first use
+        """
+        list_names = self.__list_sets.get(ref)
+        if list_names is None:
+            buffer = self.__buffer
+            count, offset, length = self.__sections[section_list_sets]
+            position = offset + _u32.unpack_from(buffer, offset + ref * _u32.size)[0]
+            list_count = _u16.unpack_from(buffer, position)[0]
+            list_names = tuple(self.__lists[index] for index in
+                               struct.unpack_from(f">{list_count}H", buffer, position + _u16.size))
+            self.__list_sets[ref] = list_names
+        return list_names
+
+    def find_domain(self, name: bytes):
+        """
+        (list set matched by the name itself, list set matched by names below it) of a domain, or None
+        """
+        buffer = self.__buffer
+        count, offset, length = self.__sections[section_domains]
+        names_offset = self.__sections[section_domain_names][1]
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            name_offset, name_length, exact_ref, subdomain_ref = _domain_record.unpack_from(
+                buffer, offset + middle * _domain_record.size)
+            candidate = buffer[names_offset + name_offset:names_offset + name_offset + name_length]
+            if candidate < name:
+                low = middle + 1
+            elif candidate > name:
+                high = middle
+            else:
+                return exact_ref, subdomain_ref
+        return None
+
+    def find_network(self, family: int, key: bytes):
+        """
+        List set of the network whose packed address and prefix length are 'key', or None
+        """
+        buffer = self.__buffer
+        record = _network_records[family]
+        count, offset, length = self.__sections[_network_sections[family]]
+        key_length = len(key)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            position = offset + middle * record.size
+            candidate = buffer[position:position + key_length]
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return record.unpack_from(buffer, position)[2]
+        return None
+
+    def match(self, host_or_ip: str) -> tuple:
+        """
+        Lists a host name or IP address falls in, most specific rule first, or an empty tuple
+        """
+        last = host_or_ip[-1:]
+        if last.isdigit() or last == ']' or ':' in host_or_ip:
+            try:
+                if ':' in host_or_ip:
+                    packed = socket.inet_pton(socket.AF_INET6, host_or_ip.strip('[]'))
+                    family, bits = 6, 128
+                else:
+                    packed = socket.inet_pton(socket.AF_INET, host_or_ip)
+                    family, bits = 4, 32
+            except OSError:
+                pass
+            else:
+                value = int.from_bytes(packed, 'big')
+                matched = tuple()
+                for prefix_length in self.__prefix_lengths[family]:
+                    host_bits = bits - prefix_length
+                    key = ((value >> host_bits) << host_bits).to_bytes(bits // 8, 'big') + bytes((prefix_length,))
+                    ref = self.find_network(family, key)
+                    if ref is not None:
+                        matched = RuleMatcher._merge(matched, self.get_list_set(ref))
+                return matched
+
+        host = host_or_ip.lower()
+        if last == '.':
+            host = host.rstrip('.')
+        name = host.encode('utf-8')
+        refs = self.find_domain(name)
+        matched = self.get_list_set(refs[0]) if refs is not None else tuple()
+        dot = name.find(b'.')
+        while dot >= 0:
+            refs = self.find_domain(name[dot + 1:])
+            if refs is not None and refs[1]:
+                matched = RuleMatcher._merge(matched, self.get_list_set(refs[1]))
+            dot = name.find(b'.', dot + 1)
+        return matched
+
+    def iter_domains(self):
+        """
+        Yield (domain, lists matched by the name itself, lists matched by names below it) in file order
+        """
+        buffer = self.__buffer
+        count, offset, length = self.__sections[section_domains]
+        names_offset = self.__sections[section_domain_names][1]
+        for index in range(count):
+            name_offset, name_length, exact_ref, subdomain_ref = _domain_record.unpack_from(
+                buffer, offset + index * _domain_record.size)
+            name = buffer[names_offset + name_offset:names_offset + name_offset + name_length].decode('utf-8')
+            yield name, self.get_list_set(exact_ref), self.get_list_set(subdomain_ref)
+
+    def iter_networks(self, family: int):
+        """
+        Yield (ip_network, lists) for one address family in file order
+        """
+        buffer = self.__buffer
+        record = _network_records[family]
+        count, offset, length = self.__sections[_network_sections[family]]
+        for index in range(count):
+            packed, prefix_length, ref = record.unpack_from(buffer, offset + index * record.size)
+            yield ipaddress.ip_network((packed, prefix_length)), self.get_list_set(ref)
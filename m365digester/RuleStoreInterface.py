@@ -0,0 +1,64 @@
+class RuleStoreInterface:
+
+    def open(self) -> bool:
+        pass
+
+    def close(self):
+        pass
+
+    def remove(self) -> bool:
+        pass
+
+    def commit(self):
+        pass
+
+    def is_persistent(self) -> bool:
+        pass
+
+    def clear(self, commit: bool = True):
+        pass
+
+    def get_meta(self, key: str, default: str = None) -> str:
+        pass
+
+    def set_meta(self, key: str, value: str, commit: bool = True):
+        pass
+
+    def get_endpoint_set(self) -> list:
+        pass
+
+    def set_endpoint_set(self, endpoint_set: list, commit: bool = True):
+        pass
+
+    def add_acls(self, acl_entries: list, commit: bool = True) -> int:
+        pass
+
+    def remove_acls(self, acl_addresses: list, commit: bool = True) -> list:
+        pass
+
+    def get_acls(self) -> list:
+        pass
+
+    def get_acls_by_address(self, acl_addresses: list) -> dict:
+        pass
+
+    def get_count_acls(self) -> int:
+        pass
+
+    def get_unique_rule_sources(self) -> list:
+        pass
+
+    def get_rule_list(self) -> dict:
+        pass
+
+    def save_snapshot(self, version: str, commit: bool = True) -> (int, int):
+        pass
+
+    def get_snapshots(self) -> list:
+        pass
+
+    def get_snapshot_diff(self, from_version: str, to_version: str) -> (list, list):
+        pass
+
+    def get_snapshot_rule_list(self, version: str) -> dict:
+        pass
@@ -0,0 +1,93 @@
+#!/bin/env python
+#
+# Rule store held in plain python dicts, for runs where the rule database is never kept
+from m365digester.Base import Base
+from m365digester.RuleStoreInterface import RuleStoreInterface
+
+
+class MemoryRuleStore(Base, RuleStoreInterface):
+
+    def __init__(self, config: dict = None, logger=None):
+        super().__init__(config, logger)
+        # Insertion ordered dict of address -> service area name, mirroring row order in the SQLite store
+        self.__acls = dict()
+        self.__meta = dict()
+        self.__endpoint_set = list()
+
+    def open(self) -> bool:
+        self.__acls = dict()
+        self.__meta = dict()
+        self.__endpoint_set = list()
+        self.debug("Opened in-memory rule store")
+        return True
+
+    def close(self):
+        pass
+
+    def remove(self) -> bool:
+        self.__acls = dict()
+        return True
+
+    def commit(self):
+        pass
+
+    def is_persistent(self) -> bool:
+        return False
+
+    def clear(self, commit: bool = True):
+        self.__acls = dict()
+
+    def get_meta(self, key: str, default: str = None) -> str:
+        return self.__meta.get(key, default)
+
+    def set_meta(self, key: str, value: str, commit: bool = True):
+        self.__meta[key] = value
+
+    def get_endpoint_set(self) -> list:
+        return self.__endpoint_set
+
+    def set_endpoint_set(self, endpoint_set: list, commit: bool = True):
+        self.__endpoint_set = list(endpoint_set)
+
+    def add_acls(self, acl_entries: list, commit: bool = True) -> int:
+        """
+        Add (acl_address, service_area_name) tuples, ignoring addresses already in the store. Returns number added
+        """
+        added = 0
+        for acl_address, service_area_name in acl_entries:
+            if acl_address in self.__acls:
+                continue
+            self.__acls[acl_address] = service_area_name
+            added += 1
+        return added
+
+    def remove_acls(self, acl_addresses: list, commit: bool = True) -> list:
+        """
+        Remove addresses from all lists. Returns (acl_address, service_area_name) tuples of the rules removed
+        """
+        removed = list()
+        for acl_address in acl_addresses:
+            service_area_name = self.__acls.pop(acl_address, None)
+            if service_area_name is not None:
+                removed.append((acl_address, service_area_name))
+        return removed
+
+    def get_acls(self) -> list:
+        return list(self.__acls.items())
+
+    def get_acls_by_address(self, acl_addresses: list) -> dict:
+        return {acl_address: self.__acls[acl_address] for acl_address in acl_addresses if acl_address in self.__acls}
+
+    def get_count_acls(self) -> int:
+        return len(self.__acls)
+
+    def get_unique_rule_sources(self) -> list:
+        return list(dict.fromkeys(self.__acls.values()))
+
+    def get_rule_list(self) -> dict:
+        local_rule_list = dict()
+        for acl_address, service_area_name in self.__acls.items():
+            local_rule_list.setdefault(service_area_name, list()).append(acl_address)
+        for service_area_name in local_rule_list:
+            local_rule_list[service_area_name].sort()
+        return local_rule_list
@@ -0,0 +1,428 @@
+#!/bin/env python
+#
+# Rule store backed by an SQLite database, in memory or kept on disk
+import datetime
+import os
+import sqlite3
+import tempfile
+
+from m365digester.Base import Base
+from m365digester.Lib import Defaults, SQLiteContext
+from m365digester.RuleStoreInterface import RuleStoreInterface
+
+
+class SQLiteRuleStore(Base, RuleStoreInterface):
+
+    __db = None
+    __db_context_handle = None
+
+    def open(self) -> bool:
+        """
+        Open sqlite database connection and create the tables
+        """
+
+        if self.config.get('sqlitedb_context', Defaults.sqlitedb_context):
+            self.config.setdefault('sqlitedb_file_path',
+                                   self.config.get('sqlitedb_context_memory', Defaults.sqlitedb_context_memory))
+        else:
+            self.config.setdefault('sqlitedb_file_path',
+                                   self.config.get('sqlitedb_context_file', Defaults.sqlitedb_context_file))
+
+        sqlitedb_context_handle: str = self.config.get('sqlitedb_file_path', None)
+        # If no sqlite db output specified, generate a temp file to use?
+        # FIXME:
+        if not sqlitedb_context_handle:
+            db_path = tempfile._get_default_tempdir()
+            db_name = next(tempfile._get_candidate_names()) + ".db"
+            sqlitedb_context_handle = os.path.join(db_path, db_name)
+
+        try:
+            self.__db_context_handle = sqlitedb_context_handle
+            self.__db = sqlite3.connect(self.__db_context_handle)
+            self.debug(f"Opened SQLite3 Database file {self.__db_context_handle} connection, version {sqlite3.version}")
+        except sqlite3.Error as e:
+            self.error(f"Unable to open SQLite3 database file {self.__db_context_handle}, error: {e}")
+            raise e
+
+        return self.init_db()
+
+    def close(self):
+        """
+        Close sqlite database connection
+        """
+        if self.__db:
+            self.__db.close()
+
+    def remove(self) -> bool:
+        """
+        Delete temporary sqlite database file after usage
+        """
+
+        if self.db_is_in_memory():
+            return True
+
+        if self.config.get('keep_sqlitedb', False):
+            self.info(f"Keeping SQLite db file: {self.__db_context_handle}.")
+            return True
+
+        try:
+            os.remove(self.__db_context_handle)
+            return True
+        except Exception as e:
+            self.warning(f"Unable to remove sqlite db file '{self.__db_context_handle}'. Error: {e}")
+            return False
+
+    def init_db(self) -> bool:
+        sqlitedb_table_create = self.config.get('sqlitedb_table_create', Defaults.sqlitedb_table_create)
+        sqlitedb_index_create = self.config.get('sqlitedb_index_create', Defaults.sqlitedb_index_create)
+        try:
+            c = self.__db.cursor()
+            c.execute(sqlitedb_table_create)
+            c.execute(sqlitedb_index_create)
+            for sqlitedb_state_table_create in Defaults.sqlitedb_state_tables_create:
+                c.execute(sqlitedb_state_table_create)
+            for sqlitedb_history_table_create in Defaults.sqlitedb_history_tables_create:
+                c.execute(sqlitedb_history_table_create)
+            return True
+        except sqlite3.Error as e:
+            self.error(f"Unable to create table using queries '{sqlitedb_table_create}' '{sqlitedb_index_create}'. "
+                       f"Error: {e}")
+            return False
+
+    def db_is_in_memory(self):
+        if self.config.get('sqlitedb_context', Defaults.sqlitedb_context) == SQLiteContext.MEMORY:
+            return True
+        return False
+
+    def db_cursor(self):
+        return self.__db.cursor()
+
+    def commit(self):
+        if self.db_is_in_memory():
+            return
+        else:
+            self.__db.commit()
+
+    def is_persistent(self) -> bool:
+        return not self.db_is_in_memory() and self.config.get('keep_sqlitedb', False)
+
+    def clear(self, commit: bool = True):
+        c = self.db_cursor()
+        c.execute("DELETE FROM acls;")
+        c.close()
+        if commit:
+            self.commit()
+
+    def get_meta(self, key: str, default: str = None) -> str:
+        c = self.db_cursor()
+        c.execute("SELECT value FROM meta WHERE key = ?;", (key,))
+        row = c.fetchone()
+        c.close()
+        return default if row is None else row[0]
+
+    def set_meta(self, key: str, value: str, commit: bool = True):
+        c = self.db_cursor()
+        c.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?,?);", (key, value))
+        c.close()
+        if commit:
+            self.commit()
+
+    def get_endpoint_set(self) -> list:
+        """
+        Rebuild the endpoint set last stored, in the same shape as the M365 '/endpoints' response
+        """
+        c = self.db_cursor()
+        c.execute("SELECT id, servicearea, category, required FROM endpoint_sets ORDER BY id;")
+        endpoint_set = dict()
+        for endpoint_set_id, service_area, category, required in c.fetchall():
+            endpoint_set[endpoint_set_id] = {'id': endpoint_set_id, 'serviceArea': service_area,
+                                             'category': category, 'required': bool(required)}
+        c.execute(f"SELECT endpoint_set_id, kind, {Defaults.sqlitedb_column_address_name} "
+                  f"FROM endpoint_addresses ORDER BY id;")
+        for endpoint_set_id, kind, address in c.fetchall():
+            if endpoint_set_id in endpoint_set:
+                endpoint_set[endpoint_set_id].setdefault(kind, list()).append(address)
+        c.close()
+        return list(endpoint_set.values())
+
+    def set_endpoint_set(self, endpoint_set: list, commit: bool = True):
+        """
+        Store 'endpoint_set', writing only the endpoint sets and addresses which differ from those already stored
+        """
+        new_sets = dict()
+        new_addresses = list()
+        for index, endpoint in enumerate(endpoint_set):
+            endpoint_set_id = int(endpoint.get('id', index + 1))
+            new_sets[endpoint_set_id] = (endpoint.get('serviceArea', None), endpoint.get('category', None),
+                                         1 if endpoint.get('required', False) else 0)
+            for kind in ('urls', 'ips'):
+                for address in endpoint.get(kind, []):
+                    new_addresses.append((endpoint_set_id, kind, str(address)))
+
+        c = self.db_cursor()
+        c.execute("SELECT id, servicearea, category, required FROM endpoint_sets;")
+        old_sets = {row[0]: tuple(row[1:]) for row in c.fetchall()}
+        c.executemany("DELETE FROM endpoint_sets WHERE id = ?;",
+                      [(endpoint_set_id,) for endpoint_set_id in old_sets if endpoint_set_id not in new_sets])
+        c.executemany("INSERT OR REPLACE INTO endpoint_sets(id, servicearea, category, required) VALUES (?,?,?,?);",
+                      [(endpoint_set_id,) + values for endpoint_set_id, values in new_sets.items()
+                       if old_sets.get(endpoint_set_id) != values])
+
+        c.execute(f"SELECT id, endpoint_set_id, kind, {Defaults.sqlitedb_column_address_name} "
+                  f"FROM endpoint_addresses;")
+        old_addresses = dict()
+        stale_ids = list()
+        for row in c.fetchall():
+            if tuple(row[1:]) in old_addresses:
+                stale_ids.append((row[0],))
+            else:
+                old_addresses[tuple(row[1:])] = row[0]
+        new_address_keys = set(new_addresses)
+        stale_ids.extend((row_id,) for key, row_id in old_addresses.items() if key not in new_address_keys)
+        c.executemany("DELETE FROM endpoint_addresses WHERE id = ?;", stale_ids)
+        c.executemany(f"INSERT INTO endpoint_addresses(endpoint_set_id, kind, {Defaults.sqlitedb_column_address_name}) "
+                      f"VALUES (?,?,?);",
+                      [key for key in dict.fromkeys(new_addresses) if key not in old_addresses])
+        c.close()
+        if commit:
+            self.commit()
+
+    def add_acls(self, acl_entries: list, commit: bool = True) -> int:
+        """
+        Add (acl_address, service_area_name) tuples in one batch. Duplicate addresses are ignored by the unique index on
+        the address column. Returns number added
+        """
+        sql_insert = f"INSERT OR IGNORE INTO acls(" \
+                     f"{Defaults.sqlitedb_column_address_name}, " \
+                     f"{Defaults.sqlitedb_column_service_area_name}) " \
+                     f"VALUES (?,?);"
+
+        changes_before = self.__db.total_changes
+        c = self.db_cursor()
+        c.executemany(sql_insert, acl_entries)
+        c.close()
+        if commit:
+            self.commit()
+
+        return self.__db.total_changes - changes_before
+
+    def remove_acls(self, acl_addresses: list, commit: bool = True) -> list:
+        """
+        Remove addresses from all lists, looking them up in batches. Returns (acl_address, service_area_name) tuples of
+        the rules removed
+        """
+        acl_addresses = list(acl_addresses)
+        sql_delete = f"DELETE FROM acls WHERE {Defaults.sqlitedb_column_address_name} = ?;"
+
+        found = dict()
+        c = self.db_cursor()
+        for start in range(0, len(acl_addresses), Defaults.sqlitedb_max_variables):
+            batch = acl_addresses[start:start + Defaults.sqlitedb_max_variables]
+            c.execute(f"SELECT {Defaults.sqlitedb_column_address_name}, {Defaults.sqlitedb_column_service_area_name} "
+                      f"FROM acls WHERE {Defaults.sqlitedb_column_address_name} IN ({','.join('?' * len(batch))});",
+                      batch)
+            found.update(c.fetchall())
+        removed = [(acl_address, found.pop(acl_address)) for acl_address in acl_addresses if acl_address in found]
+        c.executemany(sql_delete, [(acl_address,) for acl_address, service_area_name in removed])
+        c.close()
+        if commit:
+            self.commit()
+
+        return removed
+
+    def get_acls(self) -> list:
+        """
+        Get every (acl_address, service_area_name) in the rule database
+        """
+        sql_query = f"SELECT {Defaults.sqlitedb_column_address_name}, {Defaults.sqlitedb_column_service_area_name} " \
+                    f"FROM acls ORDER BY id;"
+        c = self.db_cursor()
+        c.execute(sql_query)
+        rows = c.fetchall()
+        c.close()
+        return rows
+
+    def get_acls_by_address(self, acl_addresses: list) -> dict:
+        """
+        Get the service area name of each address in 'acl_addresses' which is in the rule database
+        """
+        sql_query = f"SELECT {Defaults.sqlitedb_column_address_name}, {Defaults.sqlitedb_column_service_area_name} " \
+                    f"FROM acls WHERE {Defaults.sqlitedb_column_address_name} = ?;"
+        acls = dict()
+        c = self.db_cursor()
+        for acl_address in acl_addresses:
+            c.execute(sql_query, (acl_address,))
+            row = c.fetchone()
+            if row is not None:
+                acls[row[0]] = row[1]
+        c.close()
+        return acls
+
+    def get_count_acls(self) -> int:
+        """
+        Get the total number of ACL's in the 'rule_list' db
+        """
+        c = self.db_cursor()
+        c.execute("SELECT COUNT(*) FROM acls")
+        result = c.fetchone()[0]
+        c.close()
+        return result
+
+    def get_unique_rule_sources(self) -> list:
+        """
+        Get unique source names from rule database
+        """
+        sql_query = f"SELECT DISTINCT {Defaults.sqlitedb_column_service_area_name} FROM acls;"
+        c = self.db_cursor()
+        c.execute(sql_query)
+        rows = c.fetchall()
+        c.close()
+        return [str(row[0]) for row in rows]
+
+    def get_rule_list(self) -> dict:
+        """
+        Get complete rule set from rule database
+        """
+        local_rule_list = dict()
+
+        for source in self.get_unique_rule_sources():
+            sql_query = f"SELECT {Defaults.sqlitedb_column_address_name} " \
+                        f"FROM acls " \
+                        f"WHERE {Defaults.sqlitedb_column_service_area_name} = ? " \
+                        f"ORDER BY {Defaults.sqlitedb_column_address_name} ASC;"
+            c = self.db_cursor()
+            c.execute(sql_query, (source,))
+            addresses = c.fetchall()
+            c.close()
+            local_rule_list[source] = [str(address[0]) for address in addresses]
+
+        return local_rule_list
+
+    def get_snapshot_id(self, version: str) -> int:
+        c = self.db_cursor()
+        c.execute("SELECT id FROM snapshots WHERE version = ?;", (version,))
+        row = c.fetchone()
+        c.close()
+        if row is None:
+            raise KeyError(f"No snapshot of version '{version}'")
+        return row[0]
+
+    def save_snapshot(self, version: str, commit: bool = True) -> (int, int):
+        """
+        Record the rules now in the database as the snapshot of 'version'. Recording the latest version again replaces
+        it. Only rules added or removed since the previous snapshot are written. Returns (added, removed)
+        """
+        address_column = Defaults.sqlitedb_column_address_name
+        service_area_column = Defaults.sqlitedb_column_service_area_name
+        c = self.db_cursor()
+        c.execute("SELECT id, version FROM snapshots ORDER BY id DESC LIMIT 1;")
+        latest = c.fetchone()
+        c.execute("SELECT id FROM snapshots WHERE version = ?;", (version,))
+        existing = c.fetchone()
+        if existing is not None and existing[0] != latest[0]:
+            c.close()
+            raise ValueError(f"Version '{version}' is older than the latest snapshot, '{latest[1]}'")
+
+        c.execute(f"INSERT OR IGNORE INTO snapshot_rules({address_column}, {service_area_column}) "
+                  f"SELECT {address_column}, {service_area_column} FROM acls ORDER BY id;")
+        c.execute(f"SELECT r.id FROM acls a JOIN snapshot_rules r "
+                  f"ON r.{address_column} = a.{address_column} AND r.{service_area_column} = a.{service_area_column};")
+        current = set(row[0] for row in c.fetchall())
+        c.execute("SELECT rowid, rule_id, first_snapshot_id FROM snapshot_spans WHERE last_snapshot_id IS NULL;")
+        open_spans = {rule_id: (span_id, first_snapshot_id) for span_id, rule_id, first_snapshot_id in c.fetchall()}
+
+        recorded = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+        if existing is not None:
+            snapshot_id = existing[0]
+            c.execute("UPDATE snapshots SET recorded = ?, rule_count = ? WHERE id = ?;",
+                      (recorded, len(current), snapshot_id))
+        else:
+            c.execute("INSERT INTO snapshots(version, recorded, rule_count) VALUES (?,?,?);",
+                      (version, recorded, len(current)))
+            snapshot_id = c.lastrowid
+        c.execute("SELECT MAX(id) FROM snapshots WHERE id < ?;", (snapshot_id,))
+        previous_snapshot_id = c.fetchone()[0]
+
+        # A rule gone since the previous snapshot closes its span there. A span only opened by this snapshot, when
+        # it is recorded again, is dropped altogether
+        removed = [(span_id, first_snapshot_id) for rule_id, (span_id, first_snapshot_id) in open_spans.items()
+                   if rule_id not in current]
+        c.executemany("DELETE FROM snapshot_spans WHERE rowid = ?;",
+                      [(span_id,) for span_id, first_snapshot_id in removed if first_snapshot_id == snapshot_id])
+        c.executemany("UPDATE snapshot_spans SET last_snapshot_id = ? WHERE rowid = ?;",
+                      [(previous_snapshot_id, span_id) for span_id, first_snapshot_id in removed
+                       if first_snapshot_id != snapshot_id])
+        added = [(rule_id, snapshot_id) for rule_id in sorted(current) if rule_id not in open_spans]
+        c.executemany("INSERT INTO snapshot_spans(rule_id, first_snapshot_id) VALUES (?,?);", added)
+        c.close()
+        if commit:
+            self.__db.commit()
+        return len(added), len(removed)
+
+    def get_snapshots(self) -> list:
+        """
+        (version, recorded, rule_count) of each snapshot, oldest first
+        """
+        c = self.db_cursor()
+        c.execute("SELECT version, recorded, rule_count FROM snapshots ORDER BY id;")
+        rows = c.fetchall()
+        c.close()
+        return rows
+
+    def get_snapshot_diff(self, from_version: str, to_version: str) -> (list, list):
+        """
+        (address, service_area_name) rules added and removed going from snapshot 'from_version' to 'to_version'. Only
+        spans starting or ending between the two snapshots are read, so the cost follows the changes between them,
+        not the length of the history
+        """
+        from_snapshot_id = self.get_snapshot_id(from_version)
+        to_snapshot_id = self.get_snapshot_id(to_version)
+        if from_snapshot_id == to_snapshot_id:
+            return list(), list()
+        if from_snapshot_id > to_snapshot_id:
+            removed, added = self.get_snapshot_diff(to_version, from_version)
+            return added, removed
+
+        address_column = Defaults.sqlitedb_column_address_name
+        service_area_column = Defaults.sqlitedb_column_service_area_name
+        present = "SELECT 1 FROM snapshot_spans p WHERE p.rule_id = s.rule_id AND p.first_snapshot_id <= :at " \
+                  "AND (p.last_snapshot_id IS NULL OR p.last_snapshot_id >= :at)"
+        c = self.db_cursor()
+        # Present in the later snapshot through a span which started after the earlier one
+        c.execute(f"SELECT r.{address_column}, r.{service_area_column} FROM snapshot_spans s "
+                  f"JOIN snapshot_rules r ON r.id = s.rule_id "
+                  f"WHERE s.first_snapshot_id > :low AND s.first_snapshot_id <= :high "
+                  f"AND (s.last_snapshot_id IS NULL OR s.last_snapshot_id >= :high) "
+                  f"AND NOT EXISTS ({present.replace(':at', ':low')}) "
+                  f"ORDER BY r.{service_area_column}, r.{address_column};",
+                  {'low': from_snapshot_id, 'high': to_snapshot_id})
+        added = c.fetchall()
+        # Present in the earlier snapshot through a span which ended before the later one
+        c.execute(f"SELECT r.{address_column}, r.{service_area_column} FROM snapshot_spans s "
+                  f"JOIN snapshot_rules r ON r.id = s.rule_id "
+                  f"WHERE s.last_snapshot_id >= :low AND s.last_snapshot_id < :high "
+                  f"AND s.first_snapshot_id <= :low "
+                  f"AND NOT EXISTS ({present.replace(':at', ':high')}) "
+                  f"ORDER BY r.{service_area_column}, r.{address_column};",
+                  {'low': from_snapshot_id, 'high': to_snapshot_id})
+        removed = c.fetchall()
+        c.close()
+        return added, removed
+
+    def get_snapshot_rule_list(self, version: str) -> dict:
+        """
+        Rule list as it was in snapshot 'version', in the same shape as get_rule_list()
+        """
+        snapshot_id = self.get_snapshot_id(version)
+        address_column = Defaults.sqlitedb_column_address_name
+        service_area_column = Defaults.sqlitedb_column_service_area_name
+        c = self.db_cursor()
+        c.execute(f"SELECT r.{address_column}, r.{service_area_column} FROM snapshot_spans s "
+                  f"JOIN snapshot_rules r ON r.id = s.rule_id "
+                  f"WHERE s.first_snapshot_id <= :at AND (s.last_snapshot_id IS NULL OR s.last_snapshot_id >= :at) "
+                  f"ORDER BY r.{service_area_column}, r.{address_column};", {'at': snapshot_id})
+        rule_list = dict()
+        for acl_address, service_area_name in c.fetchall():
+            rule_list.setdefault(service_area_name, list()).append(acl_address)
+        c.close()
+        return rule_list
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Squid 'external_acl_type' helper answering from a compiled RuleMatcher index, so rules change without a squid
+reconfigure. The index file (written with '-t matcherindex=PATH') is watched, and reloaded in the background whenever a
+new digest publishes it, or on SIGHUP. Lookups carry on against the old index until the new one is loaded
+
+Each request line is '[channel-ID] host [list names...]'. The reply is 'OK' when the host matches a rule (in one of the
+list names, if any are given), 'ERR' when it doesn't, and 'BH' while no index is loaded. With concurrency the
+channel-ID is echoed back, so squid can keep many requests in flight to one helper process, ie:
+
+    external_acl_type m365 ttl=300 negative_ttl=60 children-max=2 concurrency=100 %DST \\
+        /usr/local/bin/m365digester-squid-helper --concurrent -x /var/lib/m365digester/matcher.json
+    acl m365 external m365
+"""
+
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+from argparse import ArgumentParser
+
+from .Base import Base
+from .Lib import Defaults
+from .RuleMatcher import RuleMatcher
+
+
+class SquidAclHelper(Base):
+    """
+    Answers squid external ACL lookups from a RuleMatcher loaded from 'matcher_index_path', swapping in a new index
+    whenever the file is replaced
+    """
+
+    __matcher = None
+    __index_stat = None
+    __lookup_count = 0
+    __reload_count = 0
+
+    def __init__(self, config: dict = None, logger=None):
+        super().__init__(config, logger)
+        self.__reload_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__watcher = None
+
+    @property
+    def matcher(self) -> RuleMatcher:
+        return self.__matcher
+
+    @property
+    def lookup_count(self) -> int:
+        return self.__lookup_count
+
+    @property
+    def reload_count(self) -> int:
+        return self.__reload_count
+
+    def get_index_path(self) -> str:
+        return self.config.get('matcher_index_path', None)
+
+    def get_index_stat(self):
+        """
+        (device, inode, size, mtime) of the index file, which changes when a new index is renamed into place
+        """
+        try:
+            index_stat = os.stat(self.get_index_path())
+        except OSError:
+            return None
+        return index_stat.st_dev, index_stat.st_ino, index_stat.st_size, index_stat.st_mtime_ns
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Load the index file if it has changed since it was last loaded, then swap it in. A failed load keeps the index
+        already in use. Returns True if a new index was swapped in
+        """
+        with self.__reload_lock:
+            index_stat = self.get_index_stat()
+            if index_stat is None:
+                if self.__matcher is None:
+                    self.warning(f"Matcher index '{self.get_index_path()}' not found, answering BH until it is")
+                return False
+            if index_stat == self.__index_stat and not force:
+                return False
+            started = time.perf_counter()
+            try:
+                matcher = RuleMatcher.load(self.get_index_path())
+            except Exception as e:
+                self.error(f"Unable to load matcher index '{self.get_index_path()}', keeping the current one. "
+                           f"Error: {e.__class__.__name__}: {e}")
+                # Don't retry the same broken file until it changes again
+                self.__index_stat = index_stat
+                return False
+            # Swapping the reference is atomic, lookups in flight finish against the index they started with
+            self.__matcher = matcher
+            self.__index_stat = index_stat
+            self.__reload_count += 1
+            self.info(f"Loaded matcher index '{self.get_index_path()}' with {len(matcher)} rules "
+                      f"in {time.perf_counter() - started:.3f}s")
+            return True
+
+    def watch(self):
+        """
+        Check the index file for changes every 'squid_helper_reload_interval' seconds until stop()
+        """
+        interval = float(self.config.get('squid_helper_reload_interval', Defaults.squid_helper_reload_interval))
+        while not self.__stopped.wait(interval):
+            self.reload()
+
+    def start_watching(self):
+        self.__watcher = threading.Thread(target=self.watch, name='matcher-index-watcher', daemon=True)
+        self.__watcher.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__watcher:
+            self.__watcher.join()
+
+    def lookup(self, tokens: list) -> str:
+        """
+        Result for the tokens of one request: 'OK' or 'ERR' with the matched list as the tag, or 'BH'
+        """
+        matcher = self.__matcher
+        if matcher is None:
+            return 'BH message=no%20matcher%20index%20loaded'
+        if not tokens:
+            return 'BH message=no%20host%20given'
+        self.__lookup_count += 1
+        list_names = matcher.match(urllib.parse.unquote(tokens[0]))
+        if len(tokens) > 1:
+            wanted = set(urllib.parse.unquote(token) for token in tokens[1:])
+            list_names = tuple(list_name for list_name in list_names if list_name in wanted)
+        if list_names:
+            return f"OK tag={urllib.parse.quote(list_names[0])}"
+        return 'ERR'
+
+    def handle_line(self, line: str) -> str:
+        """
+        Reply line (without the newline) for one request line
+        """
+        tokens = line.split()
+        if self.config.get('squid_helper_concurrent', False):
+            if not tokens:
+                return None
+            channel_id = tokens.pop(0)
+            return f"{channel_id} {self.lookup(tokens)}"
+        return self.lookup(tokens)
+
+    @staticmethod
+    def iter_request_batches(input_handle):
+        """
+        Yield lists of request lines. From a pipe, each batch is every complete line squid has sent so far, so a burst
+        of concurrent requests is answered with a single write
+        """
+        try:
+            input_fd = input_handle.fileno()
+        except (AttributeError, OSError, ValueError):
+            input_fd = None
+        if input_fd is None:
+            for line in input_handle:
+                yield [line]
+            return
+
+        pending = b''
+        while True:
+            data = os.read(input_fd, 65536)
+            if not data:
+                break
+            *lines, pending = (pending + data).split(b'\n')
+            if lines:
+                yield [line.decode('utf-8', 'replace') for line in lines]
+        if pending:
+            yield [pending.decode('utf-8', 'replace')]
+
+    def serve(self, input_handle=None, output_handle=None) -> int:
+        """
+        Answer request lines from squid until end of input
+        """
+        input_handle = input_handle or sys.stdin
+        output_handle = output_handle or sys.stdout
+        self.reload(force=True)
+        self.start_watching()
+        try:
+            for lines in self.iter_request_batches(input_handle):
+                replies = [reply for reply in map(self.handle_line, lines) if reply is not None]
+                if replies:
+                    output_handle.write('\n'.join(replies) + '\n')
+                    output_handle.flush()
+        except (BrokenPipeError, KeyboardInterrupt):
+            pass
+        finally:
+            self.stop()
+        self.info(f"Answered {self.__lookup_count} lookups, loaded the matcher index {self.__reload_count} times")
+        return 0
+
+
+def main():
+    parser = ArgumentParser(prog='m365digester-squid-helper',
+                            description='Squid external_acl_type helper answering from a compiled M365 rule index')
+    parser.add_argument('-x', '--index', dest='matcher_index_path',
+                        default=os.environ.get('MATCHER_INDEX', None),
+                        help="Matcher index file written by 'm365digester-cli -t matcherindex=PATH'")
+    parser.add_argument('--concurrent', dest='squid_helper_concurrent', action='store_true',
+                        default=str(os.environ.get('SQUID_HELPER_CONCURRENT', '')).lower() in ['true', '1', 'y'],
+                        help="Requests carry a channel-ID, set when squid is configured with 'concurrency=N' (N > 0)")
+    parser.add_argument('--reload-interval', dest='squid_helper_reload_interval', type=float,
+                        default=os.environ.get('SQUID_HELPER_RELOAD_INTERVAL', Defaults.squid_helper_reload_interval),
+                        help=f"Default: {Defaults.squid_helper_reload_interval}. Seconds between checks of the index "
+                             f"file for a new digest. SIGHUP reloads at once")
+    parser.add_argument('--log-level', dest='log_level', choices=Defaults.log_levels,
+                        default=os.environ.get('LOG_LEVEL_CONSOLE', 'WARNING'),
+                        help='Default: WARNING. Logged to stderr, which squid writes to cache.log')
+    args = parser.parse_args()
+
+    if not args.matcher_index_path:
+        parser.error('a matcher index file is required (-x PATH or MATCHER_INDEX)')
+
+    # stdout carries the replies to squid, so logging must only ever go to stderr
+    logging.basicConfig(level=args.log_level, stream=sys.stderr,
+                        format='%(asctime)s m365digester-squid-helper [%(levelname)s] %(message)s')
+    helper = SquidAclHelper(vars(args), logging.getLogger())
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=helper.reload, kwargs={'force': True}, daemon=True).start())
+    sys.exit(helper.serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the M365 endpoint web service, for tests and benchmarks without access to endpoints.office.com
+
+Serves '/endpoints/{instance}', '/version/{instance}', '/version' and '/changes/{instance}/{version}' from recorded
+fixtures or generated data, optionally adding latency and errors. In recording mode requests are passed to the real
+web service, and each response is saved as a fixture for later replay. Fixtures mirror the request path, ie:
+'/endpoints/Worldwide?clientrequestid=...' is replayed from '{fixture_path}/endpoints/Worldwide.json'
+
+Connections are kept alive, bodies are gzip compressed when the client accepts it, and successful responses carry an
+ETag and Last-Modified, answering matching conditional requests with '304 Not Modified'
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from argparse import ArgumentParser
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .Base import Base
+from .Lib import Defaults
+from .Synthetic import generate_endpoint_set, generate_version, parse_mix
+
+
+class StandInServer(Base):
+    """
+    Stand-in M365 endpoint web service, run in a background thread with start(), or in the foreground with
+    serve_forever()
+    """
+
+    __server = None
+    __thread = None
+    __lock = None
+    __rnd = None
+    __endpoint_set_body = None
+    __version = None
+    __request_count = 0
+    __injected_error_count = 0
+    __not_modified_count = 0
+    __last_modified = None
+
+    @property
+    def url(self) -> str:
+        """
+        Base URL to use as 'm365_web_service_url'
+        """
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def request_count(self) -> int:
+        return self.__request_count
+
+    @property
+    def injected_error_count(self) -> int:
+        return self.__injected_error_count
+
+    @property
+    def not_modified_count(self) -> int:
+        return self.__not_modified_count
+
+    def get_fixture_path(self):
+        return self.config.get('standin_fixture_path', None)
+
+    def get_fixture_file_path(self, request_path: str) -> str:
+        """
+        Fixture file for a request path, ie: '/changes/Worldwide/0000000000' -> '{fixture_path}/changes/Worldwide/0000000000.json'
+        """
+        parts = [urllib.parse.unquote(part) for part in request_path.strip('/').split('/') if part]
+        if not parts or any(part in ('.', '..') or '/' in part or '\\' in part for part in parts):
+            return None
+        return os.path.join(self.get_fixture_path(), *parts) + '.json'
+
+    def get_version(self) -> str:
+        if self.__version is None:
+            self.__version = self.config.get('standin_version', None) or \
+                             generate_version(int(self.config.get('standin_seed', Defaults.standin_seed)))
+        return self.__version
+
+    def get_generated_response(self, method_name: str, path_parts: list) -> (int, bytes):
+        """
+        Response for generated data: one synthetic endpoint set, the same for every instance, which never changes
+        """
+        if method_name == 'endpoints':
+            if self.__endpoint_set_body is None:
+                endpoint_set = generate_endpoint_set(
+                    int(self.config.get('standin_generate_entries', Defaults.standin_generate_entries)),
+                    int(self.config.get('standin_seed', Defaults.standin_seed)),
+                    parse_mix(self.config.get('standin_mix', '') or ''))
+                self.__endpoint_set_body = json.dumps(endpoint_set).encode()
+            return 200, self.__endpoint_set_body
+        if method_name == 'version':
+            if path_parts:
+                return 200, json.dumps({'instance': path_parts[0], 'latest': self.get_version()}).encode()
+            return 200, json.dumps([{'instance': instance_name, 'latest': self.get_version()}
+                                    for instance_name in Defaults.m365_service_instance_options]).encode()
+        if method_name == 'changes':
+            return 200, b'[]'
+        return 404, b'{"error": "Unknown method"}'
+
+    def get_fixture_response(self, request_path: str) -> (int, bytes):
+        fixture_file_path = self.get_fixture_file_path(request_path)
+        if not fixture_file_path:
+            return 404, b'{"error": "Unknown method"}'
+        try:
+            with open(fixture_file_path, mode='rb') as fixture_file_handle:
+                return 200, fixture_file_handle.read()
+        except FileNotFoundError:
+            self.warning(f"No fixture for '{request_path}' at '{fixture_file_path}'")
+            return 404, b'{"error": "No fixture recorded"}'
+
+    def get_recorded_response(self, request_path: str, query: str) -> (int, bytes):
+        """
+        Pass the request to the real web service, saving a successful response as the fixture for 'request_path'
+        """
+        upstream_url = self.config.get('standin_record_url', Defaults.m365_web_service_url).rstrip('/') + \
+                       request_path + (f"?{query}" if query else '')
+        self.info(f"Recording '{upstream_url}'")
+        try:
+            with urllib.request.urlopen(urllib.request.Request(upstream_url)) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+        fixture_file_path = self.get_fixture_file_path(request_path)
+        if fixture_file_path:
+            os.makedirs(os.path.dirname(fixture_file_path), exist_ok=True)
+            file_handle, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(fixture_file_path), suffix='.tmp')
+            with os.fdopen(file_handle, mode='wb') as temp_file_handle:
+                temp_file_handle.write(body)
+            os.replace(temp_file_path, fixture_file_path)
+        return status, body
+
+    def get_last_modified(self) -> str:
+        """
+        Last-Modified of every response: the time the server started
+        """
+        if self.__last_modified is None:
+            self.__last_modified = formatdate(time.time(), usegmt=True)
+        return self.__last_modified
+
+    def count_not_modified(self):
+        with self.__lock:
+            self.__not_modified_count += 1
+
+    def inject_fault(self):
+        """
+        Sleep for the configured latency, then decide whether this request fails. Returns an error status or None
+        """
+        latency_ms = float(self.config.get('standin_latency_ms', 0) or 0)
+        jitter_ms = float(self.config.get('standin_latency_jitter_ms', 0) or 0)
+        with self.__lock:
+            self.__request_count += 1
+            request_number = self.__request_count
+            delay = (latency_ms + self.__rnd.uniform(0, jitter_ms)) / 1000.0
+            fail = request_number <= int(self.config.get('standin_fail_first', 0) or 0) or \
+                self.__rnd.random() < float(self.config.get('standin_error_rate', 0) or 0)
+            if fail:
+                self.__injected_error_count += 1
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            return int(self.config.get('standin_error_status', Defaults.standin_error_status))
+        return None
+
+    def handle_request(self, raw_path: str) -> (int, bytes):
+        request_path, _, query = raw_path.partition('?')
+        error_status = self.inject_fault()
+        if error_status:
+            return error_status, json.dumps({'error': f"Injected error {error_status}"}).encode()
+
+        if self.config.get('standin_record_url', None):
+            return self.get_recorded_response(request_path, query)
+        if self.get_fixture_path():
+            return self.get_fixture_response(request_path)
+
+        path_parts = [urllib.parse.unquote(part) for part in request_path.strip('/').split('/') if part]
+        if not path_parts:
+            return 404, b'{"error": "Unknown method"}'
+        return self.get_generated_response(path_parts[0].lower(), path_parts[1:])
+
+    def create_server(self):
+        stand_in = self
+        self.__lock = threading.Lock()
+        self.__rnd = random.Random(int(self.config.get('standin_seed', Defaults.standin_seed)))
+        if not self.config.get('standin_record_url', None) and not self.get_fixture_path():
+            # Generate up front, so the first request isn't slowed down and threads don't race to generate
+            self.get_generated_response('endpoints', list())
+        self.get_last_modified()
+
+        class StandInRequestHandler(BaseHTTPRequestHandler):
+            # Keep connections alive, every response has a Content-Length
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                try:
+                    status, body = stand_in.handle_request(self.path)
+                except Exception as e:
+                    stand_in.error(f"Unable to handle request '{self.path}'. Error: {e}")
+                    status, body = 500, json.dumps({'error': str(e)}).encode()
+
+                headers = {'Content-Type': 'application/json; charset=utf-8'}
+                if status == 200:
+                    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+                    headers.update({'ETag': etag, 'Last-Modified': stand_in.get_last_modified()})
+                    if self.headers.get('If-None-Match', None) == etag:
+                        status, body = 304, b''
+                        stand_in.count_not_modified()
+                if body and 'gzip' in (self.headers.get('Accept-Encoding', '') or ''):
+                    body = gzip.compress(body, compresslevel=5)
+                    headers['Content-Encoding'] = 'gzip'
+
+                self.send_response(status)
+                for header_name, header_value in headers.items():
+                    self.send_header(header_name, header_value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                stand_in.debug(f"Stand-in: {self.address_string()} {format % args}")
+
+        self.__server = ThreadingHTTPServer((self.config.get('standin_bind', Defaults.standin_bind),
+                                             int(self.config.get('standin_port', Defaults.standin_port))),
+                                            StandInRequestHandler)
+        self.__server.daemon_threads = True
+
+    def start(self) -> str:
+        """
+        Serve from a background thread, returning the base URL
+        """
+        self.create_server()
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        self.info(f"Stand-in M365 web service listening on {self.url}")
+        return self.url
+
+    def stop(self):
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
+        if self.__thread:
+            self.__thread.join()
+
+    def serve_forever(self):
+        self.create_server()
+        self.info(f"Stand-in M365 web service listening on {self.url}")
+        try:
+            self.__server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.__server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+def main():
+    import logging
+
+    parser = ArgumentParser(prog='python -m m365digester.StandIn',
+                            description='Local stand-in for the M365 endpoint web service')
+    parser.add_argument('-b', '--bind', dest='standin_bind', default=Defaults.standin_bind)
+    parser.add_argument('-P', '--port', dest='standin_port', type=int, default=Defaults.standin_port)
+    parser.add_argument('-F', '--fixtures', dest='standin_fixture_path',
+                        help='Replay responses from this fixture directory (or save them to it with --record)')
+    parser.add_argument('-R', '--record', dest='standin_record_url', nargs='?', const=Defaults.m365_web_service_url,
+                        help=f"Pass requests to the real web service and save them as fixtures. "
+                             f"Default: {Defaults.m365_web_service_url}")
+    parser.add_argument('-n', '--generate', dest='standin_generate_entries', type=int,
+                        default=Defaults.standin_generate_entries,
+                        help='Entries in the generated endpoint set, when not replaying fixtures')
+    parser.add_argument('-m', '--mix', dest='standin_mix', default='',
+                        help="Generated address mix overrides as 'kind=share,...', ie: 'duplicate=0.2,ipv6=0'")
+    parser.add_argument('--seed', dest='standin_seed', type=int, default=Defaults.standin_seed)
+    parser.add_argument('--version', dest='standin_version', default=None,
+                        help='Endpoint version served with generated data. Default: derived from the seed')
+    parser.add_argument('--latency-ms', dest='standin_latency_ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', dest='standin_latency_jitter_ms', type=float, default=0,
+                        help='Random extra latency of up to this many milliseconds')
+    parser.add_argument('--error-rate', dest='standin_error_rate', type=float, default=0,
+                        help='Share of requests answered with an error, ie: 0.1')
+    parser.add_argument('--error-status', dest='standin_error_status', type=int,
+                        default=Defaults.standin_error_status)
+    parser.add_argument('--fail-first', dest='standin_fail_first', type=int, default=0,
+                        help='Answer the first N requests with an error')
+    args = parser.parse_args()
+
+    if args.standin_record_url and not args.standin_fixture_path:
+        parser.error('--record needs --fixtures to save responses to')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s', stream=sys.stdout)
+    StandInServer(vars(args), logging.getLogger()).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+class SuffixTrie(object):
+    """
+    Trie of domain name suffixes, keyed on reversed DNS labels ('www.example.com' is stored as com -> example -> www)
+
+    Lookups walk the labels of a name from the right, so finding the suffixes that cover a name costs one dict lookup
+    per label, regardless of how many suffixes are stored
+    """
+
+    # Key used inside a node to hold the value of a suffix ending at that node. DNS labels are never empty, so this
+    # can't collide with a real label
+    _terminal = ''
+
+    def __init__(self):
+        self._root = dict()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @staticmethod
+    def labels(name: str) -> list:
+        """
+        Split a domain name into reversed, lower cased labels. A leading dot (squid style '.example.com') is ignored
+        """
+        if name.startswith('.'):
+            name = name[1:]
+        labels = name.lower().split('.')
+        labels.reverse()
+        return labels
+
+    def add(self, suffix: str, value=True):
+        """
+        Add 'suffix' to the trie, storing 'value' against it
+        """
+        node = self._root
+        for label in self.labels(suffix):
+            node = node.setdefault(label, dict())
+        if self._terminal not in node:
+            self._count += 1
+        node[self._terminal] = value
+
+    def get(self, suffix: str, default=None):
+        """
+        Get the value stored against exactly 'suffix'
+        """
+        node = self._root
+        for label in self.labels(suffix):
+            node = node.get(label)
+            if node is None:
+                return default
+        return node.get(self._terminal, default)
+
+    def find_parent(self, name: str, default=None):
+        """
+        Get the value of the shortest stored suffix which 'name' is a strict subdomain of, ie: 'a.example.com' and
+        '.a.example.com' are both covered by a stored 'example.com', but 'example.com' is not
+        """
+        node = self._root
+        labels = self.labels(name)
+        for label in labels[:-1]:
+            node = node.get(label)
+            if node is None:
+                return default
+            if self._terminal in node:
+                return node[self._terminal]
+        return default
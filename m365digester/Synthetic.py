@@ -0,0 +1,104 @@
+import random
+
+# Share of generated addresses of each kind:
+#   wildcard  - '*.tenantN.exampleN.com', which cover every 'overlap' address of the same tenant
+#   overlap   - 'hostN.tenantN.exampleN.com', a subdomain of a wildcard generated before it, left to the overlap pass
+#   domain    - 'hostN.siteN.exampleN.net', unique and never covered
+#   duplicate - repeat of an address already generated, possibly in another endpoint set
+#   ipv4      - IPv4 network, neighbouring networks are often adjacent so they can be aggregated
+#   ipv6      - IPv6 network
+default_mix = {
+    'wildcard': 0.10,
+    'overlap': 0.35,
+    'domain': 0.20,
+    'duplicate': 0.05,
+    'ipv4': 0.20,
+    'ipv6': 0.10,
+}
+
+
+def parse_mix(mix_spec: str) -> dict:
+    """
+    Parse 'kind=share,kind=share' into a mix, starting from the default mix, ie: 'duplicate=0.2,ipv6=0'
+    """
+    mix = dict(default_mix)
+    for item in filter(None, mix_spec.split(',')):
+        kind, _, share = item.partition('=')
+        if kind not in default_mix:
+            raise ValueError(f"Unknown address kind '{kind}', choose from: {', '.join(default_mix)}")
+        mix[kind] = float(share)
+    return mix
+
+
+def generate_version(seed: int = 365) -> str:
+    """
+    Endpoint version string in the M365 'YYYYMMDDNN' form, derived from 'seed' so generated data is reproducible
+    """
+    rnd = random.Random(seed)
+    return f"{rnd.randint(2018, 2030)}{rnd.randint(1, 12):02}{rnd.randint(1, 28):02}{rnd.randint(0, 99):02}"
+
+
+def generate_endpoint_set(entry_count: int, seed: int = 365, mix: dict = None) -> list:
+    """
+    Generate a list of endpoint set objects shaped like the M365 '/endpoints' response, holding roughly
+    'entry_count' urls and ips in total, split between the kinds of address in 'mix'. Used for benchmarks and by the
+    stand-in web service, without access to the live web service
+    """
+    rnd = random.Random(seed)
+    mix = mix or default_mix
+    kinds = [kind for kind in mix if mix[kind] > 0]
+    weights = [mix[kind] for kind in kinds]
+    service_areas = ('Exchange', 'SharePoint', 'Skype', 'Common')
+    categories = ('Optimize', 'Allow', 'Default')
+    generated_urls = list()
+    generated_ips = list()
+    # 'tenantN.exampleN.com' of each wildcard generated so far, overlap addresses are drawn below them
+    wildcard_domains = list()
+    endpoint_set = list()
+    generated = 0
+    endpoint_set_id = 1
+    while generated < entry_count:
+        urls = list()
+        ips = list()
+        for i, kind in enumerate(rnd.choices(kinds, weights, k=min(rnd.randint(1, 40), entry_count - generated))):
+            n = generated + i
+            if kind == 'duplicate' and (generated_urls or generated_ips):
+                if generated_ips and (not generated_urls or rnd.random() < 0.3):
+                    ips.append(rnd.choice(generated_ips))
+                else:
+                    urls.append(rnd.choice(generated_urls))
+            elif kind == 'wildcard':
+                wildcard_domains.append(f"tenant{n % 997}.example{n % 7}.com")
+                urls.append(f"*.{wildcard_domains[-1]}")
+            elif kind == 'overlap':
+                if wildcard_domains:
+                    urls.append(f"host{n}.{rnd.choice(wildcard_domains)}")
+                else:
+                    urls.append(f"host{n}.tenant{n % 997}.example{n % 7}.com")
+            elif kind == 'ipv4':
+                ips.append(f"{10 + (n >> 16) % 200}.{(n >> 8) % 256}.{n % 256}.0/{rnd.choice((24, 25, 31, 32))}")
+            elif kind == 'ipv6':
+                ips.append(f"2603:{(n >> 12) % 65536:x}:{n % 4096:x}::/{rnd.choice((48, 56, 64))}")
+            else:
+                urls.append(f"host{n}.site{n % 991}.example{n % 7}.net")
+        generated += len(urls) + len(ips)
+        generated_urls.extend(urls)
+        generated_ips.extend(ips)
+        endpoint = {
+            'id': endpoint_set_id,
+            'serviceArea': rnd.choice(service_areas),
+            'serviceAreaDisplayName': 'Synthetic',
+            'category': rnd.choice(categories),
+            'required': rnd.random() < 0.9,
+            'expressRoute': False,
+            'tcpPorts': '80,443',
+        }
+        if urls:
+            endpoint['urls'] = urls
+        if ips:
+            endpoint['ips'] = ips
+        if rnd.random() < 0.2:
+            endpoint['notes'] = f"Synthetic endpoint set {endpoint_set_id}, generated for benchmarking"
+        endpoint_set.append(endpoint)
+        endpoint_set_id += 1
+    return endpoint_set
@@ -21,7 +21,7 @@ setup(
                  'Programming Language :: Python :: 3.6',
                  'Programming Language :: Python :: 3.7'],
     packages=find_packages(),
-    scripts=['m365digester-cli'],
+    scripts=['m365digester-cli', 'm365digester-squid-helper', 'm365digester-history'],
     install_requires=None,
     python_requires='>=3.6.2'
 )